@@ -0,0 +1,255 @@
+#!/usr/bin/python
+import math
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# bits of a Bloom filter for each key added to it.  10 bits, with the
+# matching number of hash functions, let about 1% of other keys through
+bloom_filter_bits_per_key = 10
+
+# hashes are kept to 64 bits
+hash_mask = 0xFFFFFFFFFFFFFFFF
+
+# python hashes numbers modulo this prime, so that equal numbers of any
+# type have the same hash
+hash_modulus = (1 << 61) - 1
+
+
+class BloomFilter:
+    '''a set of keys that can only answer whether a key might be in it.
+        keys that were added are always found, and other keys are found
+        with a small probability, the false-positive rate.  each key sets
+        a few bits of a bit array, chosen by hashes of the key, and a key
+        might be in the set if all of its bits are set
+
+        keys are hashed with the splitmix64 finalizer applied to python's
+        hash of each key, so that keys that are equal, such as 5 and 5.0,
+        have the same bits.  with numpy, the hashes of numbers in typed
+        columns are computed a column at a time, the same way python
+        hashes them.  strings are hashed differently by each process, so a
+        filter is only meaningful within one process
+'''
+
+    def __init__(self, key_count, bits_per_key=bloom_filter_bits_per_key):
+        '''keyword_args:
+            key_count - number of keys that will be added to the filter.
+                        duplicate keys may be counted
+            bits_per_key - bits of the filter for each key (optional)
+'''
+        bit_count = 64
+        while bit_count < key_count * bits_per_key:
+            bit_count *= 2
+
+        self.bit_mask = bit_count - 1
+        self.hash_count = max(1, int(round(bits_per_key * math.log(2))))
+        self.bits = bytearray(bit_count // 8)
+
+        # rows checked against the filter and rows that passed, counted
+        # by the scans that use it
+        self.checked = 0
+        self.passed = 0
+
+        # join keys of the rows that passed, appended a batch at a time by
+        # the scans, so that the keys that passed without being in the
+        # other table can be counted once the scans are done
+        self.passed_keys = []
+
+    def add(self, values):
+        '''adds keys to the filter.  empty values are left out, as they
+            never join
+
+        keyword_args:
+            values - a typed column, as returned by file_to_data_structure
+'''
+        if numpy is not None:
+            hashes = key_hashes(values)
+            if len(hashes) == 0:
+                return
+            bits = numpy.frombuffer(self.bits, numpy.uint8)
+            first_hashes, second_hashes = split_hashes(hashes)
+            for i in range(self.hash_count):
+                positions = (first_hashes + numpy.uint64(i) *
+                             second_hashes) & numpy.uint64(self.bit_mask)
+                numpy.bitwise_or.at(
+                    bits, (positions >> numpy.uint64(3)).astype(numpy.intp),
+                    numpy.left_shift(1, positions & numpy.uint64(7)).astype(
+                        numpy.uint8))
+            return
+
+        bits = self.bits
+        bit_mask = self.bit_mask
+        for value in set(values):
+            if value is None:
+                continue
+            z = mix_hash(hash(value))
+            first_hash = z & 0xFFFFFFFF
+            second_hash = (z >> 32) | 1
+            for i in range(self.hash_count):
+                position = (first_hash + i * second_hash) & bit_mask
+                bits[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, value):
+        '''returns False if a key is certainly not in the filter, and True
+            if it might be
+'''
+        z = mix_hash(hash(value))
+        first_hash = z & 0xFFFFFFFF
+        second_hash = (z >> 32) | 1
+        bits = self.bits
+        bit_mask = self.bit_mask
+        for i in range(self.hash_count):
+            position = (first_hash + i * second_hash) & bit_mask
+            if not bits[position >> 3] >> (position & 7) & 1:
+                return False
+
+        return True
+
+    def might_contain_values(self, values):
+        '''checks many keys against the filter at once, with numpy
+
+        keyword_args:
+            values - numpy array of keys, or a typed column with no empty
+                     values
+
+        returns:
+            numpy boolean array, True for each key that might be in the
+            filter
+'''
+        hashes = key_hashes(values)
+        first_hashes, second_hashes = split_hashes(hashes)
+        bits = numpy.frombuffer(self.bits, numpy.uint8)
+
+        # keys that are missing one bit aren't checked any further
+        candidates = numpy.arange(len(hashes))
+        for i in range(self.hash_count):
+            positions = (first_hashes + numpy.uint64(i) * second_hashes) & \
+                numpy.uint64(self.bit_mask)
+            found = (bits[(positions >> numpy.uint64(3)).astype(numpy.intp)] >>
+                     (positions & numpy.uint64(7)).astype(numpy.uint8)) & 1
+            found = found.astype(bool)
+            candidates = candidates[found]
+            first_hashes = first_hashes[found]
+            second_hashes = second_hashes[found]
+
+        contained = numpy.zeros(len(hashes), bool)
+        contained[candidates] = True
+        return contained
+
+    def false_positive_rate(self):
+        '''returns the expected fraction of keys that weren't added to the
+            filter that it might contain, from the fraction of its bits that
+            are set
+'''
+        if numpy is not None:
+            set_bits = int(numpy.unpackbits(
+                numpy.frombuffer(self.bits, numpy.uint8)).sum())
+        else:
+            set_bits = sum(bin(byte).count('1') for byte in self.bits)
+
+        return (set_bits / (self.bit_mask + 1)) ** self.hash_count
+
+
+def mix_hash(value_hash):
+    '''returns the splitmix64 finalizer of a python hash, as a 64 bit
+        unsigned number
+'''
+    z = (value_hash + 0x9E3779B97F4A7C15) & hash_mask
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & hash_mask
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & hash_mask
+    return z ^ (z >> 31)
+
+
+def key_hashes(values):
+    '''returns the python hashes of keys, with numpy, as a uint64 array.
+        empty values are left out
+
+    keyword_args:
+        values - numpy array of keys, or a typed column
+'''
+    if isinstance(values, array):
+        values = numpy.frombuffer(values, values.typecode)
+    elif not isinstance(values, numpy.ndarray):
+        values = [v for v in values if v is not None]
+        if len(values) > 0 and isinstance(values[0], (int, float)):
+            values = numpy.array(values)
+        else:
+            return numpy.fromiter(map(hash, values), numpy.int64,
+                                  len(values)).view(numpy.uint64)
+
+    # whole numbers hash like the integers they are equal to
+    if values.dtype.kind == 'f':
+        if numpy.isfinite(values).all() and \
+                (numpy.abs(values) < 2.0 ** 63).all() and \
+                (numpy.floor(values) == values).all():
+            values = values.astype(numpy.int64)
+        else:
+            return numpy.fromiter(map(hash, values.tolist()), numpy.int64,
+                                  len(values)).view(numpy.uint64)
+
+    if values.dtype.kind in 'iu':
+        hashes = numpy.fmod(values.astype(numpy.int64), hash_modulus)
+        hashes[hashes == -1] = -2
+        return hashes.view(numpy.uint64)
+
+    return numpy.fromiter(map(hash, values.tolist()), numpy.int64,
+                          len(values)).view(numpy.uint64)
+
+
+def split_hashes(hashes):
+    '''mixes python hashes with the splitmix64 finalizer, with numpy, and
+        splits them into the two hashes that the bits of each key are
+        chosen from
+'''
+    z = hashes + numpy.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    z ^= z >> numpy.uint64(31)
+
+    return z & numpy.uint64(0xFFFFFFFF), \
+        (z >> numpy.uint64(32)) | numpy.uint64(1)
+
+
+if __name__ == '__main__':
+
+    # unit tests
+    keys = array('q', range(0, 200000, 2))
+    bloom_filter = BloomFilter(len(keys))
+    bloom_filter.add(keys)
+
+    # keys that were added are always found, as whatever type of number
+    assert all(bloom_filter.might_contain(key) for key in keys)
+    assert all(bloom_filter.might_contain(float(key)) for key in keys[:1000])
+
+    false_positives = sum(bloom_filter.might_contain(key)
+                          for key in range(1, 200000, 2))
+    assert false_positives / 100000 < 0.02
+    assert abs(bloom_filter.false_positive_rate() -
+               false_positives / 100000) < 0.005
+
+    if numpy is not None:
+        candidates = numpy.arange(-5, 200000)
+        contained = bloom_filter.might_contain_values(candidates)
+        assert contained.tolist() == [bloom_filter.might_contain(key)
+                                      for key in candidates.tolist()]
+        assert bloom_filter.might_contain_values(
+            array('d', [4.0, 6.5, -1.0])).tolist() == \
+            [True, bloom_filter.might_contain(6.5),
+             bloom_filter.might_contain(-1)]
+
+    # strings and columns with empty values
+    bloom_filter = BloomFilter(3)
+    bloom_filter.add(['BUILDING', None, 'MACHINERY'])
+    assert bloom_filter.might_contain('BUILDING')
+    assert bloom_filter.might_contain('MACHINERY')
+    if numpy is not None:
+        assert bloom_filter.might_contain_values(
+            numpy.array(['MACHINERY', 'BUILDING'], object)).all()
+
+    bloom_filter = BloomFilter(3)
+    bloom_filter.add([3, None, -1, 2 ** 62])
+    assert all(bloom_filter.might_contain(key) for key in [3, -1, 2 ** 62])
+
+    print('bloom filter unit tests passed')
@@ -0,0 +1,1071 @@
+#!/usr/bin/python
+import csv
+import json
+import mmap
+import os
+import shutil
+import tempfile
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from file_query_utilities import file_to_data_batches, concatenate_batches, \
+                                 column_storage, compile_column_filters, \
+                                 new_column_like, default_scan_batch_size, \
+                                 block_zones, blocks_to_scan, \
+                                 read_zone_maps, write_zone_maps, \
+                                 zone_map_block_size, zone_map_suffix, \
+                                 date_to_ordinal, scan_statistics, \
+                                 scan_statistics_lock
+from table_statistics import TableStatisticsCollector
+
+# a table's columnar layouts are kept in a directory next to its CSV file,
+# named after the CSV file with this suffix
+columnar_suffix = '.columns'
+
+# file in each layout that describes its columns
+layout_filename = 'layout.json'
+
+# strings are stored one after the other, each followed by this separator
+string_separator = '\x00'
+
+# an equality filter reads the rows its index finds if they are less than
+# this fraction of the table.  reading neighbouring rows is cheaper than
+# reading rows one at a time, so less selective filters read every row
+index_row_fraction = 0.05
+
+
+def columnar_directory(local_filename):
+    '''returns the name of the directory holding the columnar layouts of a
+        local CSV file
+'''
+    return local_filename + columnar_suffix
+
+
+def layout_directory(local_filename, etags):
+    '''returns the name of the directory holding the columnar layout of a
+        particular version of a local CSV file
+
+    keyword_args:
+        local_filename - name of the local CSV file
+        etags - ETags of the S3 objects the CSV file and its _header file
+                were downloaded from
+'''
+    return os.path.join(columnar_directory(local_filename),
+                        '_'.join(etag.strip('"') for etag in etags))
+
+
+def columnar_bytes(local_filename):
+    '''returns the number of bytes taken on disk by the columnar layouts of
+        a local CSV file, along with their indexes, and by the zone maps
+        kept next to the file when it has no layout
+'''
+    total_bytes = 0
+    for directory, directory_names, filenames in \
+            os.walk(columnar_directory(local_filename)):
+        for filename in filenames:
+            try:
+                total_bytes += os.path.getsize(os.path.join(directory,
+                                                            filename))
+            except FileNotFoundError:
+                pass
+
+    try:
+        total_bytes += os.path.getsize(local_filename + zone_map_suffix)
+    except FileNotFoundError:
+        pass
+
+    return total_bytes
+
+
+def remove_columnar_layouts(local_filename):
+    '''removes the columnar layouts of a local CSV file, along with their
+        indexes, and the zone maps kept next to the file.  layouts and
+        indexes that are still being written, in temporary directories, are
+        left for the query writing them
+'''
+    directory = columnar_directory(local_filename)
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        names = []
+
+    for name in names:
+        layout = os.path.join(directory, name)
+        try:
+            if name.endswith('.tmp') or \
+                    any(v.endswith('.tmp') for v in os.listdir(layout)):
+                continue
+        except FileNotFoundError:
+            continue
+        shutil.rmtree(layout, ignore_errors=True)
+
+    try:
+        os.rmdir(directory)
+    except OSError:
+        pass
+
+    try:
+        os.remove(local_filename + zone_map_suffix)
+    except FileNotFoundError:
+        pass
+
+
+def write_columnar_layout(local_filename, etags, scan_engine=None,
+                          block_size=zone_map_block_size):
+    '''converts a local CSV file and its _header file into a columnar layout,
+        with a binary file for each column.  INTEGER and DATE columns are
+        stored as 64-bit integers, NUMERIC columns as 64-bit floats and all
+        other columns as UTF-8 strings with a file of their offsets.  the
+        positions of empty numeric and date values are kept in a file of
+        their own.  the file is converted a block of rows at a time, and
+        the zone maps of each block are kept with the layout, as
+        write_zone_maps keeps them for a CSV file
+
+        the statistics of the table, as collected by TableStatisticsCollector,
+        are kept with the layout's description of its columns
+
+        the layout is written to a temporary directory and then moved into
+        place, so a partly written layout is never read.  layouts of other
+        versions of the file are removed
+
+    keyword_args:
+        local_filename - name of the local CSV file
+        etags - ETags of the S3 objects the CSV file and its _header file
+                were downloaded from
+        scan_engine - engine used to read the CSV file, as used by
+                      file_to_data_structure (optional)
+        block_size - number of rows in each block of the zone maps
+                     (optional)
+
+    returns:
+        name of the directory holding the layout
+
+    raises:
+        ValueError if a string holds string_separator, so the file can't be
+        stored in a columnar layout
+'''
+    directory = columnar_directory(local_filename)
+    os.makedirs(directory, exist_ok=True)
+    temporary_directory = tempfile.mkdtemp(dir=directory, suffix='.tmp')
+
+    try:
+        with open(local_filename + '_header', newline='') as lfile_header:
+            column_headers = next(csv.reader(lfile_header, delimiter=',',
+                                             quotechar='"'))
+        column_typecodes = {}
+        for column_header in column_headers:
+            column_definition = column_header.split(' ')
+            column_typecodes[column_definition[0]] = \
+                column_storage(column_definition[1])[0]
+
+        column_positions, column_datatypes, batches = \
+            file_to_data_batches(local_filename, scan_engine=scan_engine,
+                                 batch_size=block_size)
+        column_names = sorted(column_positions, key=column_positions.get)
+        typecodes = [column_typecodes.get(v) for v in column_names]
+        zone_map_datatypes = {v: column_datatypes[v]
+                              for v, typecode in zip(column_names, typecodes)
+                              if typecode is not None}
+        blocks = []
+
+        column_files = []
+        offset_files = []
+        for position, typecode in enumerate(typecodes):
+            column_files.append(open(os.path.join(
+                temporary_directory, 'c' + str(position)), 'wb'))
+            if typecode is None:
+                offset_files.append(open(os.path.join(
+                    temporary_directory, 'c' + str(position) + '.offsets'),
+                    'wb'))
+                array('q', [0]).tofile(offset_files[position])
+            else:
+                offset_files.append(None)
+
+        row_count = 0
+        string_offsets = [0] * len(typecodes)
+        null_rows = [array('q') for typecode in typecodes]
+        collector = TableStatisticsCollector(column_names)
+
+        try:
+            for batch in batches:
+                collector.add_batch(batch)
+                if len(batch[0]) > 0:
+                    blocks.append({'start': row_count,
+                                   'end': row_count + len(batch[0]),
+                                   'zones': block_zones(
+                                       [column if typecode is not None
+                                        else None for column, typecode
+                                        in zip(batch, typecodes)],
+                                       column_names)})
+
+                for position, column in enumerate(batch):
+                    typecode = typecodes[position]
+
+                    if typecode is None:
+                        strings = string_separator.join(column) + \
+                            string_separator
+                        if strings.count(string_separator) != len(column):
+                            raise ValueError('column ' +
+                                             column_names[position] +
+                                             ' holds a string separator')
+
+                        # offsets are in bytes, which are only the same
+                        # as characters for ASCII strings
+                        if strings.isascii():
+                            lengths = (len(v) + 1 for v in column)
+                        else:
+                            lengths = (len(v.encode('utf-8')) + 1
+                                       for v in column)
+                        offsets = array('q', accumulate(
+                            lengths, initial=string_offsets[position]))
+                        string_offsets[position] = offsets[-1]
+                        offsets.pop(0)
+                        offsets.tofile(offset_files[position])
+
+                        if len(column) > 0:
+                            column_files[position].write(
+                                strings.encode('utf-8'))
+
+                    elif isinstance(column, array):
+                        column.tofile(column_files[position])
+
+                    else:
+                        null_rows[position].extend(
+                            row_count + row for row, v in enumerate(column)
+                            if v is None)
+                        array(typecode, (0 if v is None else v
+                                         for v in column)).tofile(
+                            column_files[position])
+
+                row_count += len(batch[0])
+        finally:
+            for column_file in column_files + offset_files:
+                if column_file is not None:
+                    column_file.close()
+
+        for position, rows in enumerate(null_rows):
+            if len(rows) > 0:
+                with open(os.path.join(temporary_directory,
+                                       'c' + str(position) + '.nulls'),
+                          'wb') as nulls_file:
+                    rows.tofile(nulls_file)
+
+        with open(os.path.join(temporary_directory, layout_filename),
+                  'w') as layout_file:
+            json.dump({'column_names': column_names,
+                       'column_datatypes': column_datatypes,
+                       'typecodes': typecodes,
+                       'row_count': row_count,
+                       'zone_maps': {'datatypes': zone_map_datatypes,
+                                     'blocks': blocks},
+                       'statistics': collector.statistics()}, layout_file)
+
+        # another query may have written the same layout in the meantime
+        layout = layout_directory(local_filename, etags)
+        try:
+            os.rename(temporary_directory, layout)
+        except OSError:
+            if not os.path.exists(os.path.join(layout, layout_filename)):
+                raise
+            shutil.rmtree(temporary_directory)
+
+    except BaseException:
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+        raise
+
+    for name in os.listdir(directory):
+        if name != os.path.basename(layout) and not name.endswith('.tmp'):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    return layout
+
+
+def columnar_to_data_batches(layout, sql_tree=None, columns=None,
+                             batch_size=default_scan_batch_size):
+    '''reads a columnar layout a batch of rows at a time, applying filters
+        along the way.  only the files of the columns that are kept or
+        filtered on are opened, and they are memory-mapped rather than read,
+        so only the rows of each batch are copied into memory.  blocks of
+        rows that can't pass the filters, according to the layout's zone
+        maps, are skipped
+
+    keyword_args:
+        layout - directory holding the layout, as returned by
+                 write_columnar_layout
+        sql_tree (optional): the SQL tree associated with this table,
+                        used to apply filters
+        columns (optional): names of the columns to keep, as used by
+                        file_to_data_structure
+        batch_size (optional): largest number of rows in each batch
+
+    returns:
+        the same as file_to_data_batches
+'''
+    with open(os.path.join(layout, layout_filename)) as layout_file:
+        layout_description = json.load(layout_file)
+
+    column_names = layout_description['column_names']
+    column_datatypes = layout_description['column_datatypes']
+    typecodes = layout_description['typecodes']
+    column_positions = {v: i for i, v in enumerate(column_names)}
+    zone_maps = layout_description['zone_maps']
+
+    data_filter_sql_tree = []
+    semi_join_filters = []
+    if sql_tree is not None and 'filters' in sql_tree:
+        data_filter_sql_tree = sql_tree['filters']
+    if sql_tree is not None and 'semi_join_filters' in sql_tree:
+        semi_join_filters = sql_tree['semi_join_filters']
+
+    # equality filters on indexed columns find their rows in the index,
+    # so only those rows are read
+    indexed_rows = None
+    for filter in data_filter_sql_tree:
+        if filter['operator'] != '=' or \
+                filter['identifier'] not in column_positions:
+            continue
+        index = open_column_index(layout,
+                                  column_positions[filter['identifier']],
+                                  typecodes[column_positions[
+                                      filter['identifier']]])
+        if index is None:
+            continue
+
+        filter_element = filter['value'].replace("'", '')
+        if column_datatypes[filter['identifier']] == 'NUMBER':
+            filter_element = float(filter_element)
+        elif column_datatypes[filter['identifier']] == 'DATE':
+            filter_element = date_to_ordinal(filter_element)
+
+        filter_rows = index.get(filter_element, [])
+        index.close()
+        if len(filter_rows) > layout_description['row_count'] * \
+                index_row_fraction:
+            continue
+        with scan_statistics_lock:
+            scan_statistics['index_lookups'] += 1
+
+        if indexed_rows is None:
+            indexed_rows = filter_rows
+        else:
+            indexed_rows = sorted(set(indexed_rows).intersection(
+                filter_rows))
+
+    # otherwise, neighbouring blocks that can pass the filters are read
+    # together, in batches of up to batch_size rows
+    if indexed_rows is not None:
+        row_batches = [indexed_rows[start:start + batch_size]
+                       for start in range(0, len(indexed_rows), batch_size)]
+    else:
+        scanned_blocks = [True] * len(zone_maps['blocks'])
+        if len(data_filter_sql_tree) > 0:
+            scanned_blocks = blocks_to_scan(zone_maps, data_filter_sql_tree)
+
+        row_ranges = []
+        for block, scanned in zip(zone_maps['blocks'], scanned_blocks):
+            if not scanned:
+                continue
+            if len(row_ranges) > 0 and row_ranges[-1][1] == block['start']:
+                row_ranges[-1][1] = block['end']
+            else:
+                row_ranges.append([block['start'], block['end']])
+
+        row_batches = [range(start, min(start + batch_size, range_end))
+                       for range_start, range_end in row_ranges
+                       for start in range(range_start, range_end,
+                                          batch_size)]
+
+    column_filters = compile_column_filters(
+        data_filter_sql_tree, column_positions, column_datatypes,
+        layout_description.get('statistics'), semi_join_filters)
+
+    # keep at least one column, so that the number of rows is known
+    if columns is not None and columns.isdisjoint(column_names):
+        columns = {column_names[0]}
+
+    kept_positions = {i for i, v in enumerate(column_names)
+                      if columns is None or v in columns}
+    read_positions = set(kept_positions)
+    read_positions.update(column_positions[filter['identifier']]
+                          for filter in data_filter_sql_tree +
+                          semi_join_filters
+                          if filter['identifier'] in column_positions)
+
+    def read_batches():
+        mapped_files = []
+        column_views = {}
+        offset_views = {}
+        null_rows = {}
+
+        def map_file(filename):
+            with open(os.path.join(layout, filename), 'rb') as mapped_file:
+                if os.fstat(mapped_file.fileno()).st_size == 0:
+                    return memoryview(b'')
+                mapped_files.append(mmap.mmap(mapped_file.fileno(), 0,
+                                              access=mmap.ACCESS_READ))
+            return memoryview(mapped_files[-1])
+
+        try:
+            for position in read_positions:
+                filename = 'c' + str(position)
+                column_views[position] = map_file(filename)
+                if typecodes[position] is None:
+                    offset_views[position] = \
+                        map_file(filename + '.offsets').cast('q')
+                elif os.path.exists(os.path.join(layout,
+                                                 filename + '.nulls')):
+                    null_rows[position] = array('q')
+                    with open(os.path.join(layout, filename + '.nulls'),
+                              'rb') as nulls_file:
+                        null_rows[position].frombytes(nulls_file.read())
+
+            batch_count = 0
+            for batch_rows in row_batches:
+                batch = [None] * len(column_names)
+                for position in read_positions:
+                    batch[position] = read_column_batch(
+                        position, batch_rows, column_views, offset_views,
+                        null_rows, typecodes[position])
+
+                rows = range(len(batch_rows))
+                for column_filter in column_filters:
+                    rows = column_filter(batch, rows)
+
+                for position in read_positions:
+                    if position not in kept_positions:
+                        batch[position] = None
+                    elif len(rows) < len(batch_rows):
+                        batch[position] = select_rows(batch[position], rows,
+                                                      typecodes[position])
+
+                if len(rows) > 0:
+                    batch_count += 1
+                    yield batch
+
+            if batch_count == 0:
+                yield [None if i not in kept_positions
+                       else [] if typecodes[i] is None
+                       else array(typecodes[i])
+                       for i in range(len(column_names))]
+
+        finally:
+            # views must be released before their files can be unmapped
+            for view in list(column_views.values()) + \
+                    list(offset_views.values()):
+                view.release()
+            for mapped_file in mapped_files:
+                mapped_file.close()
+
+    return column_positions, column_datatypes, read_batches()
+
+
+def read_column_batch(position, rows, column_views, offset_views,
+                      null_rows, typecode):
+    '''copies rows of a memory-mapped column into a typed column, as held
+        by file_to_data_structure.  used by columnar_to_data_batches
+
+    keyword_args:
+        rows - a range of neighbouring rows, or a sorted list of rows
+'''
+    column_view = column_views[position]
+
+    if not isinstance(rows, range):
+        return read_column_rows(position, rows, column_views, offset_views,
+                                null_rows, typecode)
+    start = rows.start
+    end = rows.stop
+
+    if typecode is None:
+        offsets = offset_views[position]
+        strings = str(column_view[offsets[start]:offsets[end]], 'utf-8')
+        column = strings.split(string_separator)
+        column.pop()
+        return column
+
+    column = array(typecode)
+    column.frombytes(column_view[start * column.itemsize:
+                                 end * column.itemsize])
+
+    if position in null_rows:
+        rows = null_rows[position]
+        first_null = bisect_left(rows, start)
+        if first_null < len(rows) and rows[first_null] < end:
+            column = column.tolist()
+            for row in rows[first_null:bisect_left(rows, end)]:
+                column[row - start] = None
+
+    return column
+
+
+def read_column_rows(position, rows, column_views, offset_views,
+                     null_rows, typecode):
+    '''copies a list of rows of a memory-mapped column into a typed
+        column, as read_column_batch does for a range of rows
+'''
+    column_view = column_views[position]
+
+    if typecode is None:
+        offsets = offset_views[position]
+        return [str(column_view[offsets[row]:offsets[row + 1] - 1], 'utf-8')
+                for row in rows]
+
+    column_view = column_view.cast(typecode)
+    column = array(typecode, [column_view[row] for row in rows])
+
+    if position in null_rows:
+        nulls = null_rows[position]
+        empty_rows = [i for i, row in enumerate(rows)
+                      if bisect_left(nulls, row) < len(nulls) and
+                      nulls[bisect_left(nulls, row)] == row]
+        if len(empty_rows) > 0:
+            column = column.tolist()
+            for i in empty_rows:
+                column[i] = None
+
+    column_view.release()
+    return column
+
+
+def select_rows(column, rows, typecode):
+    '''returns a new typed column holding the given rows of a column.  a
+        column with empty values is held as an array again if none of the
+        given rows are empty
+'''
+    selected_values = [column[row] for row in rows]
+    if typecode is not None and not isinstance(column, array) and \
+            None not in selected_values:
+        return array(typecode, selected_values)
+
+    selected_column = new_column_like(column)
+    selected_column.extend(selected_values)
+    return selected_column
+
+
+class ColumnIndex:
+    '''a persistent hash index of a column of a columnar layout, mapping each
+        value of the column to the rows that hold it
+
+        the index is kept as the sorted distinct values of the column, the
+        rows holding each value, in order, and the start of each value's
+        rows.  its files are memory-mapped and values are found by binary
+        search, so an index is used without being loaded into memory
+'''
+
+    def __init__(self, directory, typecode):
+        '''keyword_args:
+            directory - directory holding the index, as written by
+                        write_column_index
+            typecode - array typecode of the column, or None for strings
+'''
+        self.mapped_files = []
+        self.views = []
+
+        if typecode is None:
+            self.keys = MappedStrings(
+                self.map_file(directory, 'keys'),
+                self.map_file(directory, 'key_offsets', 'q'))
+        else:
+            self.keys = self.map_file(directory, 'keys', typecode)
+        self.starts = self.map_file(directory, 'starts', 'q')
+        self.rows = self.map_file(directory, 'rows', 'q')
+
+    def map_file(self, directory, filename, typecode=None):
+        '''memory-maps a file of the index, returning a view of its bytes,
+            or of its values if typecode is given
+'''
+        with open(os.path.join(directory, filename), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                view = memoryview(b'')
+            else:
+                self.mapped_files.append(mmap.mmap(f.fileno(), 0,
+                                                   access=mmap.ACCESS_READ))
+                view = memoryview(self.mapped_files[-1])
+        self.views.append(view)
+
+        if typecode is not None:
+            view = view.cast(typecode)
+            self.views.append(view)
+        return view
+
+    def get(self, key, default=None):
+        '''returns the rows holding a value, in order, or default if no row
+            holds it.  used in place of a dictionary of rows
+'''
+        try:
+            i = bisect_left(self.keys, key)
+        except TypeError:
+            return default
+
+        if i == len(self.keys) or self.keys[i] != key:
+            return default
+
+        return self.rows[self.starts[i]:self.starts[i + 1]].tolist()
+
+    def close(self):
+        '''unmaps the files of the index'''
+
+        for view in reversed(self.views):
+            view.release()
+        for mapped_file in self.mapped_files:
+            mapped_file.close()
+
+
+class MappedStrings:
+    '''a read-only sequence of the strings in a memory-mapped file, stored
+        as in a columnar layout, so that they can be binary searched
+'''
+
+    def __init__(self, strings, offsets):
+        self.strings = strings
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self.strings[self.offsets[i]:self.offsets[i + 1] - 1],
+                   'utf-8')
+
+
+def index_directory(layout, position):
+    '''returns the name of the directory holding the index of a column of a
+        columnar layout
+'''
+    return os.path.join(layout, 'c' + str(position) + '.index')
+
+
+def write_column_index(layout, column_name):
+    '''builds the index of a column of a columnar layout and keeps it with
+        the layout, so that it is removed along with the layout when the
+        table changes.  empty values aren't indexed
+
+    keyword_args:
+        layout - directory holding the layout, as returned by
+                 write_columnar_layout
+        column_name - name of the column to index
+
+    returns:
+        True if the index was written, or False if the layout has no such
+        column
+'''
+    with open(os.path.join(layout, layout_filename)) as layout_file:
+        layout_description = json.load(layout_file)
+    if column_name not in layout_description['column_names']:
+        return False
+
+    position = layout_description['column_names'].index(column_name)
+    typecode = layout_description['typecodes'][position]
+
+    column_positions, column_datatypes, batches = \
+        columnar_to_data_batches(layout, columns={column_name})
+
+    key_rows = {}
+    row = 0
+    for batch in batches:
+        for v in batch[position]:
+            if v is not None:
+                try:
+                    key_rows[v].append(row)
+                except KeyError:
+                    key_rows[v] = [row]
+            row += 1
+
+    keys = sorted(key_rows)
+    starts = array('q', accumulate((len(key_rows[v]) for v in keys),
+                                   initial=0))
+    rows = array('q')
+    for v in keys:
+        rows.extend(key_rows[v])
+
+    temporary_directory = tempfile.mkdtemp(dir=layout, suffix='.tmp')
+    try:
+        with open(os.path.join(temporary_directory, 'keys'), 'wb') as f:
+            if typecode is None:
+                key_offsets = array('q', accumulate(
+                    (len(v.encode('utf-8')) + 1 for v in keys), initial=0))
+                f.write(''.join(v + string_separator
+                                for v in keys).encode('utf-8'))
+                with open(os.path.join(temporary_directory, 'key_offsets'),
+                          'wb') as offsets_file:
+                    key_offsets.tofile(offsets_file)
+            else:
+                array(typecode, keys).tofile(f)
+        with open(os.path.join(temporary_directory, 'starts'), 'wb') as f:
+            starts.tofile(f)
+        with open(os.path.join(temporary_directory, 'rows'), 'wb') as f:
+            rows.tofile(f)
+
+        try:
+            os.rename(temporary_directory, index_directory(layout, position))
+        except OSError:
+            # another query wrote the index in the meantime
+            shutil.rmtree(temporary_directory)
+    except BaseException:
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+        raise
+
+    return True
+
+
+def open_column_index(layout, position, typecode):
+    '''returns the ColumnIndex of a column of a columnar layout, or None if
+        the column isn't indexed
+
+    keyword_args:
+        layout - directory holding the layout
+        position - position of the column
+        typecode - array typecode of the column, or None for strings
+'''
+    if not os.path.isdir(index_directory(layout, position)):
+        return None
+
+    return ColumnIndex(index_directory(layout, position), typecode)
+
+
+def cached_table_to_data_batches(cache, bucket, s3_filename, sql_tree=None,
+                                 scan_engine=None, columns=None,
+                                 batch_size=default_scan_batch_size,
+                                 index_columns=None):
+    '''reads a table held in an S3FileCache a batch of rows at a time, from
+        its columnar layout.  the layout is written the first time the
+        table is read, and written again whenever the ETag of the table or
+        of its _header file changes.  tables that can't be stored in a
+        columnar layout are read from the CSV file instead, with zone maps
+
+    keyword_args:
+        cache - S3FileCache that the table and its _header file have been
+                retrieved into
+        bucket - name of S3 bucket holding the table
+        s3_filename - key of the table in the bucket
+        sql_tree, scan_engine, columns, batch_size - the same as
+                file_to_data_batches (optional)
+        index_columns - names of columns to index, as used by
+                        cached_table_layout (optional)
+
+    returns:
+        the same as file_to_data_batches
+'''
+    local_filename = cache.local_filename(bucket, s3_filename)
+
+    layout = cached_table_layout(cache, bucket, s3_filename, scan_engine,
+                                 index_columns)
+    if layout is not None:
+        return columnar_to_data_batches(layout, sql_tree, columns,
+                                        batch_size)
+
+    if read_zone_maps(local_filename) is None:
+        write_zone_maps(local_filename)
+        cache.count_layout_bytes(bucket, s3_filename)
+
+    return file_to_data_batches(local_filename, sql_tree, scan_engine,
+                                columns, batch_size)
+
+
+def cached_table_layout(cache, bucket, s3_filename, scan_engine=None,
+                        index_columns=None):
+    '''finds the columnar layout of a table held in an S3FileCache, writing
+        it if the table has changed since it was last written, and writes
+        the indexes of the layout that don't exist yet.  the bytes they
+        take are counted in the size of the table in the cache
+
+    keyword_args:
+        cache - S3FileCache that the table and its _header file have been
+                retrieved into
+        bucket - name of S3 bucket holding the table
+        s3_filename - key of the table in the bucket
+        scan_engine - engine used to read the table, as used by
+                      file_to_data_structure (optional)
+        index_columns - names of the columns to index.  columns that
+                        aren't in the table are ignored (optional)
+
+    returns:
+        name of the directory holding the layout, or None if the table
+        can't be stored in a columnar layout
+'''
+    local_filename = cache.local_filename(bucket, s3_filename)
+    etags = [cache.etag(bucket, s3_filename),
+             cache.etag(bucket, s3_filename + '_header')]
+    if None in etags:
+        return None
+
+    layout = layout_directory(local_filename, etags)
+    written = False
+    try:
+        if not os.path.exists(os.path.join(layout, layout_filename)):
+            layout = write_columnar_layout(local_filename, etags,
+                                           scan_engine)
+            written = True
+    except ValueError as ve:
+        print(ve)
+        return None
+
+    if index_columns is not None:
+        with open(os.path.join(layout, layout_filename)) as layout_file:
+            column_names = json.load(layout_file)['column_names']
+        for position, column_name in enumerate(column_names):
+            if column_name in index_columns and \
+                    not os.path.isdir(index_directory(layout, position)):
+                write_column_index(layout, column_name)
+                written = True
+
+    if written:
+        cache.count_layout_bytes(bucket, s3_filename)
+
+    return layout
+
+
+def written_table_layout(cache, bucket, s3_filename, etag):
+    '''finds the columnar layout of a version of a table held in an
+        S3FileCache, if it has already been written, without retrieving the
+        table or writing its layout.  a query can then be planned from the
+        layout while the table is still being retrieved
+
+    keyword_args:
+        cache - S3FileCache that the table's _header file has been
+                retrieved into
+        bucket - name of S3 bucket holding the table
+        s3_filename - key of the table in the bucket
+        etag - ETag of the version of the table
+
+    returns:
+        name of the directory holding the layout, or None if it hasn't been
+        written
+'''
+    header_etag = cache.etag(bucket, s3_filename + '_header')
+    if header_etag is None:
+        return None
+
+    layout = layout_directory(cache.local_filename(bucket, s3_filename),
+                              [etag, header_etag])
+    if not os.path.exists(os.path.join(layout, layout_filename)):
+        return None
+
+    return layout
+
+
+def layout_indexes(layout, sql_tree=None):
+    '''opens the indexes of a columnar layout that can be used to join the
+        table, which is only the case if none of the query's filters, nor
+        any semi-join filters, apply to the table, as the indexes hold the
+        rows of the whole table
+
+    keyword_args:
+        layout - directory holding the layout
+        sql_tree - the SQL tree the table is read for (optional)
+
+    returns:
+        dictionary of column names and their ColumnIndex
+'''
+    with open(os.path.join(layout, layout_filename)) as layout_file:
+        layout_description = json.load(layout_file)
+    column_names = layout_description['column_names']
+
+    if sql_tree is not None and any(
+            filter['identifier'] in column_names
+            for filter in sql_tree.get('filters', []) +
+            sql_tree.get('semi_join_filters', [])):
+        return {}
+
+    indexes = {}
+    for position, column_name in enumerate(column_names):
+        index = open_column_index(layout, position,
+                                  layout_description['typecodes'][position])
+        if index is not None:
+            indexes[column_name] = index
+
+    return indexes
+
+
+def layout_statistics(layout):
+    '''returns the statistics of the table in a columnar layout, as
+        returned by read_table_statistics, or None if the layout was written
+        without them
+'''
+    with open(os.path.join(layout, layout_filename)) as layout_file:
+        return json.load(layout_file).get('statistics')
+
+
+def cached_table_to_data_structure(cache, bucket, s3_filename, sql_tree=None,
+                                   scan_engine=None, columns=None,
+                                   index_columns=None):
+    '''reads a table held in an S3FileCache from its columnar layout, as
+        cached_table_to_data_batches does
+
+    returns:
+        the same as file_to_data_structure
+'''
+    column_positions, column_datatypes, batches = \
+        cached_table_to_data_batches(cache, bucket, s3_filename, sql_tree,
+                                     scan_engine, columns,
+                                     index_columns=index_columns)
+
+    return column_positions, column_datatypes, concatenate_batches(batches)
+
+
+if __name__ == '__main__':
+
+    # unit tests
+    from file_query_utilities import file_to_data_structure, \
+                                     clear_scan_statistics, \
+                                     semi_join_statistics
+    from bloom_filter import BloomFilter
+
+    directory = tempfile.mkdtemp()
+    local_filename = os.path.join(directory, 'tcph_part')
+    with open(local_filename, 'w') as lfile:
+        lfile.write('p_partkey,p_name,p_size,p_retailprice,p_date\n')
+        for i in range(1000):
+            lfile.write(str(i) + ',"part, ' + chr(0x100 + i % 3) * (i % 5) +
+                        '",' + ('' if i % 7 == 0 else str(i % 50)) + ',' +
+                        str(i * 1.5) + ',1998-0' + str(1 + i % 9) +
+                        '-01\n')
+    with open(local_filename + '_header', 'w') as lfile_header:
+        lfile_header.write('p_partkey INTEGER,p_name VARCHAR(55),'
+                           'p_size INTEGER,p_retailprice NUMERIC,'
+                           'p_date DATE\n')
+
+    layout = write_columnar_layout(local_filename, ['"a"', '"b"'])
+    assert layout == layout_directory(local_filename, ['"a"', '"b"'])
+
+    # a written layout is found from the ETag of the table, before the
+    # table is retrieved
+    class HeaderCache:
+        # stands in for an S3FileCache holding the table's _header file
+        def local_filename(self, bucket, s3_filename):
+            return local_filename
+
+        def etag(self, bucket, s3_filename):
+            return '"b"' if s3_filename.endswith('_header') else None
+
+    assert written_table_layout(HeaderCache(), 'bucket', 'part', '"a"') == \
+        layout
+    assert written_table_layout(HeaderCache(), 'bucket', 'part',
+                                '"c"') is None
+
+    # the table's statistics are collected while it is converted
+    statistics = layout_statistics(layout)
+    assert statistics['row_count'] == 1000
+    assert statistics['columns']['p_size']['nulls'] == 143
+    assert statistics['columns']['p_size']['distinct'] == 50
+    assert statistics['columns']['p_date']['max'] == \
+        date_to_ordinal('1998-09-01')
+
+    sql_tree = {'filters': [{'identifier': 'p_size', 'operator': '>',
+                             'value': '10'},
+                            {'identifier': 'p_date', 'operator': '<=',
+                             'value': "'1998-05-01'"},
+                            {'identifier': 'p_name', 'operator': '!=',
+                             'value': "'part, '"}]}
+    for tree in [None, sql_tree]:
+        for columns in [None, {'p_name', 'p_size'}, {'p_partkey'}]:
+            for batch_size in [7, 1000]:
+                positions, datatypes, batches = columnar_to_data_batches(
+                    layout, tree, columns, batch_size)
+                assert (positions, datatypes, concatenate_batches(batches)) \
+                    == file_to_data_structure(local_filename, tree,
+                                              'python', columns)
+
+    # blocks that can't pass the filters are skipped
+    layout = write_columnar_layout(local_filename, ['"d"', '"b"'],
+                                   block_size=10)
+    sql_tree['filters'].append({'identifier': 'p_partkey', 'operator': '<',
+                                'value': '100'})
+    clear_scan_statistics()
+    positions, datatypes, batches = columnar_to_data_batches(
+        layout, sql_tree, None, 7)
+    assert (positions, datatypes, concatenate_batches(batches)) == \
+        file_to_data_structure(local_filename, sql_tree, 'python')
+    assert scan_statistics['blocks_scanned'] == 8
+    assert scan_statistics['blocks_skipped'] == 92
+
+    # indexes find the rows holding each value, and are used for equality
+    # filters
+    for column_name in ['p_name', 'p_size', 'p_retailprice']:
+        assert write_column_index(layout, column_name)
+    assert not write_column_index(layout, 'p_comment')
+
+    positions, datatypes, file_data = file_to_data_structure(local_filename)
+    for position in [1, 2, 3]:
+        index = open_column_index(layout, position, [None, 'q', 'd'][
+            position - 1])
+        for value in set(file_data[position]) | {'part, ', -1, 'x'}:
+            assert index.get(value) == ([row for row, v in
+                                         enumerate(file_data[position])
+                                         if v == value and v is not None]
+                                        or None)
+        index.close()
+    assert open_column_index(layout, 0, 'q') is None
+
+    clear_scan_statistics()
+    for filters in [[{'identifier': 'p_size', 'operator': '=',
+                      'value': '12'}],
+                    [{'identifier': 'p_name', 'operator': '=',
+                      'value': "'part, \u0101'"},
+                     {'identifier': 'p_size', 'operator': '=',
+                      'value': '1'},
+                     {'identifier': 'p_date', 'operator': '>',
+                      'value': "'1998-02-01'"}]]:
+        for batch_size in [3, 1000]:
+            positions, datatypes, batches = columnar_to_data_batches(
+                layout, {'filters': filters}, None, batch_size)
+            assert (positions, datatypes, concatenate_batches(batches)) == \
+                file_to_data_structure(local_filename, {'filters': filters},
+                                       'python')
+    assert scan_statistics['index_lookups'] == 4
+
+    # semi-join filters drop the rows whose keys aren't in a Bloom filter,
+    # on columns with and without empty values, and tables filtered by
+    # them aren't joined with their indexes
+    for identifier in ['p_partkey', 'p_size', 'p_name']:
+        semi_join_keys = [file_data[positions[identifier]][row]
+                          for row in range(0, 1000, 3)]
+        semi_join_filters = []
+        for scan_engine in ['python', 'numpy']:
+            bloom_filter = BloomFilter(len(semi_join_keys))
+            bloom_filter.add(semi_join_keys)
+            semi_join_filters.append({'identifier': identifier,
+                                      'bloom_filter': bloom_filter})
+        positions, datatypes, batches = columnar_to_data_batches(
+            layout, {'filters': [],
+                     'semi_join_filters': semi_join_filters[:1]},
+            {'p_name'}, 100)
+        assert (positions, datatypes, concatenate_batches(batches)) == \
+            file_to_data_structure(local_filename,
+                                   {'filters': [],
+                                    'semi_join_filters':
+                                    semi_join_filters[1:]},
+                                   'python', {'p_name'})
+        assert semi_join_filters[0]['bloom_filter'].checked == 1000
+        assert semi_join_filters[0]['bloom_filter'].passed == \
+            semi_join_filters[1]['bloom_filter'].passed
+        assert semi_join_statistics(semi_join_filters[0]['bloom_filter'],
+                                    semi_join_keys) == \
+            semi_join_statistics(semi_join_filters[1]['bloom_filter'],
+                                 semi_join_keys)
+    assert layout_indexes(layout, {'semi_join_filters':
+                                   semi_join_filters}) == {}
+
+    # a new version of the file replaces the old layout
+    write_columnar_layout(local_filename, ['"c"', '"b"'])
+    assert os.listdir(columnar_directory(local_filename)) == ['c_b']
+
+    # layouts are removed along with their indexes, apart from those still
+    # being written
+    assert write_column_index(layout_directory(local_filename,
+                                               ['"c"', '"b"']), 'p_size')
+    assert columnar_bytes(local_filename) == sum(
+        os.path.getsize(os.path.join(d, f)) for d, directory_names,
+        filenames in os.walk(columnar_directory(local_filename))
+        for f in filenames)
+    temporary_directory = tempfile.mkdtemp(
+        dir=columnar_directory(local_filename), suffix='.tmp')
+    remove_columnar_layouts(local_filename)
+    assert os.listdir(columnar_directory(local_filename)) == \
+        [os.path.basename(temporary_directory)]
+    os.rmdir(temporary_directory)
+    remove_columnar_layouts(local_filename)
+    assert not os.path.exists(columnar_directory(local_filename))
+    assert columnar_bytes(local_filename) == 0
+
+    shutil.rmtree(directory)
+    print('columnar cache unit tests passed')
@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 
-import sqlparse
 from sqlparse.sql import IdentifierList
 from sqlparse.tokens import Whitespace, Newline, Punctuation
 
+from parse_utilities import parse_statement
+
 
 def extract_groupby_part(parsed):
     '''generator function that extracts "group by" part of a query,
@@ -20,7 +21,7 @@ def extract_groupby_part(parsed):
 
     for item in parsed.tokens:
         if item.value.upper() == 'ORDER' or item.value.upper() == 'HAVING':
-            raise StopIteration
+            return
         if group_by_seen is True and item.value.upper() != 'BY':
             yield item
         if item.value.upper() == 'GROUP':
@@ -69,11 +70,12 @@ def extract_groupby(sql):
     '''extracts group by column identifiers from a SQL statement.
             does not validate that the SQL is correct
 
-        keyword-args: a string containing a SQL statement
+        keyword-args: a string containing a SQL statement,
+            or a statement already parsed by parse_statement
 
         returns: a list of group by column identifiers
     '''
-    stream = extract_groupby_part(sqlparse.parse(sql)[0])
+    stream = extract_groupby_part(parse_statement(sql))
     return list(extract_groupby_identifiers(stream))
 
 
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
-import sqlparse
 from sqlparse.tokens import Whitespace, Newline, Punctuation
 
+from parse_utilities import parse_statement
+
 
 def extract_having_part(parsed):
     '''generator function that extracts "having" part of a query,
@@ -45,11 +46,12 @@ def extract_having(sql):
     '''extracts having aggregate identifiers from a SQL statement.
         does not validate that the SQL is correct
 
-        keyword-args: a string containing a SQL statement
+        keyword-args: a string containing a SQL statement,
+            or a statement already parsed by parse_statement
 
         returns: a list of having aggregate identifiers
     '''
-    stream = extract_having_part(sqlparse.parse(sql)[0])
+    stream = extract_having_part(parse_statement(sql))
     return list(extract_having_identifiers(stream))
 
 
@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 
-import sqlparse
 from sqlparse.sql import IdentifierList, Function
 from sqlparse.tokens import Whitespace, Newline, Punctuation
 
+from parse_utilities import parse_statement
+
 
 def extract_orderby_part(parsed):
     '''generator function that extracts "order by" part of a query,
@@ -20,7 +21,7 @@ def extract_orderby_part(parsed):
 
     for item in parsed.tokens:
         if item.value.upper() == 'HAVING':
-            raise StopIteration
+            return
         if order_by_seen is True:
             yield item
         if item.value.upper() == 'ORDER':
@@ -89,11 +90,12 @@ def extract_orderby(sql):
     '''extracts order by column identifiers from a SQL statement.
         does not validate that the SQL is correct
 
-        keyword-args: a string containing a SQL statement
+        keyword-args: a string containing a SQL statement,
+            or a statement already parsed by parse_statement
 
         returns: a list of order by column identifiers
     '''
-    stream = extract_orderby_part(sqlparse.parse(sql)[0])
+    stream = extract_orderby_part(parse_statement(sql))
     return list(extract_orderby_identifiers(stream))
 
 
@@ -1,10 +1,9 @@
 #!/usr/bin/env python
 
-import sqlparse
 from sqlparse.sql import IdentifierList, Token, Function
 from sqlparse.tokens import Keyword, DML, Whitespace, Newline
 
-from parse_utilities import is_subselect
+from parse_utilities import is_subselect, parse_statement
 
 
 def extract_select_part(parsed):
@@ -34,7 +33,7 @@ def extract_select_part(parsed):
                 for x in extract_select_part(item):
                     yield x
             elif item.ttype is Keyword:
-                raise StopIteration
+                return
             else:
                 yield None
 
@@ -110,12 +109,13 @@ def extract_select(sql):
     '''extracts selected columns from a SQL statement.  does not validate
         that the SQL is correct
 
-        keyword-args: a string containing a SQL statement
+        keyword-args: a string containing a SQL statement,
+            or a statement already parsed by parse_statement
 
         returns: a list of column identifiers
     '''
 
-    stream = extract_select_part(sqlparse.parse(sql)[0])
+    stream = extract_select_part(parse_statement(sql))
     return list(extract_selected_fields(stream))
 
 
@@ -123,12 +123,13 @@ def extract_select_aggregates(sql):
     '''extracts selected columns from a SQL statement.
             does not validate that the SQL is correct
 
-        keyword-args: a string containing a SQL statement
+        keyword-args: a string containing a SQL statement,
+            or a statement already parsed by parse_statement
 
         returns: a list of column identifiers
     '''
 
-    stream = extract_select_part(sqlparse.parse(sql)[0])
+    stream = extract_select_part(parse_statement(sql))
     return list(extract_selected_aggregates(stream))
 
 
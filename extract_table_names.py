@@ -1,9 +1,8 @@
 #!/usr/bin/env python
 
-import sqlparse
 from sqlparse.sql import IdentifierList, Identifier
 from sqlparse.tokens import Keyword
-from parse_utilities import is_subselect
+from parse_utilities import is_subselect, parse_statement
 
 
 def extract_from_part(parsed):
@@ -23,7 +22,7 @@ def extract_from_part(parsed):
                 for x in extract_from_part(item):
                     yield x
             elif item.ttype is Keyword:
-                raise StopIteration
+                return
             else:
                 yield item
         elif item.ttype is Keyword and item.value.upper() == 'FROM':
@@ -64,11 +63,12 @@ def extract_table_definitions(sql):
     '''extracts tables and their aliases from a SQL statement.
        does not validate that the SQL is correct
 
-        keyword-args: a string containing a SQL statement
+        keyword-args: a string containing a SQL statement,
+            or a statement already parsed by parse_statement
 
         returns: a list of table identifiers
     '''
-    stream = extract_from_part(sqlparse.parse(sql)[0])
+    stream = extract_from_part(parse_statement(sql))
     return list(extract_table_identifiers(stream))
 
 
@@ -4,6 +4,8 @@ import sqlparse
 from sqlparse.sql import Identifier, Comparison, Parenthesis
 from sqlparse.tokens import Keyword, Whitespace, Newline, Punctuation
 
+from parse_utilities import parse_statement
+
 
 def extract_where_part(parsed):
     '''generator function that extracts "where" part of a query,
@@ -125,11 +127,12 @@ def extract_filters(sql):
     '''extracts join columns from a SQL statement.
             does not validate that the SQL is correct
 
-        keyword-args: a string containing a SQL statement
+        keyword-args: a string containing a SQL statement,
+            or a statement already parsed by parse_statement
 
         returns: a list of join identifiers
     '''
-    stream = extract_where_part(sqlparse.parse(sql)[0])
+    stream = extract_where_part(parse_statement(sql))
     return list(extract_filter_identifiers(stream))
 
 
@@ -137,11 +140,12 @@ def extract_joins(sql):
     '''extracts join columns from a SQL statement.
             does not validate that the SQL is correct
 
-        keyword-args: a string containing a SQL statement
+        keyword-args: a string containing a SQL statement,
+            or a statement already parsed by parse_statement
 
         returns: a list of join identifiers
     '''
-    stream = extract_where_part(sqlparse.parse(sql)[0])
+    stream = extract_where_part(parse_statement(sql))
     return list(extract_join_identifiers(stream))
 
 
@@ -149,11 +153,12 @@ def extract_where_subqueries(sql):
     '''extracts join columns from a SQL statement.
                 does not validate that the SQL is correct
 
-        keyword-args: a string containing a SQL statement
+        keyword-args: a string containing a SQL statement,
+            or a statement already parsed by parse_statement
 
         returns: a list of join identifiers
     '''
-    stream = extract_where_part(sqlparse.parse(sql)[0])
+    stream = extract_where_part(parse_statement(sql))
     return list(extract_where_subquery_identifiers(stream))
 
 
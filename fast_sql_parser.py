@@ -0,0 +1,448 @@
+#!/usr/bin/python
+import re
+
+# one pattern for the whole tokenizer - each alternative is a named group,
+# so the name of the matching group is the kind of the token
+sql_token_pattern = re.compile(r'''
+    (?P<whitespace>\s+|--[^\n]*)
+    |(?P<string>'(?:[^']|'')*')
+    |(?P<number>\d+(?:\.\d*)?|\.\d+)
+    |(?P<name>[A-Za-z_][A-Za-z0-9_$#]*|"(?:[^"]|"")*")
+    |(?P<operator><=|>=|<>|!=|=|<|>)
+    |(?P<punctuation>[(),.;*])
+    |(?P<other>.)
+    ''', re.VERBOSE | re.DOTALL)
+
+# words that can't be used as an alias
+reserved_words = {'SELECT', 'FROM', 'WHERE', 'GROUP', 'BY', 'HAVING',
+                  'ORDER', 'AND', 'OR', 'NOT', 'AS', 'ASC', 'DESC', 'ON',
+                  'JOIN', 'LIKE', 'IN', 'IS', 'NULL', 'BETWEEN', 'DISTINCT',
+                  'UNION', 'LIMIT'}
+
+# operators to use when the value in a comparison is on the left
+reversed_operators = {'<': '>', '>': '<', '<=': '>=', '>=': '<='}
+
+
+def tokenize_sql(input_sql):
+    '''splits SQL text into tokens, dropping whitespace and comments
+
+    keyword args:
+        input_sql: SQL text input
+
+    returns:
+        list of tokens, each a tuple of:
+            kind - one of string, number, name, operator, punctuation, other
+            text - text of the token
+            upper_text - text of the token in upper case, for keywords
+            start - position in the SQL text where the token starts
+            end - position in the SQL text just after the token
+'''
+
+    tokens = []
+    for match in sql_token_pattern.finditer(input_sql):
+        kind = match.lastgroup
+        if kind != 'whitespace':
+            text = match.group()
+            tokens.append((kind, text, text.upper(),
+                           match.start(), match.end()))
+
+    return tokens
+
+
+class SQLSubsetParser:
+    '''recursive-descent parser for the subset of SQL that the virtual data
+        layer can execute: SELECT, FROM, WHERE, GROUP BY, HAVING and ORDER BY,
+        with comparisons joined by AND.
+
+        raises ValueError for anything outside of that subset
+'''
+
+    def __init__(self, input_sql):
+        self.input_sql = input_sql
+        self.tokens = tokenize_sql(input_sql)
+        # sentinel token, so that lookahead never runs off the end
+        self.tokens.append(('end', '', '', len(input_sql), len(input_sql)))
+        self.position = 0
+
+    def peek(self, offset=0):
+        return self.tokens[self.position + offset]
+
+    def advance(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def at_keyword(self, *keywords):
+        token = self.tokens[self.position]
+        return token[0] == 'name' and token[2] in keywords
+
+    def accept_keyword(self, keyword):
+        if self.at_keyword(keyword):
+            self.position += 1
+            return True
+        return False
+
+    def expect_keyword(self, keyword):
+        if not self.accept_keyword(keyword):
+            self.error('expected ' + keyword)
+
+    def accept_punctuation(self, punctuation):
+        token = self.tokens[self.position]
+        if token[0] == 'punctuation' and token[1] == punctuation:
+            self.position += 1
+            return True
+        return False
+
+    def expect_punctuation(self, punctuation):
+        if not self.accept_punctuation(punctuation):
+            self.error("expected '" + punctuation + "'")
+
+    def error(self, message):
+        token = self.tokens[self.position]
+        raise ValueError(message + " at '" + token[1] +
+                         "' (position " + str(token[3]) + ')')
+
+    def parse(self):
+        '''parses the SQL statement
+
+        returns:
+            sql tree, in the same format as sql_to_tree.build_sql_tree
+'''
+
+        sql_tree = {}
+        select_columns = []
+        select_aggregates = []
+        joins = []
+        filters = []
+        where_subqueries = []
+        grouping = []
+        ordering = []
+        having = []
+
+        self.expect_keyword('SELECT')
+        if self.at_keyword('DISTINCT'):
+            self.error('unsupported keyword')
+        self.parse_select_list(select_columns, select_aggregates)
+
+        self.expect_keyword('FROM')
+        table_definitions = self.parse_table_list()
+
+        if self.accept_keyword('WHERE'):
+            self.parse_where(joins, filters, where_subqueries)
+
+        if self.accept_keyword('GROUP'):
+            self.expect_keyword('BY')
+            grouping.append(self.parse_grouping_item())
+            while self.accept_punctuation(','):
+                grouping.append(self.parse_grouping_item())
+
+        if self.accept_keyword('HAVING'):
+            self.parse_having(having)
+
+        if self.accept_keyword('ORDER'):
+            self.expect_keyword('BY')
+            ordering.append(self.parse_ordering_item())
+            while self.accept_punctuation(','):
+                ordering.append(self.parse_ordering_item())
+
+        # like sqlparse, only the first statement is used
+        if not self.accept_punctuation(';') and self.peek()[0] != 'end':
+            self.error('unsupported syntax')
+
+        sql_tree['select'] = select_columns
+        sql_tree['select aggregate'] = select_aggregates
+        sql_tree['table_definitions'] = table_definitions
+        sql_tree['joins'] = joins
+        sql_tree['filters'] = filters
+        sql_tree['where_subqueries'] = where_subqueries
+        sql_tree['grouping'] = grouping
+        sql_tree['ordering'] = ordering
+        sql_tree['having'] = having
+
+        return sql_tree
+
+    def parse_name(self, qualified=False):
+        # reserved words are allowed after a '.', like tcph.order
+        token = self.advance()
+        if token[0] != 'name' or \
+                (token[2] in reserved_words and not qualified):
+            self.position -= 1
+            self.error('expected a name')
+        return token[1]
+
+    def parse_column_reference(self):
+        '''parses a possibly qualified column name, like c_name or c.c_name
+
+        returns:
+            tuple of column name, table or alias name, and the full text
+'''
+
+        start = self.peek()[3]
+        names = [self.parse_name()]
+        while self.accept_punctuation('.'):
+            names.append(self.parse_name(qualified=True))
+
+        table_or_alias_name = names[-2] if len(names) > 1 else None
+        text = self.input_sql[start:self.tokens[self.position - 1][4]]
+
+        return names[-1], table_or_alias_name, text
+
+    def at_function(self):
+        next_token = self.peek(1)
+        return self.peek()[0] == 'name' and next_token[0] == 'punctuation' \
+            and next_token[1] == '('
+
+    def parse_function(self):
+        '''parses an aggregate function over a single column or *
+
+        returns:
+            dictionary with the function, column and table or alias names
+'''
+
+        function_identifier = {}
+        function_identifier['function'] = self.parse_name()
+        self.expect_punctuation('(')
+
+        if self.accept_punctuation('*'):
+            function_identifier['column_name'] = None
+            function_identifier['table_or_alias_name'] = None
+        else:
+            column_name, table_or_alias_name, text = \
+                self.parse_column_reference()
+            function_identifier['column_name'] = column_name
+            function_identifier['table_or_alias_name'] = table_or_alias_name
+
+        self.expect_punctuation(')')
+
+        return function_identifier
+
+    def parse_alias(self):
+        if self.accept_keyword('AS'):
+            return self.parse_name()
+        token = self.peek()
+        if token[0] == 'name' and token[2] not in reserved_words:
+            self.position += 1
+            return token[1]
+        return None
+
+    def parse_select_list(self, select_columns, select_aggregates):
+        while True:
+            if self.at_function():
+                select_aggregates.append(self.parse_function())
+            else:
+                column_identifier = {}
+                column_name, table_or_alias_name, text = \
+                    self.parse_column_reference()
+                column_identifier['column_name'] = column_name
+                column_identifier['table_or_alias_name'] = table_or_alias_name
+                select_columns.append(column_identifier)
+            self.parse_alias()
+
+            if not self.accept_punctuation(','):
+                return
+
+    def parse_table_list(self):
+        table_definitions = []
+
+        while True:
+            table_definition = {}
+            name = self.parse_name()
+            if self.accept_punctuation('.'):
+                table_definition['schema'] = name
+                table_definition['name'] = self.parse_name(qualified=True)
+            else:
+                table_definition['schema'] = None
+                table_definition['name'] = name
+            table_definition['alias'] = self.parse_alias()
+            table_definitions.append(table_definition)
+
+            if not self.accept_punctuation(','):
+                return table_definitions
+
+    def parse_operand(self):
+        '''parses one side of a comparison
+
+        returns:
+            tuple of the kind of operand (identifier, value, subquery,
+            or function) and its text
+'''
+
+        token = self.peek()
+
+        if token[0] == 'string' or token[0] == 'number':
+            self.position += 1
+            return 'value', token[1].replace("''", '')
+
+        if token[0] == 'other' and token[1] == '-' \
+                and self.peek(1)[0] == 'number':
+            self.position += 2
+            return 'value', self.input_sql[token[3]:self.peek(-1)[4]]
+
+        if token[0] == 'punctuation' and token[1] == '(':
+            # keep subqueries as text, like the sqlparse extractors
+            depth = 0
+            while True:
+                token = self.advance()
+                if token[0] == 'end':
+                    self.error('unbalanced parentheses')
+                elif token[1] == '(' and token[0] == 'punctuation':
+                    depth += 1
+                elif token[1] == ')' and token[0] == 'punctuation':
+                    depth -= 1
+                    if depth == 0:
+                        return 'subquery', None
+
+        if self.at_function():
+            self.parse_function()
+            return 'function', None
+
+        column_name, table_or_alias_name, text = self.parse_column_reference()
+        return 'identifier', text.replace("''", '')
+
+    def parse_comparison(self):
+        '''parses a single comparison
+
+        returns:
+            tuple of left operand, operator, right operand and
+            the full text of the comparison
+'''
+
+        start = self.peek()[3]
+        left = self.parse_operand()
+
+        token = self.advance()
+        if token[0] != 'operator':
+            self.position -= 1
+            self.error('expected a comparison operator')
+
+        right = self.parse_operand()
+        text = self.input_sql[start:self.tokens[self.position - 1][4]]
+
+        return left, token[1], right, text
+
+    def parse_where(self, joins, filters, where_subqueries):
+        while True:
+            left, operator, right, text = self.parse_comparison()
+            left_kind, left_text = left
+            right_kind, right_text = right
+
+            if left_kind == 'identifier' and right_kind == 'identifier':
+                join_identifier = {}
+                join_identifier['left_identifier'] = left_text
+                join_identifier['right_identifier'] = right_text
+                join_identifier['join_type'] = ''
+                joins.append(join_identifier)
+
+            elif (left_kind == 'identifier' and right_kind == 'subquery') \
+                    or (left_kind == 'subquery' and
+                        right_kind == 'identifier'):
+                where_subqueries.append(text)
+
+            elif left_kind == 'identifier' and right_kind == 'value':
+                comparison_identifier = {}
+                comparison_identifier['identifier'] = left_text
+                comparison_identifier['value'] = right_text
+                comparison_identifier['operator'] = operator
+                filters.append(comparison_identifier)
+
+            elif left_kind == 'value' and right_kind == 'identifier':
+                # the value is assumed to be on the right,
+                # so reverse the operator
+                comparison_identifier = {}
+                comparison_identifier['value'] = left_text
+                comparison_identifier['identifier'] = right_text
+                comparison_identifier['operator'] = \
+                    reversed_operators.get(operator, operator)
+                filters.append(comparison_identifier)
+
+            else:
+                self.error('unsupported comparison')
+
+            if not self.accept_keyword('AND'):
+                return
+
+    def parse_grouping_item(self):
+        column_identifier = {}
+        column_name, table_or_alias_name, text = \
+            self.parse_column_reference()
+        column_identifier['column_name'] = column_name
+        column_identifier['table_or_alias_name'] = table_or_alias_name
+
+        return column_identifier
+
+    def parse_having(self, having):
+        while True:
+            left, operator, right, text = self.parse_comparison()
+            having.append(text)
+
+            if self.at_keyword('AND', 'OR'):
+                having.append(self.advance()[1])
+            else:
+                return
+
+    def parse_ordering_item(self):
+        if self.at_function():
+            column_identifier = self.parse_function()
+        else:
+            column_identifier = {}
+            column_name, table_or_alias_name, text = \
+                self.parse_column_reference()
+            column_identifier['column_name'] = column_name
+            column_identifier['table_or_alias_name'] = table_or_alias_name
+            column_identifier['function'] = None
+
+        # sql trees don't record the sort direction
+        if not self.accept_keyword('ASC'):
+            self.accept_keyword('DESC')
+
+        return column_identifier
+
+
+def parse_sql(input_sql):
+    '''Converts SQL to a SQL tree with the subset parser, without sqlparse.
+        Does not validate that input SQL is correct.
+
+        Unlike the sqlparse extractors, aggregates with an alias, like
+        sum(l_quantity) as sum_qty, are returned as aggregates
+
+    keyword args:
+        input_sql: SQL text input
+
+    returns:
+        sql tree, in the same format as sql_to_tree.build_sql_tree
+
+    raises:
+        ValueError if the SQL is outside of the supported subset
+'''
+
+    return SQLSubsetParser(input_sql).parse()
+
+
+if __name__ == '__main__':
+
+    input_sql = """
+        select
+            l_orderkey,
+            sum(l_extendedprice),
+            o_orderdate,
+            o_shippriority
+        from
+            tcph.customer,
+            tcph.orders,
+            tcph.lineitem
+        where
+            c_mktsegment = 'BUILDING'
+            and c_custkey = o_custkey
+            and l_orderkey = o_orderkey
+            and o_orderdate < '1997-12-31'
+            and l_shipdate > '1998-01-01'
+        group by
+            l_orderkey,
+            o_orderdate,
+            o_shippriority
+        order by
+            sum(l_extendedprice),
+            o_orderdate;"""
+
+    for k, v in parse_sql(input_sql).items():
+        print(k, v)
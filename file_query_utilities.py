@@ -1,8 +1,121 @@
 import csv
-from datetime import datetime
-
-
-def file_to_data_structure(local_filename, sql_tree=None):
+import json
+import operator
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+from array import array
+from datetime import datetime, date
+from bisect import bisect_left
+from itertools import islice, repeat
+from s3_range_download import block_lines
+from table_statistics import TableStatisticsCollector, is_sorted
+from bloom_filter import key_hashes, split_hashes, mix_hash
+from hash_aggregation import HashAggregation
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# engine used to read CSV data.  'numpy' reads it in chunks with numpy
+# and filters each chunk with vectorized comparisons, 'python' reads it
+# a row at a time.  numpy is used whenever it is installed
+if numpy is not None:
+    default_scan_engine = 'numpy'
+else:
+    default_scan_engine = 'python'
+
+# largest number of rows in each batch read by csv_to_data_batches.
+# the numpy engine reads this many lines at a time
+default_scan_batch_size = 65536
+
+# numpy counts days from 1970-01-01, while date ordinals count from 0001-01-01
+numpy_date_offset = date(1970, 1, 1).toordinal()
+
+# rows are converted to typed columns in batches of this many rows
+column_batch_size = 4096
+
+# number of rows in each block of a zone map
+zone_map_block_size = 8192
+
+# a file's zone maps are kept next to it, in a file named after it with
+# this suffix
+zone_map_suffix = '_zonemap'
+
+# a file's statistics are kept next to it and its _header file, in a file
+# named after it with this suffix
+statistics_suffix = '_statistics'
+
+# number of blocks of rows read and skipped by scans that use zone maps,
+# number of times an index was used for a filter or a join, and number of
+# joins that were partitioned on disk, used a direct-address lookup or
+# merged tables that were in join column order
+scan_statistics = {'blocks_scanned': 0, 'blocks_skipped': 0,
+                   'index_lookups': 0, 'index_joins': 0,
+                   'partitioned_joins': 0, 'direct_joins': 0,
+                   'merge_joins': 0}
+scan_statistics_lock = threading.Lock()
+
+# ordinals of the dates seen so far, as most date columns hold few
+# distinct values.  no more than date_ordinals_size dates are kept
+date_ordinals = {}
+date_ordinals_size = 100000
+
+# comparison for each filter operator
+filter_operators = {'=': operator.eq,
+                    '!=': operator.ne,
+                    '<>': operator.ne,
+                    '>': operator.gt,
+                    '>=': operator.ge,
+                    '<': operator.lt,
+                    '<=': operator.le}
+
+# estimated fraction of rows that pass a filter with each operator
+filter_selectivities = {'=': 0.1,
+                        '!=': 0.9,
+                        '<>': 0.9,
+                        '>': 1 / 3,
+                        '>=': 1 / 3,
+                        '<': 1 / 3,
+                        '<=': 1 / 3}
+
+# relative cost of checking a value of each datatype against a filter
+filter_costs = {'CHAR': 1, 'NUMBER': 2, 'DATE': 3}
+
+# joins of up to this many tables are ordered by comparing every order in
+# which the tables can be joined, one subset of the tables at a time.
+# larger joins are ordered greedily, keeping only the cheapest subset
+max_dp_join_tables = 10
+
+# a table filters the tables it joins, with a Bloom filter of its join keys,
+# if it is expected to keep less than this fraction of its rows
+semi_join_max_fraction = 0.8
+
+# joins whose hashtable is expected to take more than this many bytes are
+# partitioned on disk, and the partitions joined one at a time - 1 GB
+join_memory_budget = 1024 ** 3
+
+# estimated bytes taken in a join's hashtable by each row it is built from
+hashtable_row_bytes = 120
+
+# largest number of partitions a join is split into, as a file is open
+# for each partition while they are written
+max_join_partitions = 256
+
+# directory that partitioned joins write their partitions to, or None for
+# the system's temporary directory
+join_spill_directory = None
+
+# joins on integer keys look up the rows of each key in an array indexed by
+# the key, rather than in a hashtable, if the keys of the table the array
+# is built from span no more than this many values for each of its rows
+direct_join_range_factor = 4
+
+
+def file_to_data_structure(local_filename, sql_tree=None,
+                           scan_engine=None, columns=None):
     '''converts a local file to a data structure, applying filters along the way
 
     keyword_args:
@@ -13,31 +126,558 @@ def file_to_data_structure(local_filename, sql_tree=None):
             assumes that this file is comma delimited
 
         sql_tree (optional): the SQL tree associated with this file,
-                        used to apply filters
+                        used to apply filters.  if the file has zone maps,
+                        written by write_zone_maps, blocks of rows that
+                        can't pass the filters are skipped.  if it has
+                        'semi_join_filters', a list of join columns of
+                        this file, each with a BloomFilter of the keys of
+                        the table it joins in 'bloom_filter', rows whose
+                        keys aren't in every filter are dropped as well
+
+        scan_engine (optional): 'numpy' or 'python', the engine used to
+                        read the file.  defaults to default_scan_engine
+
+        columns (optional): names of the columns to keep, as returned by
+                        sql_tree_columns.  other columns are skipped while
+                        reading.  all columns are kept if not given
 
     returns:
         column positions: a dictionary with a mapping between column names
                         and column_positions
         column headers: a dictionary with a mapping between column column_names
                         and column datatypes
-        file_data: a list of rows from the local file, with each row
-                        represented as a list
+        file_data: a list of the columns of the local file, in file order.
+                        INTEGER columns are held as array('q'), NUMERIC
+                        columns as array('d'), DATE columns as array('q')
+                        of date ordinals and all other columns as lists of
+                        strings.  a numeric or date column with empty
+                        values is held as a list, with None for each
+                        empty value.  columns that weren't kept are None
+'''
+
+    column_positions, column_datatypes, batches = \
+        file_to_data_batches(local_filename, sql_tree, scan_engine, columns)
+
+    return column_positions, column_datatypes, concatenate_batches(batches)
+
+
+def csv_to_data_structure(data_lines, header_lines, sql_tree=None,
+                          scan_engine=None, columns=None):
+    '''converts CSV text to a data structure, applying filters along the way.
+        the CSV text is read a line at a time, so it can be streamed
+
+    keyword_args:
+        data_lines: iterable of the lines of CSV data
+            assumes that the first line is a header with column names
+            assumes that the data is comma delimited
+        header_lines: iterable of the lines of the matching _header file,
+            which holds the datatype of each column
+
+        sql_tree (optional): the SQL tree associated with this data,
+                        used to apply filters
+
+        scan_engine (optional): 'numpy' or 'python', the engine used to
+                        read the data.  defaults to default_scan_engine.
+                        the python engine is used if numpy isn't installed
+
+        columns (optional): names of the columns to keep, as used by
+                        file_to_data_structure
+
+    returns:
+        the same as file_to_data_structure
+'''
+
+    column_positions, column_datatypes, batches = \
+        csv_to_data_batches(data_lines, header_lines, sql_tree, scan_engine,
+                            columns)
+
+    return column_positions, column_datatypes, concatenate_batches(batches)
+
+
+def file_to_data_batches(local_filename, sql_tree=None, scan_engine=None,
+                         columns=None, batch_size=default_scan_batch_size):
+    '''reads a local file a batch of rows at a time, applying filters along
+        the way, so that only one batch is held in memory at once.  the file
+        is closed once every batch has been read
+
+    keyword_args:
+        local_filename: name of the local CSV file, as used by
+                        file_to_data_structure
+        sql_tree (optional): the SQL tree associated with this file,
+                        used to apply filters
+        scan_engine (optional): the engine used to read the file, as used
+                        by file_to_data_structure
+        columns (optional): names of the columns to keep, as used by
+                        file_to_data_structure
+        batch_size (optional): largest number of rows in each batch
+
+    returns:
+        column positions: the same as file_to_data_structure
+        column headers: the same as file_to_data_structure
+        batches: generator of batches of the rows that pass the filters.
+                        each batch is a list of columns, in the same form
+                        as the file_data returned by file_to_data_structure
+'''
+
+    header_filename = local_filename + '_header'
+
+    # blocks of rows that can't pass the filters are skipped, if the file
+    # has zone maps
+    zone_maps = None
+    if sql_tree is not None and len(sql_tree.get('filters', [])) > 0:
+        zone_maps = read_zone_maps(local_filename)
+
+    # the file's statistics, if it has them, are used to order its filters
+    table_statistics = None
+    if sql_tree is not None and len(sql_tree.get('filters', [])) > 1:
+        table_statistics = read_table_statistics(local_filename)
+
+    if zone_maps is not None:
+        scanned_blocks = blocks_to_scan(zone_maps, sql_tree['filters'])
+        lfile = open(local_filename, 'rb')
+        data_lines = zone_map_lines(lfile, zone_maps['blocks'],
+                                    scanned_blocks)
+    else:
+        lfile = open(local_filename, newline='')
+        data_lines = lfile
+
+    try:
+        with open(header_filename, newline='') as lfile_header:
+            column_positions, column_datatypes, batches = \
+                csv_to_data_batches(data_lines, lfile_header, sql_tree,
+                                    scan_engine, columns, batch_size,
+                                    table_statistics)
+    except BaseException:
+        lfile.close()
+        raise
+
+    return column_positions, column_datatypes, \
+        close_after_batches(batches, lfile)
+
+
+def close_after_batches(batches, lfile):
+    '''generator function that yields every batch of a file, then closes it
+'''
+    try:
+        yield from batches
+    finally:
+        lfile.close()
+
+
+def write_zone_maps(local_filename, block_size=zone_map_block_size,
+                    scan_engine=None, etag=None, statistics=False):
+    '''writes the zone maps of a local file to a file alongside it, named
+        after the file with zone_map_suffix.  the rows of the file are
+        split into blocks, and the smallest and largest value of each
+        NUMBER and DATE column in each block is kept, so that scans can
+        skip blocks that can't pass their filters.  the zone maps are only
+        used while the file's size and modification time are unchanged
+
+    keyword_args:
+        local_filename - name of the local CSV file, as used by
+                         file_to_data_structure
+        block_size - number of rows in each block (optional)
+        scan_engine - engine used to read each block, as used by
+                      file_to_data_structure (optional)
+        etag - ETag of the S3 object the file was downloaded from, kept
+               with the zone maps as it is with the file's statistics
+               (optional)
+        statistics - if True, the statistics of the file are collected
+                     from the same blocks, and written as
+                     write_table_statistics writes them (optional)
+
+    returns:
+        the zone maps, as returned by read_zone_maps
+'''
+    with open(local_filename + '_header', newline='') as lfile_header:
+        header_lines = lfile_header.readlines()
+    zone_map_datatypes = {k: v for k, v in
+                          header_datatypes(header_lines).items()
+                          if v in ['NUMBER', 'DATE']}
+
+    blocks = []
+    with open(local_filename, 'rb') as lfile:
+        file_status = os.fstat(lfile.fileno())
+        column_names_line = lfile.readline().decode('utf-8')
+        column_names = next(csv.reader([column_names_line], delimiter=',',
+                                       quotechar='"'))
+        collector = TableStatisticsCollector(column_names)
+
+        # offsets are in bytes, so that a scan can seek to each block
+        block_start = lfile.tell()
+        while True:
+            lines = list(islice(lfile, block_size))
+            if len(lines) == 0:
+                break
+
+            batch = next(csv_to_data_batches(
+                [column_names_line] + [line.decode('utf-8')
+                                       for line in lines],
+                header_lines, scan_engine=scan_engine,
+                batch_size=block_size)[2])
+            if statistics:
+                collector.add_batch(batch)
+
+            block_end = block_start + sum(map(len, lines))
+            blocks.append({'start': block_start, 'end': block_end,
+                           'zones': block_zones(
+                               [column if v in zone_map_datatypes else None
+                                for column, v in zip(batch, column_names)],
+                               column_names)})
+            block_start = block_end
+
+    zone_maps = {'size': file_status.st_size,
+                 'modified': file_status.st_mtime_ns,
+                 'etag': etag,
+                 'datatypes': zone_map_datatypes,
+                 'blocks': blocks}
+    save_zone_maps(local_filename, zone_maps)
+
+    if statistics:
+        save_table_statistics(local_filename,
+                              {'size': file_status.st_size,
+                               'modified': file_status.st_mtime_ns,
+                               'etag': etag,
+                               **collector.statistics()})
+
+    return zone_maps
+
+
+def save_zone_maps(local_filename, zone_maps):
+    '''writes the zone maps of a local file next to it, through a temporary
+        file, as save_table_statistics writes statistics
+'''
+    zone_map_filename = local_filename + zone_map_suffix
+    with open(zone_map_filename + '.tmp', 'w') as zone_map_file:
+        json.dump(zone_maps, zone_map_file)
+    os.replace(zone_map_filename + '.tmp', zone_map_filename)
+
+
+def read_zone_maps(local_filename, etag=None):
+    '''reads the zone maps of a local file, as written by write_zone_maps
+
+    keyword_args:
+        local_filename - name of the local CSV file
+        etag - ETag of the S3 object the file is downloaded from.  if
+               given, the zone maps are those of that object, as with
+               read_table_statistics (optional)
+
+    returns:
+        the zone maps, or None if the file has none or has changed since
+        they were written.  the zone maps are a dictionary holding:
+            datatypes - dictionary of the simplified datatype of each
+                        column with zones
+            blocks - list of the blocks of the file, each a dictionary
+                     of its start and end, and its zones: a dictionary of
+                     the smallest and largest value of each column in the
+                     block, or None if the block only has empty values
+'''
+    try:
+        with open(local_filename + zone_map_suffix) as zone_map_file:
+            zone_maps = json.load(zone_map_file)
+        if etag is not None:
+            if zone_maps.get('etag') != etag:
+                return None
+            return zone_maps
+        file_status = os.stat(local_filename)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if zone_maps['size'] != file_status.st_size or \
+            zone_maps['modified'] != file_status.st_mtime_ns:
+        return None
+
+    return zone_maps
+
+
+def write_table_statistics(local_filename, scan_engine=None, etag=None):
+    '''collects the statistics of a local file, as TableStatisticsCollector
+        does, and writes them to a file next to it and its _header file,
+        named after the file with statistics_suffix.  like zone maps, the
+        statistics are only used while the file's size and modification
+        time are unchanged
+
+    keyword_args:
+        local_filename - name of the local CSV file, as used by
+                         file_to_data_structure
+        scan_engine - engine used to read the file, as used by
+                      file_to_data_structure (optional)
+        etag - ETag of the S3 object the file was downloaded from, kept
+               with the statistics so that later downloads of the same
+               object can use them, as refresh_table_statistics does
+               (optional)
+
+    returns:
+        the statistics, as returned by read_table_statistics
+'''
+    file_status = os.stat(local_filename)
+    column_positions, column_datatypes, batches = \
+        file_to_data_batches(local_filename, scan_engine=scan_engine)
+
+    collector = TableStatisticsCollector(
+        sorted(column_positions, key=column_positions.get))
+    for batch in batches:
+        collector.add_batch(batch)
+
+    table_statistics = {'size': file_status.st_size,
+                        'modified': file_status.st_mtime_ns,
+                        'etag': etag,
+                        **collector.statistics()}
+    save_table_statistics(local_filename, table_statistics)
+
+    return table_statistics
+
+
+def save_table_statistics(local_filename, table_statistics):
+    '''writes the statistics of a local file next to it.  they are written
+        to a temporary file first, so partly written statistics are never
+        read
+'''
+    statistics_filename = local_filename + statistics_suffix
+    with open(statistics_filename + '.tmp', 'w') as statistics_file:
+        json.dump(table_statistics, statistics_file)
+    os.replace(statistics_filename + '.tmp', statistics_filename)
+
+
+def refresh_table_statistics(local_filename, etag, scan_engine=None):
+    '''makes sure a file that has just been downloaded from S3 has
+        statistics and zone maps.  those written for an earlier download of
+        the same object, as told by its ETag, are kept for the new download,
+        so they are only collected again when the object changes, both in
+        the same pass over the file, by write_zone_maps
+
+    keyword_args:
+        local_filename - name of the local CSV file
+        etag - ETag of the S3 object the file was downloaded from
+        scan_engine - engine used to read the file, if its statistics and
+                      zone maps are collected (optional)
+
+    returns:
+        the statistics, as returned by read_table_statistics
+'''
+    table_statistics = read_table_statistics(local_filename, etag)
+    zone_maps = read_zone_maps(local_filename, etag)
+    file_status = os.stat(local_filename)
+    if table_statistics is None or zone_maps is None or \
+            table_statistics['size'] != file_status.st_size or \
+            zone_maps['size'] != file_status.st_size:
+        write_zone_maps(local_filename, scan_engine=scan_engine, etag=etag,
+                        statistics=True)
+        return read_table_statistics(local_filename, etag)
+
+    if table_statistics['modified'] != file_status.st_mtime_ns:
+        table_statistics['modified'] = file_status.st_mtime_ns
+        save_table_statistics(local_filename, table_statistics)
+    if zone_maps['modified'] != file_status.st_mtime_ns:
+        zone_maps['modified'] = file_status.st_mtime_ns
+        save_zone_maps(local_filename, zone_maps)
+
+    return table_statistics
+
+
+def read_table_statistics(local_filename, etag=None):
+    '''reads the statistics of a local file, as written by
+        write_table_statistics
+
+    keyword_args:
+        local_filename - name of the local CSV file
+        etag - ETag of the S3 object the file is downloaded from.  if
+               given, the statistics are those of that object, whether or
+               not the file has been downloaded again since they were
+               written (optional)
+
+    returns:
+        the statistics, as returned by TableStatisticsCollector.statistics,
+        or None if the file has none or has changed since they were written
+'''
+    try:
+        with open(local_filename + statistics_suffix) as statistics_file:
+            table_statistics = json.load(statistics_file)
+        if etag is not None:
+            if table_statistics.get('etag') != etag:
+                return None
+            return table_statistics
+        file_status = os.stat(local_filename)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if table_statistics['size'] != file_status.st_size or \
+            table_statistics['modified'] != file_status.st_mtime_ns:
+        return None
+
+    return table_statistics
+
+
+def block_zones(columns, column_names):
+    '''finds the smallest and largest value of each typed column of a block
+        of rows, for its zone map
+
+    keyword_args:
+        columns - list of typed columns, as held by file_to_data_structure.
+                  columns that don't need zones are None
+        column_names - names of the columns, in the same order
+
+    returns:
+        dictionary of a [smallest, largest] list for each column, or None
+        for a column that only has empty values
+'''
+    zones = {}
+    for column_name, column in zip(column_names, columns):
+        if column is None:
+            continue
+        if not isinstance(column, array):
+            column = [v for v in column if v is not None]
+
+        if len(column) == 0:
+            zones[column_name] = None
+        else:
+            zones[column_name] = [min(column), max(column)]
+
+    return zones
+
+
+def blocks_to_scan(zone_maps, filters):
+    '''finds the blocks of a zone map that may hold rows passing every
+        filter, and counts the blocks that are skipped in scan_statistics
+
+    keyword_args:
+        zone_maps - zone maps, as returned by read_zone_maps
+        filters - the 'filters' part of a sql tree
+
+    returns:
+        list with True for each block that needs to be scanned, and False
+        for each block that can be skipped
+'''
+    scanned_blocks = [True] * len(zone_maps['blocks'])
+
+    for filter in filters:
+        filter_datatype = zone_maps['datatypes'].get(filter['identifier'])
+        if filter_datatype is None or \
+                filter['operator'] not in filter_operators:
+            continue
+
+        filter_element = filter['value'].replace("'", '')
+        if filter_datatype == 'NUMBER':
+            filter_element = float(filter_element)
+        else:
+            filter_element = date_to_ordinal(filter_element)
+
+        for i, block in enumerate(zone_maps['blocks']):
+            zone = block['zones'][filter['identifier']]
+            if scanned_blocks[i] and (
+                    zone is None or
+                    not zone_may_pass(zone, filter['operator'],
+                                      filter_element)):
+                scanned_blocks[i] = False
+
+    with scan_statistics_lock:
+        scan_statistics['blocks_scanned'] += sum(scanned_blocks)
+        scan_statistics['blocks_skipped'] += \
+            len(scanned_blocks) - sum(scanned_blocks)
+
+    return scanned_blocks
+
+
+def zone_may_pass(zone, filter_operator, filter_element):
+    '''checks whether any value between the smallest and largest value of a
+        zone could pass a filter
+
+    keyword_args:
+        zone - list of the smallest and largest value of a column in a block
+        filter_operator - comparison operator of the filter, such as '<='
+        filter_element - value the column is compared to, converted to the
+                         type of the column
+'''
+    smallest, largest = zone
+
+    if filter_operator == '=':
+        return smallest <= filter_element <= largest
+    elif filter_operator in ['!=', '<>']:
+        return not smallest == largest == filter_element
+    elif filter_operator in ['>', '>=']:
+        return filter_operators[filter_operator](largest, filter_element)
+
+    return filter_operators[filter_operator](smallest, filter_element)
+
+
+def zone_map_lines(lfile, blocks, scanned_blocks):
+    '''generator function that reads the column names and the blocks of a
+        file that need to be scanned, skipping the others
+
+    keyword_args:
+        lfile - the file, opened in binary mode
+        blocks - the blocks of the file, as in its zone maps
+        scanned_blocks - list of whether each block needs to be scanned,
+                         as returned by blocks_to_scan
+
+    returns:
+        each line, as used by csv_to_data_batches
+'''
+    yield lfile.readline().decode('utf-8')
+
+    for block, scanned in zip(blocks, scanned_blocks):
+        if scanned:
+            lfile.seek(block['start'])
+            yield from block_lines([lfile.read(block['end'] -
+                                               block['start'])])
+
+
+def clear_scan_statistics():
+    '''resets the counts of blocks scanned and skipped'''
+
+    with scan_statistics_lock:
+        for k in scan_statistics:
+            scan_statistics[k] = 0
+
+
+def csv_to_data_batches(data_lines, header_lines, sql_tree=None,
+                        scan_engine=None, columns=None,
+                        batch_size=default_scan_batch_size,
+                        table_statistics=None):
+    '''reads CSV text a batch of rows at a time, applying filters along the
+        way.  the header lines are read straight away, and the data lines
+        as the batches are read
+
+    keyword_args:
+        data_lines: iterable of the lines of CSV data, as used by
+                        csv_to_data_structure
+        header_lines: iterable of the lines of the matching _header file
+        sql_tree (optional): the SQL tree associated with this data,
+                        used to apply filters
+        scan_engine (optional): the engine used to read the data, as used
+                        by csv_to_data_structure
+        columns (optional): names of the columns to keep, as used by
+                        file_to_data_structure
+        batch_size (optional): largest number of rows in each batch
+        table_statistics (optional): statistics of the data, as returned by
+                        read_table_statistics, used to order the filters
+
+    returns:
+        the same as file_to_data_batches.  at least one batch is
+        generated, even if no rows pass the filters
 '''
 
     file_data = []
     column_positions = {}
     column_datatypes = {}
+    column_storages = {}
+    column_converters = []
     data_filter_sql_tree = []
-    data_filter_this_file = {}
-    header_filename = local_filename + '_header'
+    semi_join_filters = []
 
     if sql_tree is not None and 'filters' in sql_tree:
         data_filter_sql_tree = sql_tree['filters']
+    if sql_tree is not None and 'semi_join_filters' in sql_tree:
+        semi_join_filters = sql_tree['semi_join_filters']
+
+    if scan_engine is None:
+        scan_engine = default_scan_engine
 
-    lfile_reader = csv.reader(open(local_filename, newline=''),
-                              delimiter=',', quotechar='"')
+    # the numpy engine reads the lines after the column names itself
+    data_lines = iter(data_lines)
+    lfile_reader = csv.reader(data_lines, delimiter=',', quotechar='"')
 
-    lfile_header_reader = csv.reader(open(header_filename, newline=''),
+    lfile_header_reader = csv.reader(header_lines,
                                      delimiter=',', quotechar='"')
 
     column_names = lfile_reader.__next__()
@@ -51,89 +691,868 @@ def file_to_data_structure(local_filename, sql_tree=None):
         column_definition = v.split(' ')
         column_name = column_definition[0]
         column_datatype = column_definition[1]
-        if column_datatype.upper() == 'DATE':
-            column_datatypes[column_name] = 'DATE'
+        column_datatypes[column_name] = simplified_datatype(column_datatype)
+        column_storages[column_name] = column_storage(column_datatype)
+
+    # keep at least one column, so that the number of rows is known
+    if columns is not None and columns.isdisjoint(column_names):
+        columns = {column_names[0]}
+
+    # create an empty typed column for each column that is kept
+    for i, v in enumerate(column_names):
+        if columns is not None and v not in columns:
+            file_data.append(None)
+            column_converters.append(None)
+            continue
+
+        typecode, converter = column_storages.get(v, (None, None))
+        if typecode is None:
+            file_data.append([])
+        else:
+            file_data.append(array(typecode))
+        column_converters.append(converter)
+
+    row_filters = compile_filters(data_filter_sql_tree, column_positions,
+                                  column_datatypes, table_statistics,
+                                  semi_join_filters)
+
+    def new_batch():
+        return [None if column is None else new_column_like(column)
+                for column in file_data]
+
+    def read_batches():
+        batch_count = 0
+
+        if scan_engine == 'numpy' and numpy is not None:
+            numpy_dtype = numpy.dtype(
+                [('c' + str(i), numpy_column_dtype(v, column_converters[i]))
+                 for i, v in enumerate(file_data) if v is not None])
+            chunk_filters = compile_chunk_filters(
+                data_filter_sql_tree, column_positions, column_datatypes,
+                semi_join_filters)
+
+            while True:
+                chunk_lines = list(islice(data_lines, batch_size))
+                if len(chunk_lines) == 0:
+                    break
+
+                batch = new_batch()
+                if not append_chunk_to_columns(batch, chunk_lines,
+                                               numpy_dtype, chunk_filters):
+                    # numpy couldn't read this chunk exactly as the python
+                    # engine would, so the python engine reads it instead
+                    append_rows_to_columns(
+                        batch,
+                        filter_rows(csv.reader(chunk_lines, delimiter=',',
+                                               quotechar='"'), row_filters),
+                        column_converters)
+
+                if batch_length(batch) > 0:
+                    batch_count += 1
+                    yield batch
+
+        else:
+            rows = filter_rows(lfile_reader, row_filters)
+            while True:
+                batch = new_batch()
+                append_rows_to_columns(batch, islice(rows, batch_size),
+                                       column_converters)
+                if batch_length(batch) == 0:
+                    break
+
+                batch_count += 1
+                yield batch
+
+        if batch_count == 0:
+            yield new_batch()
+
+    return column_positions, column_datatypes, read_batches()
+
+
+def batch_length(batch):
+    '''returns the number of rows in a batch, or in the file_data returned
+        by file_to_data_structure
+'''
+    for column in batch:
+        if column is not None:
+            return len(column)
+
+    return 0
+
+
+def concatenate_batches(batches):
+    '''joins batches of rows, as generated by csv_to_data_batches, into a
+        single list of columns
+
+    keyword_args:
+        batches - iterable of batches, holding at least one batch
+
+    returns:
+        a list of columns, in the same form as each batch
+'''
+    batches = iter(batches)
+    file_data = next(batches)
+
+    for batch in batches:
+        for position, column in enumerate(batch):
+            if column is None:
+                continue
+
+            # a typed column becomes a list if the batch has empty values
+            if isinstance(file_data[position], array) and \
+                    not isinstance(column, array):
+                file_data[position] = file_data[position].tolist()
+
+            file_data[position].extend(column)
+
+    return file_data
+
+
+def aggregate_batches(batches, grouping_positions, aggregate_functions):
+    '''groups the rows of a table and aggregates each group, a batch of rows
+        at a time, with a HashAggregation.  only the running totals of each
+        group are held, so the batches can be read as a stream.  empty
+        values are ignored
+
+    keyword_args:
+        batches - iterable of batches, as generated by csv_to_data_batches
+        grouping_positions - positions of the group by columns in each batch
+        aggregate_functions - list of (function, position) tuples, such as
+                              ('sum', 4).  position is None for count(*)
+
+    returns:
+        groups - list of the distinct group by values, as tuples, in the
+                 order they first appear
+        aggregates - a list of values for each aggregate function, in the
+                     same order as groups
+'''
+    aggregation = HashAggregation(grouping_positions, aggregate_functions)
+    for batch in batches:
+        aggregation.add_batch(batch)
+
+    return aggregation.results()
+
+
+def compile_filter(filter_position, filter_datatype, filter_operator,
+                   filter_value):
+    '''builds a function that checks a row of a CSV file against a filter.
+        the filter value is converted once, so each row only has its own
+        value converted
+
+    keyword_args:
+        filter_position - position of the filter column in each row
+        filter_datatype - simplified datatype of the filter column
+        filter_operator - comparison operator of the filter, such as '<='
+        filter_value - value the column is compared to, as in the sql tree
+
+    returns:
+        function that takes a row, as a list of strings, and returns True
+        if the row passes the filter.  empty numbers and dates never pass.
+        CHAR values are compared as strings, so an empty value passes
+        filters such as != 'x' or < 'x'
+'''
+    compare = filter_operators[filter_operator]
+    filter_element = filter_value.replace("'", '')
+
+    if filter_datatype == 'NUMBER':
+        convert = float
+    elif filter_datatype == 'DATE':
+        convert = date_to_ordinal
+    else:
+        return lambda row: compare(row[filter_position], filter_element)
+
+    filter_element = convert(filter_element)
+
+    def row_filter(row):
+        data_element = row[filter_position]
+        return data_element != '' and \
+            compare(convert(data_element), filter_element)
+
+    return row_filter
+
 
-        elif column_datatype.upper() == 'INTEGER':
-            column_datatypes[column_name] = 'NUMBER'
+def compile_filters(filters, column_positions, column_datatypes,
+                    table_statistics=None, semi_join_filters=None):
+    '''compiles the filters of a sql tree that apply to a file.  all the
+        filters must pass for a row to be kept, so they are ordered to
+        reject rows as cheaply as possible: filters that are cheap to
+        check and let few rows through come first.  semi-join filters are
+        checked last, on the rows that pass every other filter
 
-        elif column_datatype.upper() == 'NUMERIC':
-            column_datatypes[column_name] = 'NUMBER'
+    keyword_args:
+        filters - the 'filters' part of a sql tree
+        column_positions - dictionary of column names and their positions
+        column_datatypes - dictionary of column names and their
+                           simplified datatypes
+        table_statistics - statistics of the file, as used by rank_filters
+                           (optional)
+        semi_join_filters - the 'semi_join_filters' part of a table's sql
+                            tree, as added by execute_sqltree_on_s3
+                            (optional)
+
+    returns:
+        list of functions, as built by compile_filter and
+        compile_semi_join_filter, in the order they should be applied
+'''
+    ranked_filters = rank_filters(filters, column_positions,
+                                  column_datatypes, table_statistics)
+    if ranked_filters is None:
+        return [lambda row: False]
+
+    return [compile_filter(column_positions[filter['identifier']],
+                           column_datatypes.get(filter['identifier']),
+                           filter['operator'], filter['value'])
+            for filter in ranked_filters] + \
+        [compile_semi_join_filter(column_positions[filter['identifier']],
+                                  column_datatypes.get(filter['identifier']),
+                                  filter['bloom_filter'])
+         for filter in semi_join_filters or []
+         if filter['identifier'] in column_positions]
+
+
+def rank_filters(filters, column_positions, column_datatypes,
+                 table_statistics=None):
+    '''orders the filters of a sql tree that apply to a file, so that
+        filters that are cheap to check and let few rows through come first.
+        the fraction of rows that pass each filter is estimated from the
+        file's statistics, or guessed from its operator without them
+
+    keyword_args:
+        filters - the 'filters' part of a sql tree
+        column_positions - dictionary of column names and their positions
+        column_datatypes - dictionary of column names and their
+                           simplified datatypes
+        table_statistics - statistics of the file, as returned by
+                           read_table_statistics (optional)
+
+    returns:
+        list of the filters on columns of the file, in the order they
+        should be applied, or None if a filter has an unsupported operator
+'''
+    ranked_filters = []
+
+    # check to see if filter column is in file
+    for i, filter in enumerate(filters):
+        filter_identifier = filter['identifier']
+        if filter_identifier not in column_positions:
+            continue
+
+        if filter['operator'] not in filter_operators:
+            print('SQL Error: unsupported filter operator ' +
+                  filter['operator'])
+            return None
+
+        filter_datatype = column_datatypes.get(filter_identifier)
+        if table_statistics is not None and \
+                filter_identifier in table_statistics['columns']:
+            selectivity = estimate_filter_selectivity(
+                table_statistics['columns'][filter_identifier],
+                table_statistics['row_count'], filter_datatype,
+                filter['operator'], filter['value'])
+        else:
+            selectivity = filter_selectivities[filter['operator']]
+        # a filter that keeps every row is checked last
+        rank = filter_costs.get(filter_datatype, 1) / \
+            max(1 - selectivity, 1e-9)
+
+        ranked_filters.append((rank, i, filter))
+
+    ranked_filters.sort(key=lambda ranked_filter: ranked_filter[:2])
+
+    return [filter for rank, i, filter in ranked_filters]
+
+
+def estimate_filter_selectivity(column_statistics, row_count,
+                                filter_datatype, filter_operator,
+                                filter_value):
+    '''estimates the fraction of rows of a file that pass a filter, from
+        the statistics of the filter column.  equality filters are expected
+        to keep the rows of one distinct value, and range filters the
+        fraction of the column's histogram below or above the filter value.
+        empty values, which the statistics count as nulls, are expected not
+        to pass
+
+    keyword_args:
+        column_statistics - statistics of the filter column, as in the
+                            'columns' of read_table_statistics
+        row_count - number of rows in the file
+        filter_datatype - simplified datatype of the filter column
+        filter_operator - comparison operator of the filter, such as '<='
+        filter_value - value the column is compared to, as in the sql tree
+
+    returns:
+        the estimated fraction of rows that pass the filter, from 0 to 1
+'''
+    histogram = column_statistics['histogram']
+    if row_count == 0 or len(histogram) == 0:
+        return 0.0
+
+    filter_element = filter_value.replace("'", '')
+    if filter_datatype == 'NUMBER':
+        filter_element = float(filter_element)
+    elif filter_datatype == 'DATE':
+        filter_element = date_to_ordinal(filter_element)
+
+    value_fraction = 1 - column_statistics['nulls'] / row_count
+    equal_fraction = 1 / max(column_statistics['distinct'], 1)
+    if filter_element < column_statistics['min'] or \
+            filter_element > column_statistics['max']:
+        equal_fraction = 0.0
+
+    if filter_operator == '=':
+        return value_fraction * equal_fraction
+    if filter_operator in ['!=', '<>']:
+        return value_fraction * (1 - equal_fraction)
+
+    # fraction of the values below the filter value: the whole buckets
+    # below it, and part of the bucket it falls in
+    bucket_count = len(histogram) - 1
+    bucket = bisect_left(histogram, filter_element)
+    if bucket == 0:
+        less_fraction = 0.0
+    elif bucket > bucket_count:
+        less_fraction = 1.0
+    else:
+        lower_bound = histogram[bucket - 1]
+        upper_bound = histogram[bucket]
+        bucket_fraction = 0.5
+        if filter_datatype in ['NUMBER', 'DATE']:
+            bucket_fraction = (filter_element - lower_bound) / \
+                (upper_bound - lower_bound)
+        less_fraction = min((bucket - 1 + bucket_fraction) / bucket_count,
+                            1.0)
+
+    if filter_operator == '<':
+        selectivity = less_fraction
+    elif filter_operator == '<=':
+        selectivity = less_fraction + equal_fraction
+    elif filter_operator == '>':
+        selectivity = 1 - less_fraction - equal_fraction
+    else:
+        selectivity = 1 - less_fraction
+
+    return value_fraction * min(max(selectivity, 0.0), 1.0)
+
+
+def compile_column_filter(filter_position, filter_datatype, filter_operator,
+                          filter_value):
+    '''builds a function that checks rows of typed columns against a filter,
+        as compile_filter does for rows of a CSV file
+
+    keyword_args:
+        filter_position - position of the filter column
+        filter_datatype - simplified datatype of the filter column
+        filter_operator - comparison operator of the filter, such as '<='
+        filter_value - value the column is compared to, as in the sql tree
+
+    returns:
+        function that takes a list of typed columns and a list of row
+        numbers, and returns the row numbers that pass the filter.  as with
+        compile_filter, empty numbers and dates never pass, and empty CHAR
+        values are compared as strings
+'''
+    compare = filter_operators[filter_operator]
+    filter_element = filter_value.replace("'", '')
+
+    if filter_datatype == 'NUMBER':
+        filter_element = float(filter_element)
+    elif filter_datatype == 'DATE':
+        filter_element = date_to_ordinal(filter_element)
+
+    def column_filter(columns, rows):
+        column = columns[filter_position]
+        if isinstance(column, array):
+            return [row for row in rows if compare(column[row],
+                                                   filter_element)]
+        return [row for row in rows if column[row] is not None and
+                compare(column[row], filter_element)]
 
-        elif 'CHAR' in column_datatype.upper():
-            column_datatypes[column_name] = 'CHAR'
+    return column_filter
 
+
+def compile_column_filters(filters, column_positions, column_datatypes,
+                           table_statistics=None, semi_join_filters=None):
+    '''compiles the filters of a sql tree that apply to a table held as
+        typed columns, in the same order as compile_filters
+
+    keyword_args:
+        filters - the 'filters' part of a sql tree
+        column_positions - dictionary of column names and their positions
+        column_datatypes - dictionary of column names and their
+                           simplified datatypes
+        table_statistics - statistics of the table, as used by rank_filters
+                           (optional)
+        semi_join_filters - the semi-join filters of the table, as used by
+                            compile_filters (optional)
+
+    returns:
+        list of functions, as built by compile_column_filter and
+        compile_column_semi_join_filter, in the order they should be
+        applied
+'''
+    ranked_filters = rank_filters(filters, column_positions,
+                                  column_datatypes, table_statistics)
+    if ranked_filters is None:
+        return [lambda columns, rows: []]
+
+    return [compile_column_filter(column_positions[filter['identifier']],
+                                  column_datatypes.get(filter['identifier']),
+                                  filter['operator'], filter['value'])
+            for filter in ranked_filters] + \
+        [compile_column_semi_join_filter(
+            column_positions[filter['identifier']], filter['bloom_filter'])
+         for filter in semi_join_filters or []
+         if filter['identifier'] in column_positions]
+
+
+def compile_semi_join_filter(filter_position, filter_datatype,
+                             bloom_filter):
+    '''builds a function that checks whether the join key of a row of a
+        CSV file might be in a Bloom filter of the keys of another table,
+        so that rows that can't join are dropped as the file is read.  the
+        key is converted as it is in typed columns, so that it hashes like
+        the keys that were added to the filter
+
+    keyword_args:
+        filter_position - position of the join column in each row
+        filter_datatype - simplified datatype of the join column
+        bloom_filter - BloomFilter of the keys of the other table.  the rows
+                       checked and passed are counted in it, and the keys
+                       that passed are kept in its passed_keys
+
+    returns:
+        function that takes a row, as a list of strings, and returns True
+        if the row might join.  empty values never join
+'''
+    might_contain = bloom_filter.might_contain
+    passed_keys = []
+    bloom_filter.passed_keys.append(passed_keys)
+
+    if filter_datatype == 'NUMBER':
+        convert = float
+    elif filter_datatype == 'DATE':
+        convert = date_to_ordinal
+    else:
+        def string_filter(row):
+            bloom_filter.checked += 1
+            data_element = row[filter_position]
+            if might_contain(data_element):
+                bloom_filter.passed += 1
+                passed_keys.append(data_element)
+                return True
+            return False
+
+        return string_filter
+
+    def row_filter(row):
+        bloom_filter.checked += 1
+        data_element = row[filter_position]
+        if data_element != '':
+            key = convert(data_element)
+            if might_contain(key):
+                bloom_filter.passed += 1
+                passed_keys.append(key)
+                return True
+        return False
+
+    return row_filter
+
+
+def compile_column_semi_join_filter(filter_position, bloom_filter):
+    '''builds a function that checks rows of typed columns against a Bloom
+        filter, as compile_semi_join_filter does for rows of a CSV file.
+        with numpy, numeric and date columns are checked a batch at a time
+
+    keyword_args:
+        filter_position - position of the join column
+        bloom_filter - BloomFilter of the keys of the other table.  the
+                       keys that passed are kept in its passed_keys
+
+    returns:
+        function that takes a list of typed columns and a list of row
+        numbers, and returns the row numbers that might join
+'''
+    def column_filter(columns, rows):
+        column = columns[filter_position]
+        if numpy is not None and isinstance(column, array) and \
+                len(rows) > 0:
+            values = numpy.frombuffer(column, column.typecode)
+            if isinstance(rows, range) and rows.step == 1:
+                passed_rows = numpy.flatnonzero(
+                    bloom_filter.might_contain_values(
+                        values[rows.start:rows.stop])) + rows.start
+            else:
+                positions = numpy.fromiter(rows, numpy.intp, len(rows))
+                passed_rows = positions[
+                    bloom_filter.might_contain_values(values[positions])]
+            bloom_filter.passed_keys.append(values[passed_rows])
+            passed_rows = passed_rows.tolist()
         else:
-            column_datatypes[column_name] = column_datatype.upper()
+            might_contain = bloom_filter.might_contain
+            passed_rows = [row for row in rows if column[row] is not None and
+                           might_contain(column[row])]
+            bloom_filter.passed_keys.append([column[row]
+                                             for row in passed_rows])
+
+        bloom_filter.checked += len(rows)
+        bloom_filter.passed += len(passed_rows)
+        return passed_rows
+
+    return column_filter
+
+
+def date_to_ordinal(date_text):
+    '''converts a date in YYYY-MM-DD format to its proleptic Gregorian
+        ordinal, as used by date.toordinal
+
+    keyword_args:
+        date_text - date, as a string
+
+    returns:
+        the ordinal of the date, as an integer
+'''
+    try:
+        return date_ordinals[date_text]
+    except KeyError:
+        ordinal = datetime.strptime(date_text, '%Y-%m-%d').toordinal()
+        if len(date_ordinals) < date_ordinals_size:
+            date_ordinals[date_text] = ordinal
+        return ordinal
+
+
+def simplified_datatype(column_datatype):
+    '''returns the simplified datatype of a column, which is how filters
+        compare its values: 'NUMBER', 'DATE', 'CHAR', or the datatype
+        itself, in upper case, for any other datatype
 
-    # check to see if filter column is in file and map filters to keys
-    for i, filter in enumerate(data_filter_sql_tree):
+    keyword_args:
+        column_datatype - the datatype of the column, from its _header file
+'''
+    column_datatype = column_datatype.upper()
+
+    if column_datatype in ['INTEGER', 'NUMERIC']:
+        return 'NUMBER'
+
+    elif 'CHAR' in column_datatype:
+        return 'CHAR'
+
+    return column_datatype
+
+
+def header_datatypes(header_lines):
+    '''reads the simplified datatypes of the columns of a _header file,
+        without reading the file it describes
+
+    keyword_args:
+        header_lines - iterable of the lines of the _header file
+
+    returns:
+        dictionary of column names and their simplified datatypes, in file
+        order
+'''
+    column_headers = next(csv.reader(header_lines, delimiter=',',
+                                     quotechar='"'))
+
+    return {v.split(' ')[0]: simplified_datatype(v.split(' ')[1])
+            for v in column_headers}
+
+
+def column_storage(column_datatype):
+    '''determines how a column of a given datatype is held in memory
+
+    keyword_args:
+        column_datatype - the datatype of the column, from its _header file
+
+    returns:
+        typecode - the array typecode to store the column as,
+                   or None if the column is stored as a list
+        converter - function that converts a value in the CSV file to
+                    its stored value, or None if the value is kept as a
+                    string
+'''
+    column_datatype = column_datatype.upper()
+
+    if column_datatype == 'INTEGER':
+        return 'q', int
+
+    elif column_datatype == 'NUMERIC':
+        return 'd', float
+
+    elif column_datatype == 'DATE':
+        return 'q', date_to_ordinal
+
+    return None, None
+
+
+def append_rows_to_columns(columns, rows, column_converters):
+    '''transposes rows read from a CSV file and appends them to typed
+        columns.  rows are transposed in batches of column_batch_size,
+        and each batch is converted a column at a time
+
+    keyword_args:
+        columns - list of columns, as returned by file_to_data_structure.
+                  a typed column holding empty values is replaced by a list
+        rows - iterable of rows, each a list of strings
+        column_converters - list with the converter for each column,
+                            as returned by column_storage
+'''
+    rows = iter(rows)
+    while True:
+        batch_rows = list(islice(rows, column_batch_size))
+        if len(batch_rows) == 0:
+            break
+        append_batch_to_columns(columns, batch_rows, column_converters)
+
+
+def append_batch_to_columns(columns, rows, column_converters):
+    '''appends a batch of rows to typed columns, converting a column at a
+        time.  used by append_rows_to_columns
+'''
+    kept_positions = [position for position, column in enumerate(columns)
+                      if column is not None]
+    if len(kept_positions) == len(columns):
+        kept_values = zip(*rows)
+    else:
+        kept_values = ([row[position] for row in rows]
+                       for position in kept_positions)
+
+    for position, values in zip(kept_positions, kept_values):
+        column = columns[position]
+        converter = column_converters[position]
+
+        if converter is None:
+            column.extend(values)
+            continue
+
+        # most dates repeat many times, so each distinct date is only
+        # converted once
+        if converter is date_to_ordinal:
+            converter = {v: date_to_ordinal(v) if v != '' else None
+                         for v in set(values)}.__getitem__
+
+        if isinstance(column, array):
+            column_length = len(column)
+            try:
+                column.extend(map(converter, values))
+                continue
+            except (ValueError, TypeError):
+                # an empty value can't be stored in an array, so
+                # the column becomes a list
+                del column[column_length:]
+                column = columns[position] = column.tolist()
+
+        column.extend(None if v == '' else converter(v) for v in values)
+
+
+def filter_rows(rows, row_filters):
+    '''skips blank rows, then applies each filter in turn, so that a row is
+        only checked against a filter if it passed all the filters before it
+
+    keyword_args:
+        rows - iterable of rows, each a list of strings
+        row_filters - list of filters, as returned by compile_filters
+
+    returns:
+        iterator over the rows that pass every filter
+'''
+    rows = filter(None, rows)
+    for row_filter in row_filters:
+        rows = filter(row_filter, rows)
+
+    return rows
+
+
+def numpy_column_dtype(column, converter):
+    '''returns the numpy dtype that a column is read as by the numpy engine
+
+    keyword_args:
+        column - an empty column, as created by csv_to_data_structure
+        converter - the converter of the column, as returned by
+                    column_storage
+'''
+    if converter is date_to_ordinal:
+        return 'M8[D]'
+
+    elif isinstance(column, array):
+        return column.typecode.replace('q', 'i8').replace('d', 'f8')
+
+    return 'O'
+
+
+def compile_chunk_filters(filters, column_positions, column_datatypes,
+                          semi_join_filters=None):
+    '''compiles the filters of a sql tree that apply to a file into
+        vectorized comparisons, for the numpy engine.  semi-join filters
+        come last, as with compile_filters
+
+    keyword_args:
+        filters - the 'filters' part of a sql tree
+        column_positions - dictionary of column names and their positions
+        column_datatypes - dictionary of column names and their
+                           simplified datatypes
+        semi_join_filters - the semi-join filters of the file, as used by
+                            compile_filters (optional)
+
+    returns:
+        list of functions that take a chunk, as read by
+        append_chunk_to_columns, and return a boolean array marking the
+        rows of the chunk that pass the filter
+'''
+    chunk_filters = []
+
+    for i, filter in enumerate(filters):
         filter_identifier = filter['identifier']
-        filter_value = filter['value']
-        filter_operator = filter['operator']
-
-        if filter_identifier in column_positions:
-            filter_position = column_positions[filter_identifier]
-            if filter_position not in data_filter_this_file:
-                data_filter_this_file[filter_position] = []
-            filter_values = {}
-            filter_values['identifier'] = filter_identifier
-            filter_values['operator'] = filter_operator
-            filter_values['value'] = filter_value
-            data_filter_this_file[filter_position].append(filter_values)
-
-    # read file into data structure, filtering along the way
-    # for line in lfile:
-    for line_data in lfile_reader:
-        # if any filters,
-        # filter file on filter column while reading into dataset
-        if len(data_filter_this_file) == 0:
-            file_data.append(line_data)
-        elif len(data_filter_this_file) > 0:
-            for filter_position, filter_list in \
-                    data_filter_this_file.items():
-                for i, filter in enumerate(filter_list):
-
-                    if column_datatypes[filter['identifier']] == 'NUMBER':
-                        data_element = float(line_data[filter_position])
-                        filter_element = \
-                            float(filter['value'].replace("'", ''))
-                    elif column_datatypes[filter['identifier']] == 'DATE':
-                        data_element = \
-                            datetime.strptime(line_data[filter_position],
-                                              "%Y-%m-%d")
-                        filter_element = \
-                            datetime.strptime(filter['value'].replace("'", ''),
-                                              "%Y-%m-%d")
-                    else:
-                        data_element = line_data[filter_position]
-                        filter_element = filter['value'].replace("'", '')
+        if filter_identifier not in column_positions:
+            continue
 
-                    if filter['operator'] == '=' \
-                            and data_element == filter_element:
-                        file_data.append(line_data)
+        if filter['operator'] not in filter_operators:
+            return [lambda chunk: numpy.zeros(len(chunk), bool)]
 
-                    elif filter['operator'] == '!=' \
-                            and data_element != filter_element:
-                        file_data.append(line_data)
+        compare = filter_operators[filter['operator']]
+        field_name = 'c' + str(column_positions[filter_identifier])
+        filter_element = filter['value'].replace("'", '')
 
-                    elif filter['operator'] == '>' \
-                            and data_element > filter_element:
-                        file_data.append(line_data)
+        if column_datatypes.get(filter_identifier) == 'NUMBER':
+            filter_element = float(filter_element)
 
-                    elif filter['operator'] == '>=' \
-                            and data_element >= filter_element:
-                        file_data.append(line_data)
+        # dates are compared as days since 1970-01-01
+        elif column_datatypes.get(filter_identifier) == 'DATE':
+            filter_element = date_to_ordinal(filter_element) - \
+                numpy_date_offset
+            chunk_filters.append(
+                lambda chunk, compare=compare, field_name=field_name,
+                filter_element=filter_element:
+                    compare(chunk[field_name].view('i8'), filter_element))
+            continue
 
-                    elif filter['operator'] == '<' \
-                            and data_element < filter_element:
-                        file_data.append(line_data)
+        chunk_filters.append(
+            lambda chunk, compare=compare, field_name=field_name,
+            filter_element=filter_element:
+                compare(chunk[field_name], filter_element))
 
-                    elif filter['operator'] == '<=' \
-                            and data_element <= filter_element:
-                        file_data.append(line_data)
+    for filter in semi_join_filters or []:
+        if filter['identifier'] in column_positions:
+            chunk_filters.append(compile_chunk_semi_join_filter(
+                'c' + str(column_positions[filter['identifier']]),
+                filter['bloom_filter']))
 
-    return column_positions, column_datatypes, file_data
+    return chunk_filters
+
+
+def compile_chunk_semi_join_filter(field_name, bloom_filter):
+    '''builds a function that checks the join keys of a chunk against a
+        Bloom filter, for the numpy engine
+
+    keyword_args:
+        field_name - name of the join column's field in each chunk
+        bloom_filter - BloomFilter of the keys of the other table.  the
+                       keys that passed are kept in its passed_keys
+
+    returns:
+        function that takes a chunk and returns a boolean array marking the
+        rows of the chunk that might join
+'''
+    def chunk_filter(chunk):
+        values = chunk[field_name]
+        # dates are checked as ordinals, as they are held in typed columns
+        if values.dtype.kind == 'M':
+            values = values.view('i8') + numpy_date_offset
+
+        passed = bloom_filter.might_contain_values(values)
+        bloom_filter.checked += len(passed)
+        bloom_filter.passed += int(passed.sum())
+        bloom_filter.passed_keys.append(values[passed])
+        return passed
+
+    return chunk_filter
+
+
+def append_chunk_to_columns(columns, chunk_lines, numpy_dtype,
+                            chunk_filters):
+    '''reads a chunk of CSV lines with numpy, filters it and appends the
+        rows that pass every filter to typed columns
+
+    keyword_args:
+        columns - list of columns, as returned by file_to_data_structure
+        chunk_lines - list of lines of CSV data
+        numpy_dtype - structured numpy dtype, with a field named c<position>
+                      for each column that is kept, as returned by
+                      numpy_column_dtype
+        chunk_filters - list of filters, as returned by
+                        compile_chunk_filters
+
+    returns:
+        True if the chunk was read, or False if numpy can't read it the
+        same way as the python engine, such as when it has empty values
+        in numeric or date columns.  nothing is appended in that case
+'''
+    try:
+        chunk = numpy.loadtxt(chunk_lines, dtype=numpy_dtype, delimiter=',',
+                              quotechar='"', comments=None, ndmin=1,
+                              usecols=[int(field_name[1:]) for field_name
+                                       in numpy_dtype.names])
+    except ValueError:
+        return False
+
+    for field_name in numpy_dtype.names:
+        if numpy_dtype[field_name].kind == 'M' and \
+                numpy.isnat(chunk[field_name]).any():
+            return False
+
+    # each filter only checks the rows that passed the filters before it
+    for chunk_filter in chunk_filters:
+        chunk = chunk[chunk_filter(chunk)]
+
+    for position, column in enumerate(columns):
+        if column is None:
+            continue
+
+        values = chunk['c' + str(position)]
+        if values.dtype.kind == 'M':
+            values = values.view('i8') + numpy_date_offset
+
+        if isinstance(column, array):
+            column.frombytes(values.tobytes())
+        else:
+            column.extend(values.tolist())
+
+    return True
+
+
+def sql_tree_columns(sql_tree):
+    '''finds the columns a sql tree refers to in its select, joins, filters,
+        grouping and ordering, so that the tables it reads only keep those
+        columns
+
+    keyword_args:
+        sql_tree - a sql tree, as generated by sql_to_tree library
+
+    returns:
+        set of column names, or None if the query selects every column
+'''
+    columns = set()
+
+    for select_item in sql_tree['select'] + sql_tree['select aggregate']:
+        if select_item['column_name'] == '*':
+            return None
+        columns.add(select_item['column_name'])
+
+    for join in sql_tree['joins']:
+        columns.add(join['left_identifier'])
+        columns.add(join['right_identifier'])
+
+    for filter in sql_tree['filters']:
+        columns.add(filter['identifier'])
+
+    for grouping_item in sql_tree['grouping']:
+        columns.add(grouping_item.get('column_name'))
+
+    for order_item in sql_tree['ordering']:
+        columns.add(order_item['column_name'])
+
+    columns.discard(None)
+
+    return columns
 
 
 def map_select_columns_to_data(sql_tree, table_name,
@@ -201,8 +1620,8 @@ def transpose_columns_to_rows(selected_data_in_columns):
     keyword_args:
         selected_data_in_columns - a columnar dataset, expressed as a dict
                                   each dictionary item should have the column
-                                  name as its key, and a list of the data
-                                  for that column as its value
+                                  name as its key, and a list or array of
+                                  the data for that column as its value
 
     returns:
         selected_data_headers - list of each of the selected columns
@@ -210,69 +1629,538 @@ def transpose_columns_to_rows(selected_data_in_columns):
                                 of data
 
 '''
-    selected_data_in_rows = []
     selected_data_headers = tuple(selected_data_in_columns.keys())
-
-    for row, value in \
-            enumerate(selected_data_in_columns[selected_data_headers[0]]):
-        row_data = []
-        for k in selected_data_in_columns.keys():
-            row_data.append(selected_data_in_columns[k][row])
-        selected_data_in_rows.append(tuple(row_data))
+    selected_data_in_rows = list(zip(*selected_data_in_columns.values()))
 
     return selected_data_headers, selected_data_in_rows
 
 
-def column_join(left_column, right_column):
-    '''determines the join between two columns of data
+def new_column_like(column):
+    '''returns a new, empty column that stores the same type of values as
+        a given column
+
+    keyword_args:
+        column - a column, as returned by file_to_data_structure, or a
+                 range of row numbers, as used by gather_rows
+'''
+    if isinstance(column, array):
+        return array(column.typecode)
+
+    if isinstance(column, range):
+        return array('q')
+
+    return []
+
+
+def join_keys(columns):
+    '''returns the join keys of the rows of a table: the values of its
+        join column, or tuples of the values of its join columns.  a key
+        with an empty value is None, as it never joins
+'''
+    if len(columns) == 1:
+        return columns[0]
+
+    return [None if None in key else key for key in zip(*columns)]
+
+
+def column_join(left_columns, right_columns, right_index=None,
+                memory_budget=None, spill_directory=None):
+    '''determines the join between the rows of two tables on one or more
+       columns.  a hashtable of the rows of each key of the smaller table is
+       built, and probed with each key of the other table
        used in table join
 
         keyword_args:
-            left_column - list, corresponding to left column in join
-            right_column - list, corresponding to right column in joins
+            left_columns - list of the join columns of the left table
+            right_columns - list of the join columns of the right table,
+                            in the same order as the left columns
+            right_index - index of the right column, such as a ColumnIndex,
+                          used instead of building a hashtable.  must map
+                          each value to the rows of the right column
+                          holding it, with get.  only used with a single
+                          join column (optional)
+            memory_budget - bytes the hashtable may take before the join
+                            is partitioned on disk.  defaults to
+                            join_memory_budget (optional)
+            spill_directory - directory the partitions are written to, as
+                              used by partitioned_column_join (optional)
+
+        a join on a single integer column, whose right keys are dense,
+        looks up the rows of each key in an array, as built by
+        direct_lookup, instead of a hashtable.  otherwise, when the
+        hashtable of the smaller table is expected to take more than the
+        memory budget, the join is applied by partitioned_column_join
+        instead
 
         returns:
-            join - dictionary with left column rows as keys,
-                           right column rows as values
+            left_rows, right_rows - parallel array('q') of the row numbers
+                           of each pair of joined rows, in left row order
+                           and then right row order
+'''
+
+    if right_index is None and len(right_columns) == 1:
+        lookup = direct_lookup(left_columns[0], right_columns[0])
+        if lookup is not None:
+            return probe_direct_lookup(lookup, left_columns[0])
+
+    if right_index is not None and len(right_columns) == 1:
+        return probe_hashtable(right_index, join_keys(left_columns))
+
+    if memory_budget is None:
+        memory_budget = join_memory_budget
+
+    # a hashtable that doesn't fit in the memory budget is built a
+    # partition at a time instead
+    hashtable_bytes = min(len(left_columns[0]), len(right_columns[0])) * \
+        hashtable_row_bytes
+    if hashtable_bytes > memory_budget:
+        return partitioned_column_join(
+            left_columns, right_columns,
+            min(max(2, -(-2 * hashtable_bytes // memory_budget)),
+                max_join_partitions), spill_directory)
+
+    if len(right_columns[0]) <= len(left_columns[0]):
+        return probe_hashtable(build_hashtable(join_keys(right_columns)),
+                               join_keys(left_columns))
+
+    # the right rows are found in right row order, and are put back in
+    # left row order
+    right_rows, left_rows = probe_hashtable(
+        build_hashtable(join_keys(left_columns)), join_keys(right_columns))
+    return left_row_order(left_rows, right_rows)
+
+
+def left_row_order(left_rows, right_rows):
+    '''puts joined rows in the order column_join returns them in, which is
+        left row order, and then right row order
+
+    keyword_args:
+        left_rows, right_rows - parallel array('q') of the row numbers of
+                                each pair of joined rows.  the right rows
+                                of each left row must be in order
+
+    returns:
+        the same as column_join
 '''
+    if is_sorted(left_rows):
+        return left_rows, right_rows
 
+    if numpy is not None:
+        left_positions = numpy.frombuffer(left_rows, numpy.int64)
+        right_positions = numpy.frombuffer(right_rows, numpy.int64)
+        order = numpy.argsort(left_positions, kind='stable')
+        return array('q', left_positions[order].tobytes()), \
+            array('q', right_positions[order].tobytes())
+
+    joined_rows = sorted(zip(left_rows, right_rows))
+    return array('q', (row for row, _ in joined_rows)), \
+        array('q', (row for _, row in joined_rows))
+
+
+def build_hashtable(keys):
+    '''builds a hashtable of the rows holding each join key, in row order.
+        empty values never match, so they are left out
+
+    keyword_args:
+        keys - join keys of a table, as returned by join_keys
+'''
     hashtable = {}
-    join = {}
-
-    # bulid a hashtable out of the right column
-    for i, v in enumerate(right_column):
-        try:
-            hashtable[v].append(i)
-        except KeyError:
-            hashtable[v] = [i]
-
-    # iterate the left column over the hashtable and record results
-    for i, v in enumerate(left_column):
-        if v in hashtable.keys():
+    for i, v in enumerate(keys):
+        if v is not None:
+            rows = hashtable.get(v)
+            if rows is None:
+                hashtable[v] = [i]
+            else:
+                rows.append(i)
+
+    return hashtable
+
+
+def probe_hashtable(hashtable, keys):
+    '''finds the rows that join by looking up each join key of a table in
+        a hashtable of the keys of another table
+
+    keyword_args:
+        hashtable - hashtable of the keys of the right table, as returned
+                    by build_hashtable, or an index mapping each key to the
+                    rows holding it, with get
+        keys - join keys of the left table, as returned by join_keys
+
+    returns:
+        the same as column_join
+'''
+    left_rows = array('q')
+    right_rows = array('q')
+
+    # iterate the left keys over the hashtable and record results
+    get_rows = hashtable.get
+    for i, v in enumerate(keys):
+        if v is not None:
+            rows = get_rows(v)
+            if rows is not None:
+                right_rows.extend(rows)
+                if len(rows) == 1:
+                    left_rows.append(i)
+                else:
+                    left_rows.extend(repeat(i, len(rows)))
+
+    return left_rows, right_rows
+
+
+def direct_lookup(left_column, right_column):
+    '''builds a direct-address lookup of the rows holding each key of a
+        join column, with numpy.  the keys must be integers, as held in
+        array('q') for INTEGER columns of a _header file, and dense: the
+        range from the smallest to the largest key can't be more than
+        direct_join_range_factor times the number of rows.  the rows are
+        then grouped by key, and the start of each key's rows is kept in an
+        array indexed by the key, less the smallest key
+
+    keyword_args:
+        left_column - join column of the table that probes the lookup,
+                      which must also hold integers
+        right_column - join column the lookup is built from
+
+    returns:
+        a tuple of the smallest key, the start of the rows of each key,
+        followed by the end of the last key's rows, and the rows grouped by
+        key, in row order, or None if the columns can't be joined this way
+'''
+    if numpy is None or not isinstance(left_column, array) or \
+            not isinstance(right_column, array) or \
+            left_column.typecode != 'q' or right_column.typecode != 'q' or \
+            len(right_column) == 0:
+        return None
+
+    keys = numpy.frombuffer(right_column, numpy.int64)
+    minimum = int(keys.min())
+    key_range = int(keys.max()) - minimum + 1
+    if key_range > direct_join_range_factor * len(keys):
+        return None
+
+    with scan_statistics_lock:
+        scan_statistics['direct_joins'] += 1
+
+    slots = keys - minimum
+    starts = numpy.zeros(key_range + 1, numpy.int64)
+    numpy.cumsum(numpy.bincount(slots, minlength=key_range),
+                 out=starts[1:])
+
+    return minimum, starts, numpy.argsort(slots, kind='stable')
+
+
+def probe_direct_lookup(lookup, keys):
+    '''finds the rows that join by looking up each key of a join column in
+        a direct-address lookup of the keys of another table, with numpy
+
+    keyword_args:
+        lookup - lookup of the keys of the right table, as returned by
+                 direct_lookup
+        keys - join column of the left table, as an array('q')
+
+    returns:
+        the same as column_join
+'''
+    minimum, starts, grouped_rows = lookup
+
+    keys = numpy.frombuffer(keys, numpy.int64)
+    left_rows = numpy.flatnonzero((keys >= minimum) &
+                                  (keys < minimum + len(starts) - 1))
+    slots = keys[left_rows] - minimum
+    row_starts = starts[slots]
+    row_counts = starts[slots + 1] - row_starts
+
+    # each left row is repeated for every right row of its key, which are
+    # found at consecutive positions from the start of the key's rows
+    left_rows = numpy.repeat(left_rows, row_counts)
+    positions = numpy.arange(len(left_rows)) + numpy.repeat(
+        row_starts - (numpy.cumsum(row_counts) - row_counts), row_counts)
+
+    return array('q', left_rows.astype(numpy.int64).tobytes()), \
+        array('q', grouped_rows[positions].astype(numpy.int64).tobytes())
+
+
+def merge_column_join(left_column, right_column):
+    '''finds the rows of two tables that join on a single column, when
+        both columns are in ascending order, by merging them.  no hashtable
+        is built: with numpy, the rows of each left key are found by binary
+        search of the right column, and otherwise by merge_join_rows
+
+    keyword_args:
+        left_column - join column of the left table, in ascending order
+        right_column - join column of the right table, in ascending order
+
+    returns:
+        the same as column_join
+'''
+    with scan_statistics_lock:
+        scan_statistics['merge_joins'] += 1
+
+    if numpy is not None and isinstance(left_column, array) and \
+            isinstance(right_column, array):
+        left_keys = numpy.frombuffer(left_column, left_column.typecode)
+        right_keys = numpy.frombuffer(right_column, right_column.typecode)
+        row_starts = numpy.searchsorted(right_keys, left_keys, 'left')
+        row_counts = numpy.searchsorted(right_keys, left_keys, 'right') - \
+            row_starts
+
+        # each left row is repeated for every right row of its key, which
+        # are found at consecutive positions from the first of them
+        left_rows = numpy.repeat(numpy.arange(len(left_keys)), row_counts)
+        right_rows = numpy.arange(len(left_rows)) + numpy.repeat(
+            row_starts - (numpy.cumsum(row_counts) - row_counts), row_counts)
+
+        return array('q', left_rows.astype(numpy.int64).tobytes()), \
+            array('q', right_rows.astype(numpy.int64).tobytes())
+
+    left_rows = array('q')
+    right_rows = array('q')
+    for left_row, rows in merge_join_rows(left_column, right_column):
+        right_rows.extend(rows)
+        if len(rows) == 1:
+            left_rows.append(left_row)
+        else:
+            left_rows.extend(repeat(left_row, len(rows)))
+
+    return left_rows, right_rows
+
+
+def merge_join_rows(left_keys, right_keys):
+    '''merges two sequences of join keys in ascending order, such as the
+        join columns of two tables read by a streaming scan.  only the right
+        rows of the current key are held, so the merge takes the same
+        memory whatever the size of the tables
+
+    keyword_args:
+        left_keys - iterable of the keys of the left table
+        right_keys - iterable of the keys of the right table
+
+    returns:
+        generator of each left row that joins and the list of right rows it
+        joins with, in row order
+'''
+    right_keys = enumerate(right_keys)
+    right_row, right_key = next(right_keys, (None, None))
+    run_key = None
+    run_rows = []
+
+    for left_row, left_key in enumerate(left_keys):
+        if left_key != run_key or len(run_rows) == 0:
+            while right_row is not None and right_key < left_key:
+                right_row, right_key = next(right_keys, (None, None))
+
+            run_key = left_key
+            run_rows = []
+            while right_row is not None and right_key == left_key:
+                run_rows.append(right_row)
+                right_row, right_key = next(right_keys, (None, None))
+
+        if len(run_rows) > 0:
+            yield left_row, run_rows
+
+
+def partitioned_column_join(left_columns, right_columns, partition_count,
+                            spill_directory=None):
+    '''determines the join between the rows of two tables, as column_join
+        does, without holding a hashtable of every key of the smaller table
+        in memory.  the keys of both tables are hashed into partition files
+        on disk, so that equal keys are in the same pair of partitions, and
+        each pair is then joined on its own, with a hashtable of the keys of
+        the smaller table's partition
+
+        keyword_args:
+            left_columns - list of the join columns of the left table
+            right_columns - list of the join columns of the right table,
+                            in the same order as the left columns
+            partition_count - number of partitions of each table
+            spill_directory - directory to write the partitions to.
+                              defaults to join_spill_directory, or the
+                              system's temporary directory (optional)
+
+        returns:
+            the same as column_join
+'''
+    with scan_statistics_lock:
+        scan_statistics['partitioned_joins'] += 1
+
+    if spill_directory is None:
+        spill_directory = join_spill_directory
+
+    # the hashtable of each partition is built from the smaller table
+    build_left = len(left_columns[0]) < len(right_columns[0])
+
+    left_rows = array('q')
+    right_rows = array('q')
+    build_rows, probe_rows = right_rows, left_rows
+    if build_left:
+        build_rows, probe_rows = left_rows, right_rows
+
+    directory = tempfile.mkdtemp(dir=spill_directory)
+    try:
+        left_partitions = write_join_partitions(left_columns,
+                                                partition_count,
+                                                directory, 'left')
+        right_partitions = write_join_partitions(right_columns,
+                                                 partition_count,
+                                                 directory, 'right')
+
+        build_partitions, probe_partitions = right_partitions, \
+            left_partitions
+        if build_left:
+            build_partitions, probe_partitions = left_partitions, \
+                right_partitions
+
+        for build_partition, probe_partition in zip(build_partitions,
+                                                    probe_partitions):
+            hashtable = {}
+            for keys, rows in read_join_partition(build_partition):
+                for v, i in zip(keys, rows):
+                    partition_rows = hashtable.get(v)
+                    if partition_rows is None:
+                        hashtable[v] = [i]
+                    else:
+                        partition_rows.append(i)
+            os.remove(build_partition)
+
+            get_rows = hashtable.get
+            for keys, rows in read_join_partition(probe_partition):
+                for v, i in zip(keys, rows):
+                    partition_rows = get_rows(v)
+                    if partition_rows is not None:
+                        build_rows.extend(partition_rows)
+                        probe_rows.extend(repeat(i, len(partition_rows)))
+            os.remove(probe_partition)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    # every key is in a single pair of partitions, so the right rows of
+    # each left row are already in order
+    return left_row_order(left_rows, right_rows)
+
+
+def write_join_partitions(columns, partition_count, directory, name):
+    '''hashes the join keys of a table into partition files, a batch of
+        rows at a time.  each file holds pickled pairs of a list of keys
+        and an array('q') of the rows holding them.  empty keys are left
+        out, as they never join
+
+        keyword_args:
+            columns - list of the join columns of the table
+            partition_count - number of partition files to write
+            directory - directory to write the partition files to
+            name - name of the table's partition files, which is followed
+                   by the number of each partition
+
+        returns:
+            list of the names of the partition files
+'''
+    partition_filenames = [os.path.join(directory, name + str(partition))
+                           for partition in range(partition_count)]
+    partition_files = []
+    try:
+        for partition_filename in partition_filenames:
+            partition_files.append(open(partition_filename, 'wb'))
+
+        row_count = len(columns[0])
+        for start in range(0, row_count, default_scan_batch_size):
+            stop = min(start + default_scan_batch_size, row_count)
+            keys = join_keys([column[start:stop] for column in columns])
+            rows = range(start, stop)
+            if not isinstance(keys, array):
+                rows = [i for i, v in zip(rows, keys) if v is not None]
+                keys = [v for v in keys if v is not None]
+
+            partition_keys = [[] for partition in range(partition_count)]
+            partition_rows = [array('q') for partition in
+                              range(partition_count)]
+            for v, i, partition in zip(keys, rows,
+                                       key_partitions(keys, partition_count)):
+                partition_keys[partition].append(v)
+                partition_rows[partition].append(i)
+
+            for partition, partition_file in enumerate(partition_files):
+                if len(partition_rows[partition]) > 0:
+                    pickle.dump((partition_keys[partition],
+                                 partition_rows[partition]),
+                                partition_file, pickle.HIGHEST_PROTOCOL)
+    finally:
+        for partition_file in partition_files:
+            partition_file.close()
+
+    return partition_filenames
+
+
+def read_join_partition(partition_filename):
+    '''generator function that reads the keys and rows of a partition file,
+        as written by write_join_partitions, a batch at a time
+'''
+    with open(partition_filename, 'rb') as partition_file:
+        while True:
             try:
-                join[i].append(hashtable[v])
-            except KeyError:
-                join[i] = hashtable[v]
+                yield pickle.load(partition_file)
+            except EOFError:
+                return
 
-    return join
 
+def key_partitions(keys, partition_count):
+    '''returns the partition of each of a list of join keys.  keys that are
+        equal, such as 5 and 5.0, are in the same partition
+'''
+    if numpy is not None and len(keys) > 0:
+        first_hashes, second_hashes = split_hashes(key_hashes(keys))
+        return (first_hashes % numpy.uint64(partition_count)).tolist()
+
+    return [(mix_hash(hash(v)) & 0xFFFFFFFF) % partition_count for v in keys]
 
-def optimize_join_order(sql_tree, join_columns):
+
+def gather_rows(column, rows):
+    '''returns a new column holding the given rows of a column, of the same
+        type as the column
+
+    keyword_args:
+        column - list or array of values, or range(n) for the row numbers
+                 of a table that hasn't been joined, whose rows are the
+                 given rows themselves
+        rows - array('q') of row numbers, as returned by column_join
+'''
+    if isinstance(column, range):
+        return array('q', rows)
+
+    if isinstance(column, array):
+        if numpy is not None and len(rows) > 0:
+            gathered_column = array(column.typecode)
+            gathered_column.frombytes(
+                numpy.frombuffer(column, column.typecode)[
+                    numpy.frombuffer(rows, numpy.int64)].tobytes())
+            return gathered_column
+        return array(column.typecode, map(column.__getitem__, rows))
+
+    return list(map(column.__getitem__, rows))
+
+
+def optimize_join_order(sql_tree, join_columns, table_statistics=None):
     '''optimizes order of tables join
        useful when joining multiple tables
 
-       can be optimized much further than the implementation below, which
-       only gets the tables in a logical order without taking into account
-       size or statistics
+       with table statistics, the order is chosen by cost_based_join_order.
+       without them, the tables are only put in a logical order, without
+       taking into account size or statistics
 
        keyword_args:
         sql_tree - a parsed SQL tree, as generated by the sql_to_tree module
         join_columns - a list of the columns in the sql tree's joins, mapped
                        to the tables in the join
+        table_statistics - the row count of each table after its filters,
+                           and the distinct values in its join columns, as
+                           returned by join_statistics (optional)
 
       returns:
         ordered_join_list - a reordered 'joins' portion of the sql tree in
-        the order that the join should follow
+        the order that the join should follow.  joins between the same two
+        tables are combined into the first of them, which holds the columns
+        of both tables in 'left_identifiers' and 'right_identifiers'.  with
+        table statistics, each join holds the estimated number of rows
+        after it, in 'estimated_rows'
 '''
 
     join_tables_list = []
@@ -294,9 +2182,29 @@ def optimize_join_order(sql_tree, join_columns):
             join_tables.append(join_columns[right_identifier][0])
 
         join['join_tables'] = join_tables
+        join['left_identifiers'] = [left_identifier]
+        join['right_identifiers'] = [right_identifier]
+
+        # joins between the same two tables are applied together, as a
+        # join on several columns
+        for previous_join in join_list:
+            if len(join_tables) == 2 and \
+                    set(previous_join['join_tables']) == set(join_tables):
+                if previous_join['join_tables'] != join_tables:
+                    left_identifier, right_identifier = \
+                        right_identifier, left_identifier
+                previous_join['left_identifiers'].append(left_identifier)
+                previous_join['right_identifiers'].append(right_identifier)
+                break
+        else:
+            join_tables_list.append(join_tables)
+            join_list.append(join)
 
-        join_tables_list.append(join_tables)
-        join_list.append(join)
+    if table_statistics is not None:
+        cost_based_join_list = cost_based_join_order(join_list,
+                                                     table_statistics)
+        if cost_based_join_list is not None:
+            return cost_based_join_list
 
     # order joins such that each join features a table in the preceding joins
     # could be optimized to go from smallest table to largest table or
@@ -320,14 +2228,367 @@ def optimize_join_order(sql_tree, join_columns):
     return ordered_join_list
 
 
-def join_data(join, dataset, column_map, previously_joined_tables):
-    '''executes an join on a columnar dataset
+def cost_based_join_order(join_list, table_statistics):
+    '''orders joins to keep the intermediate results small.  every order
+       of the joins that join_data can apply - each join adding one table to
+       the tables already joined - is compared by the total number of rows
+       estimated for its intermediate results.  joins of more than
+       max_dp_join_tables tables are ordered greedily instead
+
+       the rows of a join are estimated as the product of the rows on both
+       sides, divided by the larger number of distinct values of the two
+       join columns.  a join on several columns is divided by the product
+       of these for each pair of columns, up to the rows of its smaller side
+
+       keyword_args:
+        join_list - the joins of a sql tree, each holding its 'join_tables'
+        table_statistics - the row count of each table after its filters,
+                           and the distinct values in its join columns, as
+                           returned by join_statistics
+
+      returns:
+        the joins in the order that the join should follow, each holding the
+        estimated number of rows after it in 'estimated_rows', or None if
+        the tables aren't all joined to each other or have no statistics.
+        joins between tables that are already joined are left until last
+'''
+
+    tables = []
+    for join in join_list:
+        if len(join['join_tables']) != 2:
+            return None
+        for table in join['join_tables']:
+            if table not in table_statistics:
+                return None
+            if table not in tables:
+                tables.append(table)
+
+    # each plan is keyed by the tables it joins, and holds its cost, its
+    # estimated rows and distinct values, and its joins with their
+    # estimated rows
+    plans = {}
+    for table in tables:
+        plans[frozenset([table])] = (0, table_statistics[table]['rows'],
+                                     table_statistics[table]['distinct'], [])
+
+    for joined_count in range(1, len(tables)):
+        next_plans = {}
+
+        for joined_tables, plan in plans.items():
+            cost, rows, distinct, planned_joins = plan
+            planned_positions = [p for p, estimated_rows in planned_joins]
+
+            for position, join in enumerate(join_list):
+                left_table, right_table = join['join_tables']
+                if position in planned_positions or \
+                        (left_table in joined_tables) == \
+                        (right_table in joined_tables):
+                    continue
+
+                if left_table in joined_tables:
+                    new_table = right_table
+                else:
+                    new_table = left_table
+
+                join_distinct = {**distinct,
+                                 **table_statistics[new_table]['distinct']}
+                key_distinct = [(join_distinct.get(left_identifier, 1),
+                                 join_distinct.get(right_identifier, 1))
+                                for left_identifier, right_identifier in
+                                zip(join['left_identifiers'],
+                                    join['right_identifiers'])]
+
+                # a join on several columns is taken to keep no fewer rows
+                # than a join on a key of either table
+                divisor = max(key_distinct[0][0], key_distinct[0][1], 1)
+                for left_distinct, right_distinct in key_distinct[1:]:
+                    divisor = max(divisor, min(
+                        divisor * max(left_distinct, right_distinct, 1),
+                        rows, table_statistics[new_table]['rows']))
+                join_rows = rows * table_statistics[new_table]['rows'] / \
+                    divisor
+
+                # no column can hold more distinct values than rows, and
+                # only the values on both sides of the join are kept
+                for column, column_distinct in join_distinct.items():
+                    join_distinct[column] = min(column_distinct, join_rows)
+                for identifiers, distinct_values in zip(
+                        zip(join['left_identifiers'],
+                            join['right_identifiers']), key_distinct):
+                    join_distinct[identifiers[0]] = \
+                        join_distinct[identifiers[1]] = \
+                        min(distinct_values + (join_rows,))
+
+                next_tables = joined_tables | {new_table}
+                next_plan = (cost + join_rows, join_rows, join_distinct,
+                             planned_joins + [(position, join_rows)])
+                if next_tables not in next_plans or \
+                        next_plan[0] < next_plans[next_tables][0]:
+                    next_plans[next_tables] = next_plan
+
+        if len(tables) > max_dp_join_tables and next_plans:
+            cheapest_tables = min(next_plans,
+                                  key=lambda t: next_plans[t][0])
+            next_plans = {cheapest_tables: next_plans[cheapest_tables]}
+
+        plans = next_plans
+
+    if frozenset(tables) not in plans:
+        return None
+
+    ordered_join_list = []
+    planned_positions = []
+    for position, estimated_rows in plans[frozenset(tables)][3]:
+        join_list[position]['estimated_rows'] = estimated_rows
+        ordered_join_list.append(join_list[position])
+        planned_positions.append(position)
+
+    for position, join in enumerate(join_list):
+        if position not in planned_positions:
+            ordered_join_list.append(join)
+
+    return ordered_join_list
+
+
+def join_statistics(tables, join_columns, stored_statistics=None):
+    '''returns the statistics used by cost_based_join_order
 
     keyword_args:
-        join: a single list element from the optimize_join_order func
+        tables - dictionary of table aliases and their columns, after their
+                 filters have been applied
+        join_columns - the columns in the sql tree's joins, mapped to their
+                       tables and positions, as by map_select_columns_to_data
+        stored_statistics - dictionary of table aliases and the statistics
+                            of the whole table, as returned by
+                            read_table_statistics.  the distinct values of
+                            a join column are estimated from them, rather
+                            than counted (optional)
+
+    returns:
+        dictionary of table aliases, with the number of rows of each table in
+        'rows', and the number of distinct values in each of its join
+        columns in 'distinct'.  empty values aren't counted, as they never
+        join
+'''
+    if stored_statistics is None:
+        stored_statistics = {}
+
+    table_statistics = {}
+    for alias, columns in tables.items():
+        table_statistics[alias] = {'rows': batch_length(columns),
+                                   'distinct': {}}
+
+    for column_name, (alias, position) in join_columns.items():
+        if alias not in table_statistics:
+            continue
+
+        stored_table = stored_statistics.get(alias)
+        if stored_table is not None and \
+                column_name in stored_table['columns']:
+            # each distinct value is kept if any of its rows passes the
+            # filters, as if the rows were kept at random
+            rows = table_statistics[alias]['rows']
+            stored_rows = stored_table['row_count']
+            distinct = stored_table['columns'][column_name]['distinct']
+            if 0 < rows < stored_rows and distinct > 0:
+                distinct = distinct * (1 - (1 - rows / stored_rows) **
+                                       (stored_rows / distinct))
+            table_statistics[alias]['distinct'][column_name] = \
+                min(distinct, rows)
+            continue
+
+        distinct_values = set(tables[alias][position])
+        distinct_values.discard(None)
+        table_statistics[alias]['distinct'][column_name] = \
+            len(distinct_values)
+
+    return table_statistics
+
+
+def semi_join_plan(sql_tree, table_datatypes, table_sizes,
+                   table_statistics=None):
+    '''chooses the order in which the tables of a query are read, and the
+        semi-joins that filter each table as it is read.  a table that
+        joins a table read before it, which its filters or its own
+        semi-joins have made smaller, only keeps the rows whose join keys
+        are in a Bloom filter of that table's keys
+
+        tables are read from the smallest to the largest, as estimated from
+        their size and the fraction of their rows expected to pass their
+        filters, so that small, filtered tables filter the larger ones
+
+    keyword_args:
+        sql_tree - a sql tree, as generated by sql_to_tree library
+        table_datatypes - dictionary of the tables in the query, in the
+                          order of the query.  key is the table alias,
+                          value is the simplified datatypes of its columns,
+                          as returned by header_datatypes
+        table_sizes - dictionary of table aliases and the size of each
+                      table, such as the size of its file in bytes
+        table_statistics - dictionary of table aliases and the statistics
+                           of the whole table, as returned by
+                           read_table_statistics, used to estimate the
+                           fraction of its rows that pass its filters.
+                           tables without statistics are left out, or None
+                           (optional)
+
+    returns:
+        list of the table aliases in the order the tables should be read,
+        each with a list of its semi-joins.  each semi-join is a dictionary
+        of the 'build_table' and 'build_column' whose keys are kept in the
+        Bloom filter, and the 'probe_table' and 'probe_column' it filters
+'''
+    if table_statistics is None:
+        table_statistics = {}
+
+    # join columns that are in more than one table, such as those of a
+    # table that is read twice, can't be told apart
+    column_tables = {}
+    for alias, column_datatypes in table_datatypes.items():
+        for column_name in column_datatypes:
+            column_tables.setdefault(column_name, []).append(alias)
+
+    join_columns = []
+    for join in sql_tree['joins']:
+        left_tables = column_tables.get(join['left_identifier'], [])
+        right_tables = column_tables.get(join['right_identifier'], [])
+        if len(left_tables) == 1 and len(right_tables) == 1 and \
+                left_tables != right_tables:
+            join_columns.append((left_tables[0], join['left_identifier'],
+                                 right_tables[0], join['right_identifier']))
+            join_columns.append((right_tables[0], join['right_identifier'],
+                                 left_tables[0], join['left_identifier']))
+
+    # fraction of the rows of each table expected to pass its filters
+    filtered_fractions = {}
+    for alias, column_datatypes in table_datatypes.items():
+        statistics = table_statistics.get(alias)
+        filtered_fractions[alias] = 1.0
+        for filter in sql_tree['filters']:
+            filter_identifier = filter['identifier']
+            if filter_identifier not in column_datatypes or \
+                    filter['operator'] not in filter_operators:
+                continue
+            if statistics is not None and \
+                    filter_identifier in statistics['columns']:
+                filtered_fractions[alias] *= estimate_filter_selectivity(
+                    statistics['columns'][filter_identifier],
+                    statistics['row_count'],
+                    column_datatypes[filter_identifier],
+                    filter['operator'], filter['value'])
+            else:
+                filtered_fractions[alias] *= \
+                    filter_selectivities[filter['operator']]
+
+    read_order = sorted(table_datatypes, key=lambda alias:
+                        table_sizes[alias] * filtered_fractions[alias])
+
+    # each semi-join is expected to keep the same fraction of the rows of
+    # the probe table as were kept of the build table
+    kept_fractions = {}
+    plan = []
+    for alias in read_order:
+        semi_joins = []
+        kept_fractions[alias] = filtered_fractions[alias]
+        for build_table, build_column, probe_table, probe_column in \
+                join_columns:
+            if probe_table == alias and \
+                    kept_fractions.get(build_table, 1.0) < \
+                    semi_join_max_fraction:
+                semi_joins.append({'build_table': build_table,
+                                   'build_column': build_column,
+                                   'probe_table': probe_table,
+                                   'probe_column': probe_column})
+                kept_fractions[alias] *= kept_fractions[build_table]
+
+        plan.append((alias, semi_joins))
+
+    return plan
+
+
+def semi_join_statistics(bloom_filter, build_column):
+    '''reports how well a semi-join filtered a table, once the table has
+        been read.  the false positives are counted over the keys that
+        passed this filter, so rows that passed it but were dropped by a
+        later filter of the same table are still counted
+
+    keyword_args:
+        bloom_filter - BloomFilter of the build table's keys, that the rows
+                       of the probe table were checked against, holding the
+                       keys that passed in its passed_keys
+        build_column - join column of the build table
+
+    returns:
+        dictionary holding the number of rows of the probe table checked
+        against the filter, in 'rows_checked', the number it eliminated in
+        'rows_eliminated', the number of rows it passed whose keys aren't
+        in the build table in 'false_positives', and the fraction of the
+        rows checked whose keys aren't in the build table that were
+        passed, in 'false_positive_rate'
+'''
+    build_values = None
+    if numpy is not None and isinstance(build_column, array):
+        build_values = numpy.frombuffer(build_column, build_column.typecode)
+    build_keys = None
+
+    false_positives = 0
+    for passed_keys in bloom_filter.passed_keys:
+        if build_values is not None and \
+                isinstance(passed_keys, numpy.ndarray) and \
+                passed_keys.dtype.kind in 'iuf':
+            false_positives += int(
+                (~numpy.isin(passed_keys, build_values)).sum())
+            continue
+
+        if build_keys is None:
+            build_keys = set(build_column)
+            build_keys.discard(None)
+        false_positives += sum(1 for v in passed_keys
+                               if v not in build_keys)
+
+    rows_eliminated = bloom_filter.checked - bloom_filter.passed
+    false_positive_rate = 0.0
+    if rows_eliminated + false_positives > 0:
+        false_positive_rate = false_positives / \
+            (rows_eliminated + false_positives)
+
+    return {'rows_checked': bloom_filter.checked,
+            'rows_eliminated': rows_eliminated,
+            'false_positives': false_positives,
+            'false_positive_rate': false_positive_rate}
+
+
+def join_data(join, dataset, column_map, previously_joined_tables,
+              indexes=None, sorted_columns=None, memory_budget=None,
+              spill_directory=None):
+    '''executes an join on a columnar dataset.  the rows of the two tables
+    that join are found once, by column_join, and every column of the
+    joined tables is then gathered from those rows.  tables that are both
+    in ascending order of a single join column are merged instead, by
+    merge_column_join
+
+    keyword_args:
+        join: a single list element from the optimize_join_order func.  its
+              'left_identifiers' and 'right_identifiers', if it has them,
+              are the columns of a join on several columns
         dataset: a columnar dataset, expressed as a dictionary with
-                 the keys as columns and values as lists of row filter_values
+                 the keys as columns and values as lists or arrays of
+                 row values
         column_map: a list of columns mapped to tables
+        previously_joined_tables: the tables joined by the joins before
+                 this one, whose columns share their rows.  if both tables
+                 of the join have been joined already, only the rows on
+                 which their columns are equal are kept
+        indexes (optional): dictionary of join columns and their indexes,
+                 as used by column_join.  an index is only used while its
+                 table hasn't been joined, as it holds the table's rows
+        sorted_columns (optional): set of the columns whose tables are
+                 stored in their order, from their statistics.  like an
+                 index, this only holds while the table hasn't been joined.
+                 the order of other join columns is checked by is_sorted
+        memory_budget, spill_directory (optional): the memory budget of the
+                 join's hashtable, and the directory its partitions are
+                 written to if it doesn't fit, as used by column_join
 
     returns:
         result_data: a columnar dataset with this particular join applied
@@ -335,47 +2596,80 @@ def join_data(join, dataset, column_map, previously_joined_tables):
 '''
     result_data = {}
 
-    # optimize slightly by joining smaller table (left) to larger table (right)
-    try:
-        if len(dataset[join['left_identifier']]) < \
-                len(dataset[join['right_identifier']]):
-
-            left_table = column_map[join['left_identifier']][0]
-            right_table = column_map[join['right_identifier']][0]
+    left_identifiers = join.get('left_identifiers',
+                                [join['left_identifier']])
+    right_identifiers = join.get('right_identifiers',
+                                 [join['right_identifier']])
 
-            left_column = dataset[join['left_identifier']]
-            right_column = dataset[join['right_identifier']]
+    try:
+        left_table = column_map[left_identifiers[0]][0]
+        right_table = column_map[right_identifiers[0]][0]
+
+        if left_table in previously_joined_tables and \
+                right_table in previously_joined_tables:
+            left_keys = join_keys([dataset[k] for k in left_identifiers])
+            right_keys = join_keys([dataset[k] for k in right_identifiers])
+            left_rows = right_rows = array(
+                'q', (row for row, (left_key, right_key)
+                      in enumerate(zip(left_keys, right_keys))
+                      if left_key is not None and left_key == right_key))
 
         else:
-            left_table = column_map[join['right_identifier']][0]
-            right_table = column_map[join['left_identifier']][0]
-
-            left_column = dataset[join['right_identifier']]
-            right_column = dataset[join['left_identifier']]
-
-        table_joins = column_join(left_column, right_column)
+            # optimize slightly by joining smaller table (left) to larger
+            # table (right)
+            if len(dataset[left_identifiers[0]]) >= \
+                    len(dataset[right_identifiers[0]]):
+                left_table, right_table = right_table, left_table
+                left_identifiers, right_identifiers = \
+                    right_identifiers, left_identifiers
+
+            if sorted_columns is None:
+                sorted_columns = set()
+
+            merge = len(left_identifiers) == 1 and \
+                isinstance(dataset[left_identifiers[0]], array) == \
+                isinstance(dataset[right_identifiers[0]], array) and \
+                all((identifier in sorted_columns and
+                     table not in previously_joined_tables) or
+                    is_sorted(dataset[identifier])
+                    for identifier, table in
+                    [(left_identifiers[0], left_table),
+                     (right_identifiers[0], right_table)])
+
+            right_index = None
+            if not merge and indexes is not None and \
+                    len(right_identifiers) == 1 and \
+                    right_table not in previously_joined_tables:
+                right_index = indexes.get(right_identifiers[0])
+                if right_index is not None:
+                    with scan_statistics_lock:
+                        scan_statistics['index_joins'] += 1
+
+            if merge:
+                left_rows, right_rows = merge_column_join(
+                    dataset[left_identifiers[0]],
+                    dataset[right_identifiers[0]])
+            else:
+                left_rows, right_rows = column_join(
+                    [dataset[k] for k in left_identifiers],
+                    [dataset[k] for k in right_identifiers], right_index,
+                    memory_budget, spill_directory)
 
         for k, column in column_map.items():
-            result_data[k] = []
             select_table = column[0]
 
-            if select_table in [left_table, right_table] \
-                    or select_table in previously_joined_tables:
-                for left_row, right_rows in table_joins.items():
-                    for i, right_row in enumerate(right_rows):
-                        if select_table == left_table:
-                            result_data[k].append(dataset[k][left_row])
-                        elif select_table == right_table:
-                            result_data[k].append(dataset[k][right_row])
-                        elif select_table in previously_joined_tables:
-                            if left_table in previously_joined_tables:
-                                result_data[k].append(dataset[k][left_row])
-                            elif right_table in previously_joined_tables:
-                                result_data[k].append(dataset[k][right_row])
+            if select_table == left_table or \
+                    (select_table in previously_joined_tables and
+                     left_table in previously_joined_tables):
+                result_data[k] = gather_rows(dataset[k], left_rows)
+            elif select_table == right_table or \
+                    (select_table in previously_joined_tables and
+                     right_table in previously_joined_tables):
+                result_data[k] = gather_rows(dataset[k], right_rows)
             else:
                 result_data[k] = dataset[k]
     except KeyError as err:
-        print('Invalid identifier \'' + err + '\'')
+        print('Invalid identifier \'' + str(err) + '\'')
 
     return result_data
 
@@ -402,3 +2696,301 @@ if __name__ == '__main__':
 
     # print(column_join(left_column, right_column))
     print(optimize_join_order(sql_tree, join_columns))
+
+    # with statistics, the filtered customers are joined to orders first,
+    # and every join adds one table to the tables already joined
+    table_statistics = {'customer': {'rows': 10,
+                                     'distinct': {'c_custkey': 10}},
+                        'orders': {'rows': 1000,
+                                   'distinct': {'o_custkey': 100,
+                                                'o_orderkey': 1000}},
+                        'lineitem': {'rows': 4000,
+                                     'distinct': {'l_orderkey': 1000,
+                                                  'l_lineitemkey': 4000}},
+                        'roster': {'rows': 4000,
+                                   'distinct': {'r_rosterkey': 4000}}}
+    join_plan = optimize_join_order(sql_tree, join_columns, table_statistics)
+    assert [join['join_tables'] for join in join_plan] == \
+        [['customer', 'orders'], ['lineitem', 'orders'],
+         ['lineitem', 'roster']]
+    assert [join['estimated_rows'] for join in join_plan] == [100, 400, 400]
+    assert optimize_join_order({'joins': []}, {}, {'lineitem': {
+        'rows': 10, 'distinct': {}}}) == []
+
+    # joins find the rows that join as parallel arrays, on one or several
+    # columns.  empty values never join
+    assert column_join([left_column], [right_column]) == \
+        (array('q', [0, 0, 1, 1, 3, 4]), array('q', [4, 5, 4, 5, 1, 0]))
+    assert column_join([[1, 1, None, 2], ['a', 'b', 'a', 'a']],
+                       [[2, 1, 1, None], ['a', 'b', 'b', 'a']]) == \
+        (array('q', [1, 1, 3]), array('q', [1, 2, 0]))
+
+    # the hashtable is built from the smaller table, whichever side it is
+    # on, and joins that don't fit in the memory budget are partitioned on
+    # disk.  both find the same rows in the same order as a hashtable of
+    # the right table
+    import random
+    random.seed(1)
+    for left_count, right_count in [(3000, 3000), (300, 3000), (3000, 300)]:
+        join_tables = [[array('q', (random.randrange(500)
+                                    for i in range(row_count))),
+                        [random.choice([None, 'a', 'b'])
+                         for i in range(row_count)]]
+                       for row_count in [left_count, right_count]]
+        join_tables[1][0] = array('d', join_tables[1][0])
+        for join_columns in [[0], [0, 1], [1]]:
+            left_columns = [join_tables[0][k] for k in join_columns]
+            right_columns = [join_tables[1][k] for k in join_columns]
+            expected_rows = probe_hashtable(
+                build_hashtable(join_keys(right_columns)),
+                join_keys(left_columns))
+            assert column_join(left_columns, right_columns) == expected_rows
+            clear_scan_statistics()
+            assert column_join(left_columns, right_columns, None,
+                               hashtable_row_bytes * 1000,
+                               tempfile.mkdtemp()) == expected_rows
+            assert scan_statistics['partitioned_joins'] == \
+                (min(left_count, right_count) > 1000)
+
+    # dense integer keys are looked up in an array indexed by the key, and
+    # find the same rows in the same order as the hashtable
+    right_column = array('q', [7, 3, 5, 3, 9, 7, 7])
+    for left_column in [array('q', [3, 1, 7, 9, 10, 3, -2]),
+                        array('q', [4]), array('q')]:
+        expected_rows = probe_hashtable(build_hashtable(right_column),
+                                        left_column)
+        clear_scan_statistics()
+        assert column_join([left_column], [right_column]) == expected_rows
+        assert scan_statistics['direct_joins'] == (numpy is not None)
+    assert direct_lookup(array('q', [1]), array('q', [1, 100])) is None
+
+    # columns in ascending order are merged, and find the same rows in the
+    # same order as the hashtable
+    for left_column, right_column in [
+            (array('q', [1, 2, 2, 4, 7, 9]),
+             array('q', [0, 2, 2, 2, 4, 8, 9])),
+            (array('d', [1.5, 2.0]), array('q', [1, 2, 2])),
+            (['a', 'b', 'b', 'd'], ['b', 'c', 'd', 'd']),
+            (array('q'), array('q', [1]))]:
+        assert merge_column_join(left_column, right_column) == \
+            probe_hashtable(build_hashtable(right_column), left_column)
+    assert list(merge_join_rows(iter([1, 3, 3, 5]), iter([3, 3, 4, 5]))) == \
+        [(1, [0, 1]), (2, [0, 1]), (3, [3])]
+
+    clear_scan_statistics()
+    merge_dataset = {'o_orderkey': array('q', [1, 2, 3, 4]),
+                     'o_custkey': array('q', [5, 6, 5, 7]),
+                     'l_orderkey': array('q', [1, 1, 3, 4, 4, 4])}
+    merge_columns = {'o_orderkey': ('orders', 0), 'o_custkey': ('orders', 1),
+                     'l_orderkey': ('lineitem', 0)}
+    merged_data = join_data({'left_identifier': 'o_orderkey',
+                             'right_identifier': 'l_orderkey'},
+                            merge_dataset, merge_columns, set())
+    assert scan_statistics['merge_joins'] == 1
+    assert merged_data['o_custkey'] == array('q', [5, 5, 5, 7, 7, 7])
+    assert merged_data['l_orderkey'] == merged_data['o_orderkey']
+    assert direct_lookup(array('q', [1]), array('d', [1, 2])) is None
+
+    # joins between the same two tables are combined, and joins between
+    # tables that have already been joined keep the rows that match
+    sql_tree['joins'] = [{'left_identifier': 'a_key',
+                          'right_identifier': 'b_key', 'join_type': ''},
+                         {'left_identifier': 'c_key',
+                          'right_identifier': 'b_key', 'join_type': ''},
+                         {'left_identifier': 'b_line',
+                          'right_identifier': 'a_line', 'join_type': ''},
+                         {'left_identifier': 'c_value',
+                          'right_identifier': 'a_value', 'join_type': ''}]
+    join_columns = {'a_key': ('a', 0), 'a_line': ('a', 1),
+                    'a_value': ('a', 2), 'b_key': ('b', 0),
+                    'b_line': ('b', 1), 'c_key': ('c', 0),
+                    'c_value': ('c', 1)}
+    dataset = {'a_key': array('q', [1, 1, 2, 2]),
+               'a_line': array('q', [1, 2, 1, 2]),
+               'a_value': ['x', 'y', 'x', 'y'],
+               'b_key': array('q', [2, 1, 1]),
+               'b_line': array('q', [2, 2, 1]),
+               'c_key': array('q', [1, 2]),
+               'c_value': ['x', None]}
+    join_plan = optimize_join_order(sql_tree, join_columns)
+    assert len(join_plan) == 3
+    assert join_plan[0]['left_identifiers'] == ['a_key', 'a_line']
+    assert join_plan[0]['right_identifiers'] == ['b_key', 'b_line']
+
+    previously_joined_tables = set()
+    for join in join_plan:
+        dataset = join_data(join, dataset, join_columns,
+                            previously_joined_tables)
+        previously_joined_tables.update(join['join_tables'])
+    assert dataset == {'a_key': array('q', [1]), 'a_line': array('q', [1]),
+                       'a_value': ['x'], 'b_key': array('q', [1]),
+                       'b_line': array('q', [1]), 'c_key': array('q', [1]),
+                       'c_value': ['x']}
+
+    # rows must pass every filter, and are only kept once
+    data_lines = ['o_orderkey,o_orderdate,o_orderstatus\n',
+                  '1,1997-01-02,F\n', '2,1998-03-04,F\n',
+                  '3,1996-05-06,O\n', '4,,F\n']
+    header_lines = ['o_orderkey INTEGER,o_orderdate DATE,'
+                    'o_orderstatus CHAR(1)\n']
+    sql_tree['filters'] = [{'identifier': 'o_orderdate', 'operator': '<',
+                            'value': "'1997-12-31'"},
+                           {'identifier': 'o_orderstatus', 'operator': '=',
+                            'value': "'F'"}]
+    for scan_engine in ['python', 'numpy']:
+        column_positions, column_datatypes, file_data = \
+            csv_to_data_structure(data_lines, header_lines, sql_tree,
+                                  scan_engine)
+        assert list(file_data[0]) == [1]
+
+    # empty dates never pass, and empty CHAR values are compared as strings
+    empty_filters = {'filters': [{'identifier': 'o_orderdate',
+                                  'operator': '!=', 'value': "'1997-01-02'"},
+                                 {'identifier': 'o_orderstatus',
+                                  'operator': '<', 'value': "'O'"}]}
+    for scan_engine in ['python', 'numpy']:
+        column_positions, column_datatypes, file_data = \
+            csv_to_data_structure(data_lines[:3] + ['3,1996-05-06,\n'] +
+                                  data_lines[4:], header_lines,
+                                  empty_filters, scan_engine)
+        assert list(file_data[0]) == [2, 3]
+
+    # zone maps skip blocks that can't pass the filters, without changing
+    # which rows are read
+    local_filename = os.path.join(tempfile.mkdtemp(), 'tcph_orders')
+    with open(local_filename, 'w') as lfile:
+        lfile.writelines(data_lines[:1] +
+                         [data_lines[3], data_lines[1], data_lines[2],
+                          data_lines[4]] * 3)
+    with open(local_filename + '_header', 'w') as lfile_header:
+        lfile_header.writelines(header_lines)
+
+    expected_data = file_to_data_structure(local_filename, sql_tree)
+    zone_maps = write_zone_maps(local_filename, block_size=2)
+    assert zone_maps['blocks'][1]['zones'] == {'o_orderkey': [2, 4],
+                                               'o_orderdate': [729452,
+                                                               729452]}
+    clear_scan_statistics()
+    for scan_engine in ['python', 'numpy']:
+        assert file_to_data_structure(local_filename, sql_tree,
+                                      scan_engine) == expected_data
+    assert scan_statistics['blocks_scanned'] == 6
+    assert scan_statistics['blocks_skipped'] == 6
+
+    # statistics estimate how many rows pass each filter, which changes
+    # the order the filters are checked in but not the rows that are read
+    table_statistics = write_table_statistics(local_filename)
+    assert read_table_statistics(local_filename) == table_statistics
+
+    # the statistics and zone maps of an object are kept when it is
+    # downloaded again, and collected again, in the same pass, when it
+    # changes
+    zone_maps = write_zone_maps(local_filename)
+    assert refresh_table_statistics(local_filename, '"1"') == \
+        {**table_statistics, 'etag': '"1"'}
+    assert read_zone_maps(local_filename, '"1"')['blocks'] == \
+        zone_maps['blocks']
+    os.utime(local_filename, ns=(0, 0))
+    assert read_table_statistics(local_filename) is None
+    assert read_zone_maps(local_filename) is None
+    assert read_table_statistics(local_filename, '"1"') is not None
+    assert refresh_table_statistics(local_filename, '"1"')['modified'] == 0
+    assert read_table_statistics(local_filename)['modified'] == 0
+    assert read_zone_maps(local_filename)['modified'] == 0
+    assert read_table_statistics(local_filename, '"2"') is None
+    assert refresh_table_statistics(local_filename, '"2"')['etag'] == '"2"'
+    assert read_zone_maps(local_filename, '"2"')['etag'] == '"2"'
+    assert table_statistics['row_count'] == 12
+    assert table_statistics['columns']['o_orderdate']['nulls'] == 3
+    assert table_statistics['columns']['o_orderkey']['distinct'] == 4
+
+    column_positions, column_datatypes, file_data = \
+        file_to_data_structure(local_filename)
+    estimates = [estimate_filter_selectivity(
+        table_statistics['columns'][identifier], 12,
+        column_datatypes[identifier], filter_operator, filter_value)
+        for identifier, filter_operator, filter_value in
+        [('o_orderkey', '=', '2'), ('o_orderkey', '=', '5'),
+         ('o_orderdate', '>', "'1998-12-31'"),
+         ('o_orderdate', '<', "'1997-12-31'")]]
+    assert estimates[:3] == [0.25, 0, 0]
+    assert abs(estimates[3] - 0.5) < 0.1
+
+    filters = [{'identifier': 'o_orderdate', 'operator': '<',
+                'value': "'1997-12-31'"},
+               {'identifier': 'o_orderstatus', 'operator': '!=',
+                'value': "'O'"}]
+    assert rank_filters(filters, column_positions,
+                        column_datatypes) == filters
+    assert rank_filters(filters, column_positions, column_datatypes,
+                        table_statistics) == filters[::-1]
+    sql_tree['filters'] = filters
+    with open(local_filename) as lfile:
+        expected_data = csv_to_data_structure(lfile, header_lines, sql_tree)
+    assert file_to_data_structure(local_filename, sql_tree) == expected_data
+    assert list(expected_data[2][0]) == [1, 1, 1]
+
+    # semi-join filters drop the rows whose join keys aren't in a Bloom
+    # filter of another table's keys, as the file is read
+    from bloom_filter import BloomFilter
+    sql_tree['filters'] = []
+    for scan_engine in ['python', 'numpy']:
+        bloom_filter = BloomFilter(2)
+        bloom_filter.add(array('q', [1, 3]))
+        sql_tree['semi_join_filters'] = [{'identifier': 'o_orderkey',
+                                          'bloom_filter': bloom_filter}]
+        column_positions, column_datatypes, file_data = \
+            file_to_data_structure(local_filename, sql_tree, scan_engine)
+        assert list(file_data[0]) == [3, 1] * 3
+        assert semi_join_statistics(bloom_filter, array('q', [1, 3])) == \
+            {'rows_checked': 12, 'rows_eliminated': 6,
+             'false_positives': 0, 'false_positive_rate': 0.0}
+
+    # each filter's false positives are counted over the rows it passed,
+    # even when a later filter of the same table drops them.  key 3 stands
+    # in for a false positive of the o_orderkey filter, and the
+    # o_orderdate filter drops its rows
+    build_dates = array('q', [date_to_ordinal('1997-01-02'),
+                              date_to_ordinal('1998-03-04')])
+    for scan_engine in ['python', 'numpy']:
+        key_filter = BloomFilter(3)
+        key_filter.add(array('q', [1, 2, 3]))
+        date_filter = BloomFilter(2)
+        date_filter.add(build_dates)
+        sql_tree['semi_join_filters'] = [{'identifier': 'o_orderkey',
+                                          'bloom_filter': key_filter},
+                                         {'identifier': 'o_orderdate',
+                                          'bloom_filter': date_filter}]
+        column_positions, column_datatypes, file_data = \
+            file_to_data_structure(local_filename, sql_tree, scan_engine)
+        assert list(file_data[0]) == [1, 2] * 3
+        assert semi_join_statistics(key_filter, array('q', [1, 2])) == \
+            {'rows_checked': 12, 'rows_eliminated': 3,
+             'false_positives': 3, 'false_positive_rate': 0.5}
+        assert semi_join_statistics(date_filter, build_dates) == \
+            {'rows_checked': 9, 'rows_eliminated': 3,
+             'false_positives': 0, 'false_positive_rate': 0.0}
+    del sql_tree['semi_join_filters']
+
+    # the filtered customers are read first, and filter the orders, which
+    # filter the lineitems
+    sql_tree = {'joins': [{'left_identifier': 'l_orderkey',
+                           'right_identifier': 'o_orderkey'},
+                          {'left_identifier': 'c_custkey',
+                           'right_identifier': 'o_custkey'}],
+                'filters': [{'identifier': 'c_mktsegment', 'operator': '=',
+                             'value': "'BUILDING'"}]}
+    table_datatypes = {'lineitem': {'l_orderkey': 'NUMBER'},
+                       'orders': {'o_orderkey': 'NUMBER',
+                                  'o_custkey': 'NUMBER'},
+                       'customer': {'c_custkey': 'NUMBER',
+                                    'c_mktsegment': 'CHAR'}}
+    assert semi_join_plan(sql_tree, table_datatypes,
+                          {'lineitem': 7000, 'orders': 1500,
+                           'customer': 2000}) == \
+        [('customer', []),
+         ('orders', [{'build_table': 'customer', 'build_column': 'c_custkey',
+                      'probe_table': 'orders', 'probe_column': 'o_custkey'}]),
+         ('lineitem', [{'build_table': 'orders', 'build_column': 'o_orderkey',
+                        'probe_table': 'lineitem',
+                        'probe_column': 'l_orderkey'}])]
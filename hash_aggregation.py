@@ -0,0 +1,256 @@
+#!/usr/bin/python
+from array import array
+from itertools import repeat
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class HashAggregation:
+    '''groups the rows of a table and aggregates each group, a batch of rows
+        at a time, in a single pass over the rows.  each group's values are
+        kept as a tuple in a hashtable, which numbers the groups in the order
+        they first appear, and every aggregate keeps a running accumulator
+        for each group, indexed by its number: a count of rows, a set of the
+        values counted, a total and a count of values for sum and avg, or
+        the smallest or largest value.  empty values (None) are ignored
+
+        with numpy, the accumulators of typed columns are updated a column
+        at a time.  totals are added in row order, as they are without
+        numpy, so both give the same results
+'''
+
+    def __init__(self, grouping_positions, aggregate_functions):
+        '''keyword_args:
+            grouping_positions - positions of the group by columns in each
+                                 batch
+            aggregate_functions - list of (function, position) tuples, such
+                                  as ('sum', 4).  position is None for
+                                  count(*)
+'''
+        self.grouping_positions = grouping_positions
+        self.aggregate_functions = aggregate_functions
+        self.group_numbers = {}
+
+        self.totals = [[] for aggregate in aggregate_functions]
+        self.counts = [[] for aggregate in aggregate_functions]
+
+    def add_batch(self, batch):
+        '''adds a batch of rows to the aggregates
+
+        keyword_args:
+            batch - list of columns, as generated by csv_to_data_batches
+'''
+        group_numbers = self.group_numbers
+        number_group = group_numbers.setdefault
+        grouping_columns = [batch[position]
+                            for position in self.grouping_positions]
+
+        if len(grouping_columns) > 0:
+            groups = zip(*grouping_columns)
+        else:
+            batch_rows = 0
+            for column in batch:
+                if column is not None:
+                    batch_rows = len(column)
+                    break
+            groups = repeat((), batch_rows)
+
+        # a new group is numbered after the groups before it
+        row_groups = array('q', [number_group(group, len(group_numbers))
+                                 for group in groups])
+
+        for i, (function, position) in enumerate(self.aggregate_functions):
+            new_groups = len(group_numbers) - len(self.totals[i])
+            if function == 'count' and position is not None:
+                self.totals[i].extend(set() for group in range(new_groups))
+            elif function in ['min', 'max']:
+                self.totals[i].extend(repeat(None, new_groups))
+            else:
+                self.totals[i].extend(repeat(0, new_groups))
+            self.counts[i].extend(repeat(0, new_groups))
+
+        if len(row_groups) == 0:
+            return
+
+        batch_groups = None
+        for i, (function, position) in enumerate(self.aggregate_functions):
+            totals = self.totals[i]
+            counts = self.counts[i]
+
+            if position is None:
+                if function == 'count':
+                    for group in row_groups:
+                        totals[group] += 1
+                continue
+
+            column = batch[position]
+            if function == 'count':
+                for group, value in zip(row_groups, column):
+                    if value is not None:
+                        totals[group].add(value)
+                continue
+
+            if numpy is not None and isinstance(column, array):
+                # the accumulators of the batch hold every group, or if
+                # there are more groups than rows, the groups of the batch
+                # numbered again from 0
+                if batch_groups is None:
+                    batch_rows = numpy.frombuffer(row_groups, numpy.int64)
+                    if len(group_numbers) <= len(row_groups):
+                        batch_groups = list(range(len(group_numbers)))
+                    else:
+                        batch_groups, batch_rows = numpy.unique(
+                            batch_rows, return_inverse=True)
+                        batch_groups = batch_groups.tolist()
+                    value_counts = numpy.bincount(
+                        batch_rows, minlength=len(batch_groups)).tolist()
+
+                values = numpy.frombuffer(column, column.typecode)
+                if function in ['sum', 'avg']:
+                    batch_totals = numpy.array(
+                        [totals[group] for group in batch_groups],
+                        values.dtype)
+                    numpy.add.at(batch_totals, batch_rows, values)
+                    for group, total, value_count in zip(
+                            batch_groups, batch_totals.tolist(),
+                            value_counts):
+                        if value_count > 0:
+                            totals[group] = total
+                            counts[group] += value_count
+                else:
+                    if values.dtype.kind == 'f':
+                        limits = numpy.finfo(values.dtype)
+                    else:
+                        limits = numpy.iinfo(values.dtype)
+                    extremes = numpy.full(
+                        len(batch_groups),
+                        limits.max if function == 'min' else limits.min,
+                        values.dtype)
+                    if function == 'min':
+                        numpy.minimum.at(extremes, batch_rows, values)
+                    else:
+                        numpy.maximum.at(extremes, batch_rows, values)
+                    self.update_extremes(
+                        function, totals,
+                        [group for group, value_count
+                         in zip(batch_groups, value_counts) if value_count],
+                        [extreme for extreme, value_count
+                         in zip(extremes.tolist(), value_counts)
+                         if value_count])
+                continue
+
+            if function in ['sum', 'avg']:
+                for group, value in zip(row_groups, column):
+                    if value is not None:
+                        totals[group] += value
+                        counts[group] += 1
+            else:
+                self.update_extremes(function, totals, row_groups, column)
+
+    def update_extremes(self, function, totals, groups, values):
+        '''keeps the smallest or largest value of each group
+
+        keyword_args:
+            function - 'min' or 'max'
+            totals - the smallest or largest value of each group so far
+            groups, values - the group number and the value of each row
+'''
+        for group, value in zip(groups, values):
+            if value is None:
+                continue
+            total = totals[group]
+            if total is None or \
+                    (value < total if function == 'min' else value > total):
+                totals[group] = value
+
+    def results(self):
+        '''returns the aggregates of the rows added so far
+
+        returns:
+            groups - list of the distinct group by values, as tuples, in the
+                     order they first appear
+            aggregates - a list of values for each aggregate function, in
+                         the same order as groups.  an aggregate of a group
+                         with no values is None, and a count is 0
+'''
+        aggregates = []
+        for i, (function, position) in enumerate(self.aggregate_functions):
+            totals = self.totals[i]
+            counts = self.counts[i]
+
+            if function == 'count':
+                if position is None:
+                    aggregates.append(list(totals))
+                else:
+                    aggregates.append([len(total) for total in totals])
+            elif function == 'sum':
+                aggregates.append([total if count else None
+                                   for total, count in zip(totals, counts)])
+            elif function == 'avg':
+                aggregates.append([total / count if count else None
+                                   for total, count in zip(totals, counts)])
+            else:
+                aggregates.append(list(totals))
+
+        return list(self.group_numbers), aggregates
+
+
+if __name__ == '__main__':
+
+    # unit tests
+    batches = [[['A', 'B', 'A', 'A'], array('q', [1, 2, 3, 4]),
+                array('d', [0.5, 1.5, 2.5, 3.5]), [1, None, 1, 7],
+                ['x', 'y', 'x', 'z']],
+               [['B', 'C', 'A'], [None, 5, 6], array('d', [1.0, 2.0, 0.1]),
+                array('q', [2, 3, 1]), ['y', 'w', 'v']]]
+    aggregate_functions = [('count', None), ('sum', 1), ('avg', 2),
+                           ('min', 3), ('max', 3), ('count', 4),
+                           ('sum', 3), ('max', 4)]
+
+    aggregation = HashAggregation([0], aggregate_functions)
+    for batch in batches:
+        aggregation.add_batch(batch)
+    groups, aggregates = aggregation.results()
+
+    assert groups == [('A',), ('B',), ('C',)]
+    assert aggregates == [[4, 2, 1], [14, 2, 5],
+                          [(0.5 + 2.5 + 3.5 + 0.1) / 4, 2.5 / 2, 2.0],
+                          [1, 2, 3], [7, 2, 3], [3, 1, 1], [10, 2, 3],
+                          ['z', 'y', 'w']]
+
+    # totals are added in row order, whether or not numpy is used, so
+    # floats have the same rounding as a sum of the values in row order
+    values = array('d', [0.1 * i for i in range(1000)])
+    aggregation = HashAggregation([0], [('sum', 1), ('avg', 1)])
+    aggregation.add_batch([[i % 3 for i in range(1000)], values])
+    groups, aggregates = aggregation.results()
+    assert aggregates[0] == [sum(values[group::3]) for group in range(3)]
+
+    # groups on several columns, and no group by columns
+    aggregation = HashAggregation([0, 1], [('count', None), ('min', 2)])
+    aggregation.add_batch([array('q', [1, 1, 2]), ['a', 'a', 'a'],
+                           [None, None, 4.5]])
+    assert aggregation.results() == ([(1, 'a'), (2, 'a')],
+                                     [[2, 1], [None, 4.5]])
+    aggregation = HashAggregation([], [('count', None), ('sum', 0)])
+    aggregation.add_batch([array('q', [1, 2, 3])])
+    assert aggregation.results() == ([()], [[3], [6]])
+
+    # batches with more groups than rows
+    aggregation = HashAggregation([0], [('max', 1), ('sum', 1)])
+    aggregation.add_batch([array('q', [1, 2, 3, 4]), array('d', [1, 2, 3, 4])])
+    aggregation.add_batch([array('q', [4, 5]), array('d', [-1, 7])])
+    assert aggregation.results() == ([(1,), (2,), (3,), (4,), (5,)],
+                                     [[1, 2, 3, 4, 7], [1, 2, 3, 3, 7]])
+
+    # strings can't be added
+    aggregation = HashAggregation([0], [('sum', 0)])
+    try:
+        aggregation.add_batch([['a', 'b']])
+        assert False
+    except TypeError:
+        pass
+
+    print('hash aggregation unit tests passed')
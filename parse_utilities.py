@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import sqlparse
+from sqlparse.sql import Statement
 from sqlparse.tokens import DML
 
 
@@ -22,6 +23,24 @@ def is_subselect(parsed):
     return False
 
 
+def parse_statement(sql):
+    '''parses SQL text into a single sqlparse statement, so that it can be
+        shared by all of the extract functions instead of each of them
+        parsing the same text again
+
+        keyword args:
+            sql - a string containing a SQL statement, or a statement
+                  that has already been parsed by this function
+
+        returns:
+            the first sqlparse Statement in the SQL text
+    '''
+
+    if isinstance(sql, Statement):
+        return sql
+    return sqlparse.parse(sql)[0]
+
+
 if __name__ == '__main__':
 
     sql = """select c.customer_name, o.order_date
@@ -0,0 +1,382 @@
+#!/usr/bin/python
+import json
+import os
+import shutil
+import threading
+import time
+from botocore.exceptions import ClientError
+from columnar_cache import columnar_bytes, remove_columnar_layouts
+from s3_range_download import read_s3_ranges, default_part_size, \
+                              default_range_workers
+
+# default size limit for a cache directory - 10 GB
+default_cache_max_bytes = 10 * 1024 ** 3
+
+# open caches, so that every query against a directory shares one index
+open_caches = {}
+open_caches_lock = threading.Lock()
+
+
+class S3FileCache:
+    '''a size-bounded cache of S3 objects in a local directory
+
+        every lookup revalidates the cached copy with a conditional request
+        (If-None-Match on the object's ETag), so the body of an object is
+        only downloaded when it has changed.  the columnar layouts, indexes
+        and zone maps written for a cached object are counted in its size.
+        when the cache grows past its size limit, the least recently used
+        objects are removed along with them, apart from the objects that
+        queries have pinned while they read them.  the cache may stay over
+        its limit until those are released
+
+        the cache index is kept in cache_index.json in the cache directory,
+        so cached objects are reused across runs
+'''
+
+    index_filename = 'cache_index.json'
+
+    def __init__(self, cache_directory, max_bytes=default_cache_max_bytes):
+        '''keyword_args:
+            cache_directory - local directory to store cached objects in.
+                              created if it doesn't exist
+            max_bytes - size limit for the cached objects, in bytes
+'''
+        self.cache_directory = cache_directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        # number of times each cached object is pinned, by cache key
+        self.pins = {}
+
+        os.makedirs(cache_directory, exist_ok=True)
+
+        self.index = {}
+        try:
+            with open(os.path.join(cache_directory, self.index_filename)) \
+                    as index_file:
+                self.index = json.load(index_file)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def local_filename(self, bucket, s3_filename):
+        '''returns the name of the local copy of an S3 object
+
+        keyword_args:
+            bucket - name of S3 bucket holding the object
+            s3_filename - key of the object in the bucket
+'''
+        return os.path.join(self.cache_directory,
+                            bucket + '_' + s3_filename.replace('/', '_'))
+
+    def retrieve(self, s3, bucket, s3_filename, part_size=default_part_size,
+                 range_workers=default_range_workers, pins=None):
+        '''returns a local copy of an S3 object, downloading it only if it
+            isn't cached or has changed since it was cached
+
+        keyword_args:
+            s3 - boto3 S3 client
+            bucket - name of S3 bucket holding the object
+            s3_filename - key of the object in the bucket
+            part_size - objects larger than this are downloaded as
+                        concurrent byte ranges of this size (optional)
+            range_workers - number of byte ranges to download at once
+                            (optional)
+            pins - list that the cache key of the object is added to.  the
+                   object is then pinned, so that it isn't evicted, until
+                   the list is given to release (optional)
+
+        returns:
+            name of the cached file on the local filesystem
+'''
+        cache_key = bucket + '/' + s3_filename
+        local_filename = self.local_filename(bucket, s3_filename)
+
+        with self.lock:
+            entry = self.index.get(cache_key)
+        if entry is not None and not os.path.exists(local_filename):
+            entry = None
+
+        try:
+            if entry is not None:
+                response = s3.get_object(Bucket=bucket, Key=s3_filename,
+                                         IfNoneMatch=entry['etag'])
+            else:
+                response = s3.get_object(Bucket=bucket, Key=s3_filename)
+
+        except ClientError as ce:
+            if entry is None or \
+                    ce.response['Error']['Code'] not in ('304', 'NotModified'):
+                raise
+            # not modified, so the cached copy can be used as is,
+            # unless it was evicted in the meantime
+            with self.lock:
+                if self.index.get(cache_key) is entry:
+                    self.hits += 1
+                    entry['last_used'] = time.time()
+                    self.pin(cache_key, pins)
+                    self.save_index()
+                    return local_filename
+            response = s3.get_object(Bucket=bucket, Key=s3_filename)
+
+        # download to a temporary file first, so that an interrupted
+        # download never leaves a partial object in the cache
+        temporary_filename = local_filename + '.' + \
+            str(threading.get_ident()) + '.download'
+        with open(temporary_filename, 'wb') as local_file:
+            if response['ContentLength'] > part_size:
+                response['Body'].close()
+                for range_data in read_s3_ranges(
+                        s3, bucket, s3_filename, response['ContentLength'],
+                        response['ETag'], part_size, range_workers):
+                    local_file.write(range_data)
+            else:
+                shutil.copyfileobj(response['Body'], local_file, 1024 * 1024)
+        os.replace(temporary_filename, local_filename)
+
+        # layouts of the previous version stay until the new one is written
+        layout_bytes = columnar_bytes(local_filename)
+        with self.lock:
+            self.misses += 1
+            self.index[cache_key] = {'filename': local_filename,
+                                     'etag': response['ETag'],
+                                     'size': os.path.getsize(local_filename),
+                                     'layout_size': layout_bytes,
+                                     'last_used': time.time()}
+            self.pin(cache_key, pins)
+            self.evict(cache_key)
+            self.save_index()
+
+        return local_filename
+
+    def etag(self, bucket, s3_filename):
+        '''returns the ETag of the cached copy of an S3 object,
+            or None if it isn't cached
+'''
+        with self.lock:
+            entry = self.index.get(bucket + '/' + s3_filename)
+        if entry is None:
+            return None
+        return entry['etag']
+
+    def count_layout_bytes(self, bucket, s3_filename):
+        '''counts the bytes of the columnar layouts, indexes and zone maps
+            kept for a cached object in its size, once they are written, and
+            removes least recently used objects if the cache has grown past
+            its size limit
+
+        keyword_args:
+            bucket - name of S3 bucket holding the object
+            s3_filename - key of the object in the bucket
+'''
+        layout_bytes = columnar_bytes(self.local_filename(bucket,
+                                                          s3_filename))
+        with self.lock:
+            entry = self.index.get(bucket + '/' + s3_filename)
+            if entry is None:
+                return
+            entry['layout_size'] = layout_bytes
+            self.evict()
+            self.save_index()
+
+    def pin(self, cache_key, pins):
+        '''pins a cached object, if a list of pins is given, and adds its
+            cache key to the list.  must be called with the lock held
+'''
+        if pins is not None:
+            self.pins[cache_key] = self.pins.get(cache_key, 0) + 1
+            pins.append(cache_key)
+
+    def release(self, pins):
+        '''unpins the objects pinned by retrieve, and removes least recently
+            used objects if the cache has grown past its size limit while
+            they were pinned
+
+        keyword_args:
+            pins - list of cache keys, as given to retrieve
+'''
+        with self.lock:
+            for cache_key in pins:
+                self.pins[cache_key] -= 1
+                if self.pins[cache_key] == 0:
+                    del self.pins[cache_key]
+            del pins[:]
+            self.evict()
+            self.save_index()
+
+    def evict(self, keep_key=None):
+        '''removes least recently used objects until the cache is within its
+            size limit.  pinned objects are never removed, so the cache may
+            stay over its limit.  must be called with the lock held
+
+        keyword_args:
+            keep_key - cache key of an object that must not be removed,
+                       as it has just been added (optional)
+'''
+        total_bytes = sum(entry_bytes(entry)
+                          for entry in self.index.values())
+
+        for cache_key, entry in sorted(self.index.items(),
+                                       key=lambda i: i[1]['last_used']):
+            if total_bytes <= self.max_bytes:
+                break
+            if cache_key == keep_key or cache_key in self.pins:
+                continue
+            try:
+                os.remove(entry['filename'])
+            except FileNotFoundError:
+                pass
+            remove_columnar_layouts(entry['filename'])
+            total_bytes -= entry_bytes(entry)
+            del self.index[cache_key]
+            self.evictions += 1
+
+    def save_index(self):
+        '''writes the cache index to disk.  must be called with the lock held
+'''
+        index_filename = os.path.join(self.cache_directory,
+                                      self.index_filename)
+        with open(index_filename + '.tmp', 'w') as index_file:
+            json.dump(self.index, index_file)
+        os.replace(index_filename + '.tmp', index_filename)
+
+    def statistics(self):
+        '''returns a dictionary of the cache's hit, miss and eviction counts,
+            along with the number and total size of the cached objects
+'''
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'objects': len(self.index),
+                    'bytes': sum(entry_bytes(entry)
+                                 for entry in self.index.values())}
+
+
+def entry_bytes(entry):
+    '''returns the bytes taken by a cached object, along with its columnar
+        layouts, indexes and zone maps
+'''
+    return entry['size'] + entry.get('layout_size', 0)
+
+
+def open_s3_file_cache(cache_directory, max_bytes=default_cache_max_bytes):
+    '''returns the S3FileCache for a directory, creating it the first time,
+        so that its index and statistics are shared by all queries
+
+    keyword_args:
+        cache_directory - local directory to store cached objects in
+        max_bytes - size limit for the cached objects, in bytes
+'''
+    with open_caches_lock:
+        cache_directory = os.path.abspath(cache_directory)
+        if cache_directory not in open_caches:
+            open_caches[cache_directory] = \
+                S3FileCache(cache_directory, max_bytes)
+        cache = open_caches[cache_directory]
+        cache.max_bytes = max_bytes
+
+    return cache
+
+
+if __name__ == '__main__':
+
+    # unit tests, against a local S3 stand-in
+    import tempfile
+    import boto3
+    from columnar_cache import columnar_directory
+    from moto import mock_aws
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    with mock_aws():
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='virtual-data-layer')
+        for name in ['a', 'b', 'c']:
+            s3.put_object(Bucket='virtual-data-layer', Key='tcph/' + name,
+                          Body=name.encode() * 100)
+
+        cache = S3FileCache(tempfile.mkdtemp(), max_bytes=250)
+
+        cache.retrieve(s3, 'virtual-data-layer', 'tcph/a')
+        cache.retrieve(s3, 'virtual-data-layer', 'tcph/a')
+        assert cache.statistics()['hits'] == 1
+        assert cache.statistics()['misses'] == 1
+
+        # changed objects are downloaded again
+        s3.put_object(Bucket='virtual-data-layer', Key='tcph/a',
+                      Body=b'z' * 100)
+        with open(cache.retrieve(s3, 'virtual-data-layer', 'tcph/a')) as f:
+            assert f.read() == 'z' * 100
+        assert cache.statistics()['misses'] == 2
+
+        # a is least recently used, so it is evicted to make room for c
+        cache.retrieve(s3, 'virtual-data-layer', 'tcph/b')
+        cache.retrieve(s3, 'virtual-data-layer', 'tcph/c')
+        assert cache.statistics()['evictions'] == 1
+        assert cache.etag('virtual-data-layer', 'tcph/a') is None
+
+        # the index is reloaded from disk
+        assert S3FileCache(cache.cache_directory, 250).index == cache.index
+
+        # pinned objects are kept while the cache is over its limit, until
+        # they are released
+        pins = []
+        for name in ['a', 'b', 'c']:
+            cache.retrieve(s3, 'virtual-data-layer', 'tcph/' + name,
+                           pins=pins)
+        assert cache.statistics()['bytes'] == 300
+        assert all(os.path.exists(cache.local_filename(
+            'virtual-data-layer', 'tcph/' + name)) for name in 'abc')
+        cache.release(pins)
+        assert cache.statistics()['bytes'] == 200
+        assert cache.pins == {} and pins == []
+
+        # a query whose tables don't fit in the cache keeps them until it
+        # has been executed
+        from sql_to_tree import sql_to_tree
+        from virtual_S3_module import execute_sqltree_on_s3
+
+        for name, header, rows in [
+                ('customer', 'c_custkey INTEGER,c_mktsegment VARCHAR(10)',
+                 [str(i) + ',' + ['BUILDING', 'MACHINERY'][i % 2]
+                  for i in range(200)]),
+                ('orders', 'o_orderkey INTEGER,o_custkey INTEGER',
+                 [str(i) + ',' + str(i % 200) for i in range(1000)])]:
+            s3.put_object(Bucket='virtual-data-layer', Key='tcph/' + name,
+                          Body='\n'.join([header.replace(' INTEGER', '')
+                                          .replace(' VARCHAR(10)', '')] +
+                                         rows).encode())
+            s3.put_object(Bucket='virtual-data-layer',
+                          Key='tcph/' + name + '_header',
+                          Body=header.encode())
+        query_sql = '''select c_custkey, o_orderkey
+                       from tcph.customer, tcph.orders
+                       where c_custkey = o_custkey
+                       and c_mktsegment = 'BUILDING'
+                       order by o_orderkey'''
+
+        cache = S3FileCache(tempfile.mkdtemp(), max_bytes=1000)
+        for i in range(2):
+            selection_headers, ordered_data = execute_sqltree_on_s3(
+                'virtual-data-layer', sql_to_tree(query_sql), cache)
+            assert ordered_data == [(i % 200, i) for i in range(0, 1000, 2)]
+        assert cache.statistics()['bytes'] <= 1000
+        assert cache.pins == {}
+
+        # the columnar layouts and indexes of cached tables are counted in
+        # the size of the cache
+        cache = S3FileCache(tempfile.mkdtemp())
+        execute_sqltree_on_s3('virtual-data-layer', sql_to_tree(query_sql),
+                              cache, index_columns={'o_custkey'})
+        assert os.path.isdir(columnar_directory(cache.local_filename(
+            'virtual-data-layer', 'tcph/orders')))
+        assert cache.statistics()['bytes'] == sum(
+            os.path.getsize(os.path.join(directory, filename))
+            for directory, directory_names, filenames
+            in os.walk(cache.cache_directory) for filename in filenames
+            if filename != cache.index_filename)
+
+        print(cache.statistics())
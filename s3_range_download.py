@@ -0,0 +1,133 @@
+#!/usr/bin/python
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# objects larger than this are downloaded as concurrent byte ranges of
+# this size - 64 MB
+default_part_size = 64 * 1024 * 1024
+
+# number of byte ranges of one object to download at once
+default_range_workers = 8
+
+
+def read_s3_ranges(s3, bucket, s3_filename, object_size, etag=None,
+                   part_size=default_part_size,
+                   range_workers=default_range_workers):
+    '''generator function that downloads an S3 object as byte ranges,
+        fetching several ranges at once, and yields them in order.
+        only range_workers ranges are held in memory at a time
+
+    keyword-args:
+        s3 = boto3 S3 client
+        bucket = name of S3 bucket holding the object
+        s3_filename = key of the object in the bucket
+        object_size = size of the object in bytes
+        etag = ETag of the object.  if given, every range must come from
+               this version of the object (optional)
+        part_size = size of each byte range (optional)
+        range_workers = number of byte ranges to download at once (optional)
+
+    returns:
+        the bytes of each range, from the start of the object to the end
+'''
+
+    def read_range(start):
+        range_arguments = {'Bucket': bucket, 'Key': s3_filename,
+                           'Range': 'bytes=' + str(start) + '-' +
+                                    str(start + part_size - 1)}
+        if etag is not None:
+            range_arguments['IfMatch'] = etag
+        return s3.get_object(**range_arguments)['Body'].read()
+
+    range_starts = iter(range(0, object_size, part_size))
+
+    with ThreadPoolExecutor(max_workers=range_workers) as executor:
+        pending_ranges = deque()
+        for start in range_starts:
+            pending_ranges.append(executor.submit(read_range, start))
+            if len(pending_ranges) == range_workers:
+                break
+
+        while pending_ranges:
+            range_data = pending_ranges.popleft().result()
+            start = next(range_starts, None)
+            if start is not None:
+                pending_ranges.append(executor.submit(read_range, start))
+            yield range_data
+
+
+def stitch_line_blocks(ranges):
+    '''generator function that realigns byte ranges of a text file on line
+        boundaries.  the partial line at the end of each range is joined to
+        the start of the next range, so that every block holds whole lines
+        and can be decoded and parsed on its own, as long as no quoted CSV
+        field contains a newline
+
+    keyword-args:
+        ranges - iterable of the bytes of consecutive ranges of a file
+
+    returns:
+        each block of whole lines, as bytes, in file order
+'''
+
+    partial_line = b''
+
+    for range_data in ranges:
+        block = partial_line + range_data
+        end_of_last_line = block.rfind(b'\n') + 1
+        partial_line = block[end_of_last_line:]
+        if end_of_last_line > 0:
+            yield block[:end_of_last_line]
+
+    if partial_line:
+        yield partial_line
+
+
+def block_lines(blocks):
+    '''generator function that splits blocks of whole lines into lines
+
+    keyword-args:
+        blocks - iterable of blocks of UTF-8 text, as generated by
+                 stitch_line_blocks
+
+    returns:
+        each line, including its line ending
+'''
+
+    for block in blocks:
+        lines = block.decode('utf-8').split('\n')
+        last_line = lines.pop()
+        for line in lines:
+            yield line + '\n'
+        if last_line:
+            yield last_line
+
+
+if __name__ == '__main__':
+
+    # unit tests
+    ranges = [b'a,b\n1,', b'2\n3,4', b'\n', b'5,6\n7', b'8']
+    assert list(stitch_line_blocks(ranges)) == \
+        [b'a,b\n', b'1,2\n', b'3,4\n', b'5,6\n', b'78']
+    assert list(block_lines(stitch_line_blocks(ranges))) == \
+        ['a,b\n', '1,2\n', '3,4\n', '5,6\n', '78']
+
+    class RangeClient:
+        # stands in for an S3 client, serving byte ranges of a bytes object
+        def __init__(self, data):
+            self.data = data
+
+        def get_object(self, Bucket, Key, Range, IfMatch=None):
+            import io
+            start, end = Range.replace('bytes=', '').split('-')
+            return {'Body': io.BytesIO(self.data[int(start):int(end) + 1])}
+
+    data = ''.join(str(i) + ',row ' + str(i) + '\n'
+                   for i in range(10000)).encode()
+    for part_size in [1, 7, 1000, len(data)]:
+        ranges = read_s3_ranges(RangeClient(data), 'bucket', 'key',
+                                len(data), part_size=part_size,
+                                range_workers=3)
+        assert b''.join(stitch_line_blocks(ranges)) == data
+
+    print('range download unit tests passed')
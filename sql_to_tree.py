@@ -1,48 +1,224 @@
 #!/usr/bin/python
+import re
+import threading
+from collections import OrderedDict
 import extract_table_names
 import extract_selected_columns
 import extract_where
 import extract_orderby
 import extract_aggregates
 import extract_having
+import fast_sql_parser
+from parse_utilities import parse_statement
 
+# quoted identifiers are matched so that they can be skipped, while string
+# and numeric literals are matched so that they can be stripped out.
+# numbers that are part of a name, like tcph1, are not literals
+sql_literal_pattern = re.compile(r'''("(?:[^"]|"")*")|('(?:[^']|'')*')|'''
+                                 r'''((?<![\w.])\d+(?:\.\d+)?(?![\w.]))''')
 
-def sql_to_tree(input_sql):
+# LRU cache of SQL trees, keyed on SQL text with its literals stripped out
+tree_cache_size = 256
+tree_cache = OrderedDict()
+tree_cache_lock = threading.Lock()
+tree_cache_statistics = {'hits': 0, 'misses': 0, 'uncacheable': 0}
+
+# parser used when none is given - 'sqlparse' or 'fast'
+default_parser = 'sqlparse'
+
+
+def sql_to_tree(input_sql, use_cache=True, parser=None):
     '''Converts SQL to a SQL tree.  Does not validate that input SQL is correct.
 
+    Queries that differ only in the literal values in their filters share a
+    cached tree, with each query's own literals bound into a fresh copy.
+
+    keyword args:
+        input_sql: SQL text input.
+            May be multiple lines, so long as they are separated by semicolon
+        use_cache: if False, always parse the SQL rather than using the
+            tree cache (optional)
+        parser: 'sqlparse' or 'fast', as in build_sql_tree.
+            defaults to default_parser (optional)
+
+
+    returns:
+        list of sql tree components
+    '''
+
+    if parser is None:
+        parser = default_parser
+
+    if not use_cache:
+        return build_sql_tree(input_sql, parser)
+
+    normalized_sql, literals = normalize_sql(input_sql)
+    # the parsers don't build identical trees for every query
+    normalized_sql = (parser, normalized_sql)
+
+    with tree_cache_lock:
+        cached_tree = tree_cache.get(normalized_sql)
+        if cached_tree is not None:
+            tree_cache.move_to_end(normalized_sql)
+            tree_cache_statistics['hits'] += 1
+
+    if cached_tree is not None:
+        template_tree, filter_positions = cached_tree
+        sql_tree = copy_sql_tree(template_tree)
+        for filter_position, literal in zip(filter_positions, literals):
+            sql_tree['filters'][filter_position]['value'] = \
+                literal.replace("''", '')
+        return sql_tree
+
+    sql_tree = build_sql_tree(input_sql, parser)
+    filter_positions = map_literals_to_filters(sql_tree, literals)
+
+    with tree_cache_lock:
+        if filter_positions is None:
+            # literals outside of the filters can't be rebound,
+            # so these queries are always parsed
+            tree_cache_statistics['uncacheable'] += 1
+        else:
+            tree_cache_statistics['misses'] += 1
+            tree_cache[normalized_sql] = (copy_sql_tree(sql_tree),
+                                          filter_positions)
+            while len(tree_cache) > tree_cache_size:
+                tree_cache.popitem(last=False)
+
+    return sql_tree
+
+
+def clear_tree_cache():
+    '''empties the SQL tree cache and resets its statistics'''
+
+    with tree_cache_lock:
+        tree_cache.clear()
+        for k in tree_cache_statistics:
+            tree_cache_statistics[k] = 0
+
+
+def normalize_sql(input_sql):
+    '''strips string and numeric literals out of SQL text, so that queries
+        which only differ in their literal values normalize to the same text
+
+    keyword args:
+        input_sql: SQL text input
+
+    returns:
+        normalized_sql: SQL text with string literals replaced by '?' and
+            numeric literals replaced by ?
+        literals: list of the literals stripped out, in the order they
+            appear in the SQL text
+    '''
+
+    literals = []
+
+    def strip_literal(match):
+        if match.group(1) is not None:
+            return match.group(1)
+        literals.append(match.group(0))
+        if match.group(2) is not None:
+            return "'?'"
+        return '?'
+
+    normalized_sql = sql_literal_pattern.sub(strip_literal, input_sql)
+
+    return normalized_sql, literals
+
+
+def map_literals_to_filters(sql_tree, literals):
+    '''maps each literal in a query to the filter in its sql tree that holds it
+
+    keyword args:
+        sql_tree: SQL tree, as generated by build_sql_tree
+        literals: list of literals, as generated by normalize_sql
+
+    returns:
+        list of the positions in sql_tree['filters'] holding each literal,
+            or None if any literal is used outside of the filters
+    '''
+
+    filter_positions = []
+
+    for i, filter in enumerate(sql_tree['filters']):
+        if 'value' in filter:
+            filter_positions.append(i)
+
+    if len(filter_positions) != len(literals):
+        return None
+
+    for filter_position, literal in zip(filter_positions, literals):
+        if sql_tree['filters'][filter_position]['value'] != \
+                literal.replace("''", ''):
+            return None
+
+    return filter_positions
+
+
+def copy_sql_tree(sql_tree):
+    '''copies a SQL tree, so that changes to the copy's lists and
+        identifier dictionaries don't affect the original
+
+    keyword args:
+        sql_tree: SQL tree, as generated by build_sql_tree
+
+    returns:
+        copy of the SQL tree
+    '''
+
+    tree_copy = {}
+    for k, v in sql_tree.items():
+        tree_copy[k] = [dict(i) if isinstance(i, dict) else i for i in v]
+
+    return tree_copy
+
+
+def build_sql_tree(input_sql, parser='sqlparse'):
+    '''Parses SQL into a SQL tree, without using the tree cache.
+        Does not validate that input SQL is correct.
+
     keyword args:
         input_sql: SQL text input.
             May be multiple lines, so long as they are separated by semicolon
+        parser: 'sqlparse' to use the sqlparse extractors, or 'fast' to use
+            the much faster fast_sql_parser module.  SQL that the fast parser
+            doesn't support is parsed with sqlparse instead (optional)
 
 
     returns:
         list of sql tree components
     '''
 
+    if parser == 'fast':
+        try:
+            return fast_sql_parser.parse_sql(input_sql)
+        except ValueError:
+            pass
+
     sql_tree = {}
 
-    # todo: refactor all of these so that they take parsed
-    #                           SQL stream rather than raw SQL
+    # parse once, and share the parsed statement between all extractors
+    parsed_sql = parse_statement(input_sql)
 
     sql_tree['select'] = \
-        extract_selected_columns.extract_select(input_sql)
+        extract_selected_columns.extract_select(parsed_sql)
     # sqlparse doesn't properly support aliases for aggregates
     # sqlparse also doesn't properly support expressions within an aggregate
     #   so this doesn't yet support either of those
     sql_tree['select aggregate'] = \
-        extract_selected_columns.extract_select_aggregates(input_sql)
+        extract_selected_columns.extract_select_aggregates(parsed_sql)
     sql_tree['table_definitions'] = \
-        extract_table_names.extract_table_definitions(input_sql)
+        extract_table_names.extract_table_definitions(parsed_sql)
     # needs support for outer joins
     # needs to support table/schema/alias format
-    sql_tree['joins'] = extract_where.extract_joins(input_sql)
-    sql_tree['filters'] = extract_where.extract_filters(input_sql)
+    sql_tree['joins'] = extract_where.extract_joins(parsed_sql)
+    sql_tree['filters'] = extract_where.extract_filters(parsed_sql)
     # need to split out join from subquery
     sql_tree['where_subqueries'] = \
-        extract_where.extract_where_subqueries(input_sql)
-    sql_tree['grouping'] = extract_aggregates.extract_groupby(input_sql)
-    sql_tree['ordering'] = extract_orderby.extract_orderby(input_sql)
-    sql_tree['having'] = extract_having.extract_having(input_sql)
+        extract_where.extract_where_subqueries(parsed_sql)
+    sql_tree['grouping'] = extract_aggregates.extract_groupby(parsed_sql)
+    sql_tree['ordering'] = extract_orderby.extract_orderby(parsed_sql)
+    sql_tree['having'] = extract_having.extract_having(parsed_sql)
 
     return sql_tree
 
@@ -0,0 +1,394 @@
+#!/usr/bin/python
+import math
+import operator
+import random
+from array import array
+from itertools import islice
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# HyperLogLog sketches have 2 ** hyperloglog_precision registers.  12 gives
+# distinct counts a standard error of about 1.6%, in 4 KB per column
+hyperloglog_precision = 12
+
+# number of buckets in the equi-depth histogram of each column
+histogram_buckets = 32
+
+# histograms are built from a random sample of up to this many rows of
+# each table, so collecting them takes the same memory for any table
+histogram_sample_size = 4096
+
+# hashes are kept to 64 bits
+hash_mask = 0xFFFFFFFFFFFFFFFF
+
+
+class HyperLogLog:
+    '''estimates the number of distinct values added to it, in a fixed
+        amount of memory.  each value is hashed, the low bits of the hash
+        choose a register and the register keeps the longest run of trailing
+        zeros seen in the rest of the hash
+
+        values are hashed with the splitmix64 finalizer, applied to python's
+        hash of each value or, with numpy, to the 64 bits of each number in
+        a typed column.  strings are hashed differently by each process, so
+        a sketch is only meaningful within one process, and only its count
+        is kept.  with numpy, the values are hashed and added a column at a
+        time
+'''
+
+    def __init__(self, precision=hyperloglog_precision):
+        '''keyword_args:
+            precision - the sketch has 2 ** precision registers (optional)
+'''
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def update(self, values):
+        '''adds values to the sketch.  adding a value more than once has
+            no effect
+
+        keyword_args:
+            values - a typed column, as an array of 8 byte numbers, or a
+                     list of hashable values
+'''
+        if numpy is not None:
+            if isinstance(values, array):
+                hashes = numpy.frombuffer(values, numpy.uint64)
+            else:
+                hashes = numpy.fromiter(map(hash, values), numpy.int64,
+                                        len(values)).view(numpy.uint64)
+            self.update_hashes(hashes)
+            return
+
+        registers = self.registers
+        precision = self.precision
+        register_mask = len(registers) - 1
+        no_zeros_rank = 65 - precision
+
+        # duplicate values are only hashed once
+        for value in set(values):
+            z = (hash(value) + 0x9E3779B97F4A7C15) & hash_mask
+            z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & hash_mask
+            z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & hash_mask
+            z ^= z >> 31
+
+            remaining_bits = z >> precision
+            if remaining_bits:
+                rank = (remaining_bits & -remaining_bits).bit_length()
+            else:
+                rank = no_zeros_rank
+            register = z & register_mask
+            if rank > registers[register]:
+                registers[register] = rank
+
+    def update_hashes(self, hashes):
+        '''adds values to the sketch with numpy, as update does
+
+        keyword_args:
+            hashes - numpy array of the 64 bits of each value, as uint64
+'''
+        z = hashes + numpy.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+        z ^= z >> numpy.uint64(31)
+
+        remaining_bits = z >> numpy.uint64(self.precision)
+        lowest_bits = remaining_bits & (~remaining_bits + numpy.uint64(1))
+        ranks = numpy.full(len(z), 65 - self.precision, numpy.uint8)
+        has_bits = remaining_bits != 0
+        ranks[has_bits] = numpy.log2(lowest_bits[has_bits]).astype(
+            numpy.uint8) + 1
+
+        registers = numpy.frombuffer(self.registers, numpy.uint8)
+        numpy.maximum.at(registers, (z & numpy.uint64(
+            len(self.registers) - 1)).astype(numpy.intp), ranks)
+
+    def merge(self, other):
+        '''adds the values of another sketch of the same precision to this
+            sketch
+'''
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        '''returns the estimated number of distinct values in the sketch.
+            small counts are estimated from the number of empty registers
+'''
+        register_count = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / register_count)
+        estimate = alpha * register_count ** 2 / \
+            sum(2.0 ** -rank for rank in self.registers)
+
+        empty_registers = self.registers.count(0)
+        if estimate <= 2.5 * register_count and empty_registers > 0:
+            estimate = register_count * \
+                math.log(register_count / empty_registers)
+
+        return int(round(estimate))
+
+
+class TableStatisticsCollector:
+    '''collects the statistics of a table as it is read, a batch of rows at
+        a time: the number of rows, and for each column the number of empty
+        values, the smallest and largest values, an estimate of the number
+        of distinct values, an equi-depth histogram and whether the values
+        are in ascending order.  empty values, which
+        are None in numeric and date columns and '' in other columns, are
+        left out of everything but the count of empty values
+
+        the histograms are built from a sample of the rows of the table,
+        kept with reservoir sampling (Li's algorithm L), which only draws
+        random numbers for the rows that enter the sample.  the same rows
+        are sampled from every column
+'''
+
+    def __init__(self, column_names, seed=1):
+        '''keyword_args:
+            column_names - names of the columns of the table, in file order
+            seed - seed of the random sampling, so that the same table gets
+                   the same histograms (optional)
+'''
+        self.column_names = column_names
+        self.row_count = 0
+        self.random = random.Random(seed)
+        self.sample_weight = 1.0
+        self.next_sample = 0
+
+        column_count = len(column_names)
+        self.collected = [False] * column_count
+        self.nulls = [0] * column_count
+        self.minimums = [None] * column_count
+        self.maximums = [None] * column_count
+        self.sketches = [HyperLogLog() for i in range(column_count)]
+        self.sorted = [True] * column_count
+        self.last_values = [None] * column_count
+        self.samples = [[] for i in range(column_count)]
+
+    def add_batch(self, batch):
+        '''adds a batch of rows to the statistics
+
+        keyword_args:
+            batch - list of columns, as generated by csv_to_data_batches.
+                    columns that weren't kept are None and get no statistics
+'''
+        batch_rows = 0
+        for column in batch:
+            if column is not None:
+                batch_rows = len(column)
+                break
+
+        filled_rows = max(min(histogram_sample_size - self.row_count,
+                              batch_rows), 0)
+        sampled_rows = self.sample_rows(batch_rows)
+
+        for position, column in enumerate(batch):
+            if column is None:
+                continue
+            self.collected[position] = True
+
+            sample = self.samples[position]
+            sample.extend(column[:filled_rows])
+            for sample_position, row in sampled_rows:
+                sample[sample_position] = column[row]
+
+            if isinstance(column, array):
+                values = column
+            else:
+                values = [v for v in column if v is not None and v != '']
+                # numbers are hashed the same way whether or not their
+                # batch has empty values
+                if len(values) > 0 and isinstance(values[0], int):
+                    values = array('q', values)
+                elif len(values) > 0 and isinstance(values[0], float):
+                    values = array('d', values)
+            self.nulls[position] += len(column) - len(values)
+
+            if len(values) == 0:
+                self.sorted[position] = False
+                continue
+
+            # each batch carries on from the last value of the one before
+            if self.sorted[position]:
+                self.sorted[position] = len(values) == len(column) and \
+                    (self.last_values[position] is None or
+                     self.last_values[position] <= values[0]) and \
+                    is_sorted(values)
+                self.last_values[position] = values[-1]
+
+            if numpy is not None and isinstance(values, array):
+                numbers = numpy.frombuffer(values, values.typecode)
+                minimum = numbers.min().item()
+                maximum = numbers.max().item()
+            else:
+                minimum = min(values)
+                maximum = max(values)
+            if self.minimums[position] is None or \
+                    minimum < self.minimums[position]:
+                self.minimums[position] = minimum
+            if self.maximums[position] is None or \
+                    maximum > self.maximums[position]:
+                self.maximums[position] = maximum
+
+            self.sketches[position].update(values)
+
+        self.row_count += batch_rows
+
+    def sample_rows(self, batch_rows):
+        '''chooses the rows of the next batch that replace rows of the
+            sample, once the sample is full
+
+        keyword_args:
+            batch_rows - number of rows in the batch
+
+        returns:
+            list of the position in the sample and the row in the batch of
+            each replacement, in row order
+'''
+        if self.row_count + batch_rows <= histogram_sample_size:
+            return []
+
+        # the first row after the sample is filled
+        if self.row_count <= histogram_sample_size:
+            self.next_sample = histogram_sample_size - 1
+            self.skip_rows()
+
+        sampled_rows = []
+        while self.next_sample < self.row_count + batch_rows:
+            sampled_rows.append((self.random.randrange(histogram_sample_size),
+                                 self.next_sample - self.row_count))
+            self.skip_rows()
+
+        return sampled_rows
+
+    def skip_rows(self):
+        '''draws the next row that enters the sample
+'''
+        self.sample_weight *= math.exp(
+            math.log(self.random.random() or 0.5) / histogram_sample_size)
+
+        skipped_rows = 0
+        if self.sample_weight < 1:
+            skipped_rows = math.floor(
+                math.log(self.random.random() or 0.5) /
+                math.log1p(-self.sample_weight))
+        self.next_sample += skipped_rows + 1
+
+    def statistics(self):
+        '''returns the statistics collected so far, as a dictionary holding:
+            row_count - the number of rows in the table
+            columns - dictionary of the statistics of each column that was
+                      kept, each a dictionary holding:
+                nulls - the number of empty values
+                min, max - the smallest and largest values, in the form
+                           they are held in typed columns, or None if the
+                           column only has empty values
+                distinct - the estimated number of distinct values
+                histogram - the bounds of the buckets of an equi-depth
+                            histogram of the values: histogram_buckets + 1
+                            values, each bucket holding about the same
+                            number of rows, or no values if the column only
+                            has empty values
+                sorted - True if the values are in ascending order and
+                         none of them are empty
+'''
+        columns = {}
+
+        for position, column_name in enumerate(self.column_names):
+            if not self.collected[position]:
+                continue
+
+            values = self.row_count - self.nulls[position]
+            sample = sorted(v for v in self.samples[position]
+                            if v is not None and v != '')
+            histogram = []
+            if len(sample) > 0:
+                histogram = [sample[(len(sample) - 1) * bucket //
+                                    histogram_buckets]
+                             for bucket in range(histogram_buckets + 1)]
+
+            columns[column_name] = {
+                'nulls': self.nulls[position],
+                'min': self.minimums[position],
+                'max': self.maximums[position],
+                'distinct': min(self.sketches[position].count(), values),
+                'histogram': histogram,
+                'sorted': self.sorted[position]}
+
+        return {'row_count': self.row_count, 'columns': columns}
+
+
+def is_sorted(values):
+    '''returns True if the values of a column are in ascending order.  a
+        column with empty values (None) is never in order, and nor is a
+        column of numbers that aren't (nan)
+
+    keyword_args:
+        values - a typed column, as an array of numbers, or a list
+'''
+    if numpy is not None and isinstance(values, array):
+        numbers = numpy.frombuffer(values, values.typecode)
+        return bool((numbers[1:] >= numbers[:-1]).all())
+
+    try:
+        return all(map(operator.le, values, islice(values, 1, None)))
+    except TypeError:
+        return False
+
+
+if __name__ == '__main__':
+
+    # unit tests
+    for distinct_count in [0, 10, 1000, 100000]:
+        sketch = HyperLogLog()
+        sketch.update(array('q', range(distinct_count)))
+        sketch.update(list(range(distinct_count)))
+        assert abs(sketch.count() - distinct_count) <= distinct_count * 0.05
+
+    halves = [HyperLogLog(), HyperLogLog()]
+    halves[0].update([str(i) for i in range(5000)])
+    halves[1].update([str(i) for i in range(2500, 7500)])
+    halves[0].merge(halves[1])
+    assert abs(halves[0].count() - 7500) <= 7500 * 0.05
+
+    # the histogram of uniform values has evenly spaced bounds, however
+    # the values are split into batches
+    collector = TableStatisticsCollector(['key', 'name', 'price', 'skipped'])
+    for start in range(0, 100000, 7000):
+        keys = array('q', range(start, min(start + 7000, 100000)))
+        collector.add_batch([keys,
+                             ['' if key % 10 == 0 else 'n' + str(key % 50)
+                              for key in keys],
+                             [None if key % 4 == 0 else key / 100
+                              for key in keys],
+                             None])
+    statistics = collector.statistics()
+
+    assert statistics['row_count'] == 100000
+    assert set(statistics['columns']) == {'key', 'name', 'price'}
+    key_statistics = statistics['columns']['key']
+    assert key_statistics['min'] == 0 and key_statistics['max'] == 99999
+    assert abs(key_statistics['distinct'] - 100000) <= 5000
+    assert len(key_statistics['histogram']) == histogram_buckets + 1
+    for bucket, bound in enumerate(key_statistics['histogram']):
+        assert abs(bound - bucket * 100000 / histogram_buckets) < 2000
+    assert statistics['columns']['name']['nulls'] == 10000
+    assert abs(statistics['columns']['name']['distinct'] - 45) <= 2
+    assert statistics['columns']['price']['nulls'] == 25000
+    assert statistics['columns']['price']['max'] == 999.99
+    assert key_statistics['sorted']
+    assert not statistics['columns']['name']['sorted']
+    assert not statistics['columns']['price']['sorted']
+
+    # order is checked across batches as well as within them
+    collector = TableStatisticsCollector(['key'])
+    collector.add_batch([array('q', [1, 2, 2])])
+    collector.add_batch([array('q', [2, 3])])
+    assert collector.statistics()['columns']['key']['sorted']
+    collector.add_batch([array('q', [1])])
+    assert not collector.statistics()['columns']['key']['sorted']
+    assert is_sorted(['a', 'a', 'b']) and not is_sorted(['b', 'a'])
+    assert not is_sorted([1, None, 2])
+    assert not is_sorted(array('d', [1.0, float('nan'), 2.0]))
+
+    print('table statistics unit tests passed')
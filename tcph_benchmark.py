@@ -0,0 +1,1893 @@
+#!/usr/bin/python
+import csv
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from array import array
+from datetime import date, datetime, timedelta
+import extract_table_names
+import extract_selected_columns
+import extract_where
+import extract_orderby
+import extract_aggregates
+import extract_having
+from sql_to_tree import sql_to_tree, build_sql_tree, clear_tree_cache, \
+                        tree_cache_statistics
+import file_query_utilities
+import virtual_S3_module
+from file_query_utilities import file_to_data_structure, \
+                                 file_to_data_batches, concatenate_batches, \
+                                 compile_filters, default_scan_engine, \
+                                 sql_tree_columns, write_zone_maps, \
+                                 scan_statistics, clear_scan_statistics, \
+                                 join_statistics, write_table_statistics, \
+                                 compile_column_filters, \
+                                 estimate_filter_selectivity, \
+                                 filter_selectivities, new_column_like, \
+                                 join_data, header_datatypes, batch_length, \
+                                 gather_rows, aggregate_batches
+from columnar_cache import write_columnar_layout, layout_directory, \
+                           columnar_to_data_batches, write_column_index, \
+                           layout_indexes
+from virtual_S3_module import s3_file_names, execute_sqltree_on_tables, \
+                              execute_sqltree_on_batches, \
+                              read_tables_with_semi_joins, join_tables
+
+tcph_sql_files = ['tcph1.sql', 'tcph2.sql', 'tcph3.sql']
+
+# ETags that benchmark tables are converted to columnar layouts under
+benchmark_etags = ['benchmark', 'benchmark']
+
+
+def best_time(function, number, repeat=5):
+    '''times a function, taking the best of several runs to reduce noise
+
+    keyword_args:
+        function - function with no arguments to be timed
+        number - number of calls to make in each run
+        repeat - number of runs
+
+    returns:
+        best time for a single call of the function, in seconds
+'''
+
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def write_tcph_table(directory, table_name, columns, rows):
+    '''writes a table and its _header file in the layout that is read from
+        S3, as tcph_<table_name> in a local directory
+
+    keyword_args:
+        directory - local directory to write the files to
+        table_name - name of the table
+        columns - list of (column name, datatype) tuples
+        rows - iterable of rows, each a tuple of values
+'''
+
+    filename = os.path.join(directory, 'tcph_' + table_name)
+
+    with open(filename, 'w', newline='') as data_file:
+        data_writer = csv.writer(data_file)
+        data_writer.writerow([column[0] for column in columns])
+        data_writer.writerows(rows)
+
+    with open(filename + '_header', 'w', newline='') as header_file:
+        csv.writer(header_file).writerow(
+            [column[0] + ' ' + column[1] for column in columns])
+
+
+def generate_tcph_data(directory, scale_factor=0.01, seed=1):
+    '''generates synthetic TPC-H tables for the tcph queries.  the tables
+        follow the TPC-H schema and row counts, with random values
+
+    keyword_args:
+        directory - local directory to write the tables to
+        scale_factor - TPC-H scale factor.  1 is about 1 GB of data
+        seed - random seed, so the same data can be generated again
+'''
+
+    r = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    supplier_count = max(int(10000 * scale_factor), 10)
+    customer_count = max(int(150000 * scale_factor), 10)
+    order_count = max(int(1500000 * scale_factor), 10)
+    part_count = max(int(200000 * scale_factor), 10)
+
+    regions = ['AFRICA', 'AMERICA', 'ASIA', 'EUROPE', 'MIDDLE EAST']
+    write_tcph_table(directory, 'region',
+                     [('r_regionkey', 'INTEGER'), ('r_name', 'CHAR(25)'),
+                      ('r_comment', 'VARCHAR(152)')],
+                     [(i, v.ljust(25), 'region comment')
+                      for i, v in enumerate(regions)])
+
+    write_tcph_table(directory, 'nation',
+                     [('n_nationkey', 'INTEGER'), ('n_name', 'CHAR(25)'),
+                      ('n_regionkey', 'INTEGER'),
+                      ('n_comment', 'VARCHAR(152)')],
+                     [(i, ('NATION' + str(i)).ljust(25), i % 5,
+                       'nation comment') for i in range(25)])
+
+    write_tcph_table(directory, 'supplier',
+                     [('s_suppkey', 'INTEGER'), ('s_name', 'CHAR(25)'),
+                      ('s_address', 'VARCHAR(40)'),
+                      ('s_nationkey', 'INTEGER'), ('s_phone', 'CHAR(15)'),
+                      ('s_acctbal', 'NUMERIC'), ('s_comment', 'VARCHAR(101)')],
+                     [(i, 'Supplier#%09d' % i, 'address ' + str(i),
+                       r.randrange(25), '11-111-111-1111',
+                       '%.2f' % r.uniform(-999, 9999),
+                       'supplier comment ' + 'x' * r.randrange(20, 90))
+                      for i in range(1, supplier_count + 1)])
+
+    part_types = [a + ' ' + b + ' ' + c
+                  for a in ['STANDARD', 'SMALL', 'MEDIUM', 'LARGE', 'ECONOMY']
+                  for b in ['ANODIZED', 'BURNISHED', 'PLATED', 'POLISHED']
+                  for c in ['TIN', 'NICKEL', 'BRASS', 'STEEL', 'COPPER']]
+    write_tcph_table(directory, 'part',
+                     [('p_partkey', 'INTEGER'), ('p_name', 'VARCHAR(55)'),
+                      ('p_mfgr', 'CHAR(25)'), ('p_brand', 'CHAR(10)'),
+                      ('p_type', 'VARCHAR(25)'), ('p_size', 'INTEGER'),
+                      ('p_container', 'CHAR(10)'),
+                      ('p_retailprice', 'NUMERIC'),
+                      ('p_comment', 'VARCHAR(23)')],
+                     [(i, 'part ' + str(i),
+                       'Manufacturer#' + str(r.randrange(1, 6)),
+                       'Brand#' + str(r.randrange(11, 56)),
+                       r.choice(part_types), r.randrange(1, 51), 'SM BOX',
+                       '%.2f' % (900 + i % 1000), 'part comment')
+                      for i in range(1, part_count + 1)])
+
+    # each part has four suppliers.  partsuppcost holds the lowest
+    # supply cost of each part, as built by tcph2_table_create.sql
+    partsupp_rows = []
+    min_supplycosts = {}
+    for partkey in range(1, part_count + 1):
+        for i in range(4):
+            suppkey = (partkey + i * (supplier_count // 4 + 1)) \
+                % supplier_count + 1
+            supplycost = '%.2f' % r.uniform(1, 1000)
+            partsupp_rows.append((partkey, suppkey, r.randrange(1, 10000),
+                                  supplycost, 'partsupp comment'))
+            min_supplycosts[partkey] = \
+                min(min_supplycosts.get(partkey, supplycost), supplycost,
+                    key=float)
+    write_tcph_table(directory, 'partsupp',
+                     [('ps_partkey', 'INTEGER'), ('ps_suppkey', 'INTEGER'),
+                      ('ps_availqty', 'INTEGER'),
+                      ('ps_supplycost', 'NUMERIC'),
+                      ('ps_comment', 'VARCHAR(199)')], partsupp_rows)
+    write_tcph_table(directory, 'partsuppcost',
+                     [('psc_partkey', 'INTEGER'),
+                      ('psc_min_supplycost', 'NUMERIC')],
+                     sorted(min_supplycosts.items()))
+
+    segments = ['AUTOMOBILE', 'BUILDING', 'FURNITURE', 'HOUSEHOLD',
+                'MACHINERY']
+    write_tcph_table(directory, 'customer',
+                     [('c_custkey', 'INTEGER'), ('c_name', 'VARCHAR(25)'),
+                      ('c_address', 'VARCHAR(40)'),
+                      ('c_nationkey', 'INTEGER'), ('c_phone', 'CHAR(15)'),
+                      ('c_acctbal', 'NUMERIC'), ('c_mktsegment', 'CHAR(10)'),
+                      ('c_comment', 'VARCHAR(117)')],
+                     [(i, 'Customer#%09d' % i, 'address ' + str(i),
+                       r.randrange(25), '22-222-222-2222',
+                       '%.2f' % r.uniform(-999, 9999), r.choice(segments),
+                       'customer comment, with a comma')
+                      for i in range(1, customer_count + 1)])
+
+    # orders and lineitems are generated in order key order
+    order_rows = []
+    lineitem_rows = []
+    for orderkey in range(1, order_count + 1):
+        orderdate = date(1992, 1, 1) + timedelta(days=r.randrange(2405))
+        order_rows.append((orderkey, r.randrange(1, customer_count + 1),
+                           r.choice('OFP'),
+                           '%.2f' % r.uniform(1000, 400000),
+                           orderdate.isoformat(),
+                           r.choice(['1-URGENT', '2-HIGH', '3-MEDIUM',
+                                     '4-NOT SPECIFIED', '5-LOW']),
+                           'Clerk#%09d' % r.randrange(1000), 0,
+                           'order comment'))
+        for linenumber in range(1, r.randrange(2, 9)):
+            shipdate = orderdate + timedelta(days=r.randrange(1, 122))
+            quantity = r.randrange(1, 51)
+            lineitem_rows.append(
+                (orderkey, r.randrange(1, part_count + 1),
+                 r.randrange(1, supplier_count + 1), linenumber, quantity,
+                 '%.2f' % (quantity * r.uniform(900, 2000)),
+                 '%.2f' % (r.randrange(11) / 100),
+                 '%.2f' % (r.randrange(9) / 100), r.choice('RAN'),
+                 'F' if shipdate < date(1995, 6, 17) else 'O',
+                 shipdate.isoformat(),
+                 (shipdate + timedelta(days=10)).isoformat(),
+                 (shipdate + timedelta(days=20)).isoformat(),
+                 'DELIVER IN PERSON', r.choice(['AIR', 'MAIL', 'SHIP']),
+                 'lineitem comment'))
+    write_tcph_table(directory, 'orders',
+                     [('o_orderkey', 'INTEGER'), ('o_custkey', 'INTEGER'),
+                      ('o_orderstatus', 'CHAR(1)'),
+                      ('o_totalprice', 'NUMERIC'), ('o_orderdate', 'DATE'),
+                      ('o_orderpriority', 'CHAR(15)'),
+                      ('o_clerk', 'CHAR(15)'), ('o_shippriority', 'INTEGER'),
+                      ('o_comment', 'VARCHAR(79)')], order_rows)
+    write_tcph_table(directory, 'lineitem',
+                     [('l_orderkey', 'INTEGER'), ('l_partkey', 'INTEGER'),
+                      ('l_suppkey', 'INTEGER'), ('l_linenumber', 'INTEGER'),
+                      ('l_quantity', 'NUMERIC'),
+                      ('l_extendedprice', 'NUMERIC'),
+                      ('l_discount', 'NUMERIC'), ('l_tax', 'NUMERIC'),
+                      ('l_returnflag', 'CHAR(1)'),
+                      ('l_linestatus', 'CHAR(1)'), ('l_shipdate', 'DATE'),
+                      ('l_commitdate', 'DATE'), ('l_receiptdate', 'DATE'),
+                      ('l_shipinstruct', 'CHAR(25)'),
+                      ('l_shipmode', 'CHAR(10)'),
+                      ('l_comment', 'VARCHAR(44)')], lineitem_rows)
+
+
+def load_tcph_tables(sql_tree, directory, projection=True):
+    '''reads the tables of a query from a local directory, as
+        execute_sqltree_on_s3 reads them once they are downloaded
+
+    keyword_args:
+        sql_tree - a sql tree, as generated by sql_to_tree library
+        directory - local directory holding the tables
+        projection - if True, only the columns the query refers to are kept
+
+    returns:
+        dictionary of tables, as used by execute_sqltree_on_tables
+'''
+
+    query_columns = None
+    if projection:
+        query_columns = sql_tree_columns(sql_tree)
+
+    tables = {}
+    for table_definition in sql_tree['table_definitions']:
+        alias = table_definition['alias'] or table_definition['name']
+        local_filename, s3_filename = \
+            s3_file_names(table_definition['name'],
+                          table_definition['schema'])
+        tables[alias] = file_to_data_structure(
+            os.path.join(directory, local_filename), sql_tree,
+            columns=query_columns)
+
+    return tables
+
+
+def run_tcph_query(sql_file, directory, projection=True):
+    '''parses a tcph query and executes it against tables in a local
+        directory
+
+    keyword_args:
+        sql_file - name of the file holding the query
+        directory - local directory holding the tables
+        projection - if True, only the columns the query refers to are kept
+
+    returns:
+        the query result, as returned by execute_sqltree_on_s3
+'''
+
+    with open(sql_file) as f:
+        sql_tree = sql_to_tree(f.read())
+
+    return execute_sqltree_on_tables(
+        sql_tree, load_tcph_tables(sql_tree, directory, projection))
+
+
+def measure(function):
+    '''runs a function twice, timing the first run and measuring the
+        memory use of the second, as tracing memory slows it down
+
+    keyword_args:
+        function - function with no arguments to be measured
+
+    returns:
+        a tuple of the time taken in seconds, the peak memory allocated
+        while it ran and the memory still held by its result, in bytes
+'''
+
+    start_time = timeit.default_timer()
+    result = function()
+    elapsed_time = timeit.default_timer() - start_time
+    del result
+
+    tracemalloc.start()
+    result = function()
+    retained_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    return elapsed_time, peak_bytes, retained_bytes
+
+
+def measure_joins(function, join_function=join_tables):
+    '''runs a function that executes a SQL tree twice, with join_tables
+        replaced by another function, timing the first run and measuring
+        the peak memory allocated while the joins ran in the second.  the
+        filters and sorts around the joins are left out of the peak
+
+    keyword_args:
+        function - function with no arguments that executes a SQL tree
+        join_function - function with the arguments of join_tables
+
+    returns:
+        a tuple of the time taken in seconds, the peak memory allocated
+        by the joins beyond the memory held when they started, in bytes,
+        and the result of the function
+'''
+
+    join_peaks = [0]
+
+    def measuring_join_tables(*args):
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        selected_data = join_function(*args)
+        join_peaks.append(tracemalloc.get_traced_memory()[1] - start_bytes)
+        return selected_data
+
+    try:
+        virtual_S3_module.join_tables = join_function
+        start_time = timeit.default_timer()
+        result = function()
+        elapsed_time = timeit.default_timer() - start_time
+        del result
+
+        virtual_S3_module.join_tables = measuring_join_tables
+        tracemalloc.start()
+        result = function()
+    finally:
+        tracemalloc.stop()
+        virtual_S3_module.join_tables = join_tables
+
+    return elapsed_time, max(join_peaks), result
+
+
+def reparsing_sql_to_tree(input_sql):
+    '''builds a SQL tree the way sql_to_tree used to, with every extract
+        function parsing the raw SQL text again.  used as a baseline
+
+    keyword_args:
+        input_sql - SQL text input
+
+    returns:
+        sql tree, as generated by sql_to_tree
+'''
+
+    sql_tree = {}
+    sql_tree['select'] = \
+        extract_selected_columns.extract_select(input_sql)
+    sql_tree['select aggregate'] = \
+        extract_selected_columns.extract_select_aggregates(input_sql)
+    sql_tree['table_definitions'] = \
+        extract_table_names.extract_table_definitions(input_sql)
+    sql_tree['joins'] = extract_where.extract_joins(input_sql)
+    sql_tree['filters'] = extract_where.extract_filters(input_sql)
+    sql_tree['where_subqueries'] = \
+        extract_where.extract_where_subqueries(input_sql)
+    sql_tree['grouping'] = extract_aggregates.extract_groupby(input_sql)
+    sql_tree['ordering'] = extract_orderby.extract_orderby(input_sql)
+    sql_tree['having'] = extract_having.extract_having(input_sql)
+
+    return sql_tree
+
+
+def benchmark_parse(number=50):
+    '''compares parsing each tcph query once per extract function with
+        parsing it once for the whole SQL tree
+
+    keyword_args:
+        number - number of parses to time for each query
+'''
+
+    print('parse time per query (ms)')
+    print('query       reparsing   single pass   speedup')
+    for sql_file in tcph_sql_files:
+        with open(sql_file) as f:
+            input_sql = f.read()
+
+        assert sql_to_tree(input_sql, use_cache=False) == \
+            reparsing_sql_to_tree(input_sql)
+
+        reparsing_time = best_time(lambda: reparsing_sql_to_tree(input_sql),
+                                   number)
+        single_pass_time = best_time(
+            lambda: sql_to_tree(input_sql, use_cache=False), number)
+
+        print('%-10s %10.3f %13.3f %8.1fx' %
+              (sql_file, reparsing_time * 1000, single_pass_time * 1000,
+               reparsing_time / single_pass_time))
+
+
+def benchmark_parse_cache(number=200):
+    '''compares parsing tcph3 with a different market segment and order date
+        on each call, with and without the SQL tree cache
+
+    keyword_args:
+        number - number of queries to time
+'''
+
+    with open('tcph3.sql') as f:
+        input_sql = f.read()
+
+    segments = ['AUTOMOBILE', 'BUILDING', 'FURNITURE', 'HOUSEHOLD',
+                'MACHINERY']
+    queries = []
+    for i in range(number):
+        queries.append(input_sql.replace(
+            "'BUILDING'", "'" + segments[i % len(segments)] + "'").replace(
+            '1997-12-31', '1997-12-%02d' % (i % 28 + 1)))
+
+    for query in queries[:10]:
+        assert sql_to_tree(query) == sql_to_tree(query, use_cache=False)
+
+    clear_tree_cache()
+    uncached_time = best_time(
+        lambda: [sql_to_tree(q, use_cache=False) for q in queries], 1, 3)
+    cached_time = best_time(lambda: [sql_to_tree(q) for q in queries], 1, 3)
+
+    print('tcph3 parse time per query with varying literals (ms)')
+    print('uncached   cached   speedup')
+    print('%8.3f %8.3f %8.1fx' %
+          (uncached_time * 1000 / number, cached_time * 1000 / number,
+           uncached_time / cached_time))
+    print('tree cache: ' + str(tree_cache_statistics))
+
+
+def benchmark_fast_parse(number=50):
+    '''compares parsing each tcph query with the sqlparse extractors and
+        with the fast subset parser
+
+    keyword_args:
+        number - number of parses to time for each query
+'''
+
+    print('parse time per query (ms)')
+    print('query        sqlparse      fast   speedup   same tree')
+    for sql_file in tcph_sql_files:
+        with open(sql_file) as f:
+            input_sql = f.read()
+
+        # tcph1 differs, as sqlparse can't see the aggregate in
+        # sum(l_quantity) as sum_qty
+        same_tree = build_sql_tree(input_sql, 'sqlparse') == \
+            build_sql_tree(input_sql, 'fast')
+
+        sqlparse_time = best_time(
+            lambda: build_sql_tree(input_sql, 'sqlparse'), number)
+        fast_time = best_time(
+            lambda: build_sql_tree(input_sql, 'fast'), number * 10)
+
+        print('%-10s %10.3f %9.3f %8.1fx   %s' %
+              (sql_file, sqlparse_time * 1000, fast_time * 1000,
+               sqlparse_time / fast_time, same_tree))
+
+
+def read_rows_as_strings(local_filename):
+    '''reads a local file as file_to_data_structure used to, as a list of
+        rows of strings.  used as a baseline
+'''
+
+    with open(local_filename, newline='') as lfile:
+        lfile_reader = csv.reader(lfile, delimiter=',', quotechar='"')
+        lfile_reader.__next__()
+        return list(lfile_reader)
+
+
+def benchmark_typed_columns(scale_factors=[0.01, 0.05]):
+    '''compares holding the tcph tables as rows of strings with holding
+        them as typed columns, and times the tcph queries on typed columns
+
+    keyword_args:
+        scale_factors - TPC-H scale factors of the generated data
+'''
+
+    for scale_factor in scale_factors:
+        directory = tempfile.mkdtemp()
+        try:
+            generate_tcph_data(directory, scale_factor)
+
+            print('scale factor ' + str(scale_factor) +
+                  ': load time (s) and memory (MB)')
+            print('table       representation   time    peak    held')
+            for table_name in ['lineitem', 'orders']:
+                local_filename = os.path.join(directory, 'tcph_' + table_name)
+                for representation, function in [
+                        ('string rows', lambda: read_rows_as_strings(
+                            local_filename)),
+                        ('typed columns', lambda: file_to_data_structure(
+                            local_filename))]:
+                    elapsed_time, peak_bytes, retained_bytes = \
+                        measure(function)
+                    print('%-11s %-14s %7.3f %7.1f %7.1f' %
+                          (table_name, representation, elapsed_time,
+                           peak_bytes / 1024 ** 2, retained_bytes / 1024 ** 2))
+
+            # the aggregate step used to convert each value from a string
+            local_filename = os.path.join(directory, 'tcph_lineitem')
+            string_column = [row[5] for row in
+                             read_rows_as_strings(local_filename)]
+            typed_column = file_to_data_structure(local_filename)[2][5]
+            reparsing_time = best_time(
+                lambda: sum([float(i) for i in string_column]), 1, 3)
+            typed_time = best_time(lambda: sum(typed_column), 1, 3)
+            print('sum(l_extendedprice): %.4fs from strings, %.4fs typed, '
+                  '%.1fx' % (reparsing_time, typed_time,
+                             reparsing_time / typed_time))
+
+            for sql_file in tcph_sql_files:
+                elapsed_time, peak_bytes, retained_bytes = measure(
+                    lambda: run_tcph_query(sql_file, directory))
+                print('%s: %.3fs, peak %.1f MB' %
+                      (sql_file, elapsed_time, peak_bytes / 1024 ** 2))
+        finally:
+            shutil.rmtree(directory)
+
+
+def interpreted_filter_rows(rows, filters, column_positions,
+                            column_datatypes):
+    '''filters rows the way file_to_data_structure used to, converting the
+        filter value for every row and keeping a row once for each filter
+        it passes.  used as a baseline
+'''
+
+    file_data = []
+    for line_data in rows:
+        for filter in filters:
+            filter_position = column_positions[filter['identifier']]
+            if column_datatypes[filter['identifier']] == 'NUMBER':
+                data_element = float(line_data[filter_position])
+                filter_element = float(filter['value'].replace("'", ''))
+            elif column_datatypes[filter['identifier']] == 'DATE':
+                data_element = datetime.strptime(line_data[filter_position],
+                                                 "%Y-%m-%d")
+                filter_element = datetime.strptime(
+                    filter['value'].replace("'", ''), "%Y-%m-%d")
+            else:
+                data_element = line_data[filter_position]
+                filter_element = filter['value'].replace("'", '')
+
+            if filter['operator'] == '=' and data_element == filter_element:
+                file_data.append(line_data)
+            elif filter['operator'] == '<' and data_element < filter_element:
+                file_data.append(line_data)
+
+    return file_data
+
+
+def compiled_filter_rows(rows, filters, column_positions, column_datatypes):
+    '''filters rows the way file_to_data_structure does
+'''
+
+    for row_filter in compile_filters(filters, column_positions,
+                                      column_datatypes):
+        rows = filter(row_filter, rows)
+
+    return list(rows)
+
+
+def benchmark_filters(scale_factor=0.01):
+    '''compares filtering the tables of tcph3 with the interpreted filter
+        loop and with compiled filters.  orders is also filtered on
+        o_orderstatus as well as o_orderdate, to compare a conjunction
+
+    keyword_args:
+        scale_factor - TPC-H scale factor of the generated data
+'''
+
+    with open('tcph3.sql') as f:
+        tcph3_filters = sql_to_tree(f.read())['filters']
+    status_filter = {'identifier': 'o_orderstatus', 'operator': '=',
+                     'value': "'F'"}
+
+    directory = tempfile.mkdtemp()
+    try:
+        generate_tcph_data(directory, scale_factor)
+
+        print('tcph3 filter time (ms) at scale factor ' + str(scale_factor))
+        print('table        filters   interpreted   compiled   speedup'
+              '   rows kept')
+        for table_name, filters in [
+                ('customer', tcph3_filters),
+                ('orders', tcph3_filters),
+                ('orders', tcph3_filters + [status_filter])]:
+            local_filename = os.path.join(directory, 'tcph_' + table_name)
+            column_positions, column_datatypes, file_data = \
+                file_to_data_structure(local_filename)
+            filters = [f for f in filters
+                       if f['identifier'] in column_positions]
+            rows = read_rows_as_strings(local_filename)
+
+            interpreted_time = best_time(
+                lambda: interpreted_filter_rows(rows, filters,
+                                                column_positions,
+                                                column_datatypes), 1, 3)
+            compiled_time = best_time(
+                lambda: compiled_filter_rows(rows, filters, column_positions,
+                                             column_datatypes), 1, 3)
+            interpreted_rows = len(interpreted_filter_rows(
+                rows, filters, column_positions, column_datatypes))
+            compiled_rows = len(compiled_filter_rows(
+                rows, filters, column_positions, column_datatypes))
+
+            print('%-12s %7d %13.2f %10.2f %8.1fx %6d / %d' %
+                  (table_name, len(filters), interpreted_time * 1000,
+                   compiled_time * 1000, interpreted_time / compiled_time,
+                   compiled_rows, interpreted_rows))
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_scan_engines(scale_factor=0.05):
+    '''compares reading and filtering the tables of each tcph query with the
+        python and numpy scan engines, and checks that they read the same
+        data
+
+    keyword_args:
+        scale_factor - TPC-H scale factor of the generated data
+'''
+
+    if file_query_utilities.numpy is None:
+        print('numpy is not installed')
+        return
+
+    directory = tempfile.mkdtemp()
+    try:
+        generate_tcph_data(directory, scale_factor)
+
+        print('scan time per query (s) at scale factor ' + str(scale_factor))
+        print('query          python     numpy   speedup   same data')
+        for sql_file in tcph_sql_files:
+            with open(sql_file) as f:
+                sql_tree = sql_to_tree(f.read())
+
+            scan_times = {}
+            scanned_tables = {}
+            for scan_engine in ['python', 'numpy']:
+                file_query_utilities.default_scan_engine = scan_engine
+                scan_times[scan_engine] = best_time(
+                    lambda: load_tcph_tables(sql_tree, directory), 1, 3)
+                scanned_tables[scan_engine] = \
+                    load_tcph_tables(sql_tree, directory)
+
+            print('%-10s %10.3f %9.3f %8.1fx   %s' %
+                  (sql_file, scan_times['python'], scan_times['numpy'],
+                   scan_times['python'] / scan_times['numpy'],
+                   scanned_tables['python'] == scanned_tables['numpy']))
+    finally:
+        file_query_utilities.default_scan_engine = default_scan_engine
+        shutil.rmtree(directory)
+
+
+def benchmark_projection(scale_factors=[0.01, 0.05]):
+    '''compares the time and peak memory of each tcph query when tables keep
+        every column and when they only keep the columns the query refers to
+
+    keyword_args:
+        scale_factors - TPC-H scale factors of the generated data
+'''
+
+    for scale_factor in scale_factors:
+        directory = tempfile.mkdtemp()
+        try:
+            generate_tcph_data(directory, scale_factor)
+
+            print('scale factor ' + str(scale_factor) +
+                  ': query time (s) and peak memory (MB)')
+            print('query       all columns     projected      memory saved')
+            for sql_file in tcph_sql_files:
+                results = {}
+                for projection in [False, True]:
+                    results[projection] = measure(
+                        lambda: run_tcph_query(sql_file, directory,
+                                               projection))
+
+                print('%-10s %6.3f %6.1f %6.3f %6.1f %12.0f%%' %
+                      (sql_file, results[False][0],
+                       results[False][1] / 1024 ** 2, results[True][0],
+                       results[True][1] / 1024 ** 2,
+                       100 - results[True][1] * 100 / results[False][1]))
+        finally:
+            shutil.rmtree(directory)
+
+
+def run_tcph_query_on_batches(sql_file, directory):
+    '''parses a single table tcph query and executes it against a table in
+        a local directory, reading the table a batch of rows at a time, as
+        execute_sqltree_on_s3 does
+
+    keyword_args:
+        sql_file - name of the file holding the query
+        directory - local directory holding the table
+
+    returns:
+        the query result, as returned by execute_sqltree_on_s3
+'''
+
+    with open(sql_file) as f:
+        sql_tree = sql_to_tree(f.read())
+
+    table_definition = sql_tree['table_definitions'][0]
+    alias = table_definition['alias'] or table_definition['name']
+    local_filename, s3_filename = \
+        s3_file_names(table_definition['name'], table_definition['schema'])
+
+    return execute_sqltree_on_batches(
+        sql_tree, alias,
+        file_to_data_batches(os.path.join(directory, local_filename),
+                             sql_tree, columns=sql_tree_columns(sql_tree)))
+
+
+def benchmark_batches(scale_factors=[0.01, 0.05, 0.1]):
+    '''compares the time and peak memory of tcph1 when lineitem is read as
+        a whole and when it is read and aggregated a batch at a time.  the
+        peak memory of the batched scan shouldn't grow with the scale factor
+
+    keyword_args:
+        scale_factors - TPC-H scale factors of the generated data
+'''
+
+    print('tcph1: query time (s) and peak memory (MB)')
+    print('scale factor   whole table      batches')
+    for scale_factor in scale_factors:
+        directory = tempfile.mkdtemp()
+        try:
+            generate_tcph_data(directory, scale_factor)
+
+            assert run_tcph_query('tcph1.sql', directory) == \
+                run_tcph_query_on_batches('tcph1.sql', directory)
+
+            whole = measure(lambda: run_tcph_query('tcph1.sql', directory))
+            batched = measure(
+                lambda: run_tcph_query_on_batches('tcph1.sql', directory))
+
+            print('%-12s %6.3f %6.1f %6.3f %6.1f' %
+                  (scale_factor, whole[0], whole[1] / 1024 ** 2,
+                   batched[0], batched[1] / 1024 ** 2))
+        finally:
+            shutil.rmtree(directory)
+
+
+def load_columnar_tcph_tables(sql_tree, directory):
+    '''reads the tables of a query from their columnar layouts in a local
+        directory, as execute_sqltree_on_s3 reads cached tables
+
+    keyword_args:
+        sql_tree - a sql tree, as generated by sql_to_tree library
+        directory - local directory holding the tables, converted by
+                    write_columnar_layout with the ETags benchmark_etags
+
+    returns:
+        dictionary of tables, as used by execute_sqltree_on_tables
+'''
+
+    query_columns = sql_tree_columns(sql_tree)
+
+    tables = {}
+    for table_definition in sql_tree['table_definitions']:
+        alias = table_definition['alias'] or table_definition['name']
+        local_filename, s3_filename = \
+            s3_file_names(table_definition['name'],
+                          table_definition['schema'])
+        column_positions, column_datatypes, batches = \
+            columnar_to_data_batches(
+                layout_directory(os.path.join(directory, local_filename),
+                                 benchmark_etags),
+                sql_tree, query_columns)
+        tables[alias] = (column_positions, column_datatypes,
+                         concatenate_batches(batches))
+
+    return tables
+
+
+def benchmark_columnar(scale_factor=0.05):
+    '''compares reading the tables of each tcph query from CSV files with
+        reading them from their columnar layouts, and checks that they read
+        the same data.  the one-time conversion to columnar layouts is also
+        timed
+
+    keyword_args:
+        scale_factor - TPC-H scale factor of the generated data
+'''
+
+    directory = tempfile.mkdtemp()
+    try:
+        generate_tcph_data(directory, scale_factor)
+
+        start_time = timeit.default_timer()
+        for local_filename in os.listdir(directory):
+            if not local_filename.endswith('_header'):
+                write_columnar_layout(os.path.join(directory, local_filename),
+                                      benchmark_etags)
+        print('conversion to columnar layouts: %.3fs' %
+              (timeit.default_timer() - start_time))
+
+        print('scan time per query (s) at scale factor ' + str(scale_factor))
+        print('query             csv  columnar   speedup   same data')
+        for sql_file in tcph_sql_files:
+            with open(sql_file) as f:
+                sql_tree = sql_to_tree(f.read())
+
+            csv_time = best_time(
+                lambda: load_tcph_tables(sql_tree, directory), 1, 3)
+            columnar_time = best_time(
+                lambda: load_columnar_tcph_tables(sql_tree, directory), 1, 3)
+
+            print('%-10s %10.3f %9.3f %8.1fx   %s' %
+                  (sql_file, csv_time, columnar_time,
+                   csv_time / columnar_time,
+                   load_tcph_tables(sql_tree, directory) ==
+                   load_columnar_tcph_tables(sql_tree, directory)))
+    finally:
+        shutil.rmtree(directory)
+
+
+def cluster_tcph_table(directory, table_name, column_name):
+    '''sorts a generated table on one of its columns, so that the values
+        of the column are clustered as they are in tables loaded in date
+        order
+
+    keyword_args:
+        directory - local directory holding the table
+        table_name - name of the table
+        column_name - name of the column to sort on
+'''
+
+    filename = os.path.join(directory, 'tcph_' + table_name)
+
+    with open(filename, newline='') as data_file:
+        rows = list(csv.reader(data_file))
+    position = rows[0].index(column_name)
+
+    with open(filename, 'w', newline='') as data_file:
+        data_writer = csv.writer(data_file)
+        data_writer.writerow(rows[0])
+        data_writer.writerows(sorted(rows[1:], key=lambda row: row[position]))
+
+
+def run_columnar_tcph_query(sql_file, directory):
+    '''parses a tcph query and executes it against the columnar layouts of
+        tables in a local directory, as execute_sqltree_on_s3 executes it
+        against cached tables.  the indexes of the layouts are used for
+        equality filters and joins
+
+    keyword_args:
+        sql_file - name of the file holding the query
+        directory - local directory holding the tables, converted by
+                    write_columnar_layout with the ETags benchmark_etags
+
+    returns:
+        the query result, as returned by execute_sqltree_on_s3
+'''
+
+    with open(sql_file) as f:
+        sql_tree = sql_to_tree(f.read())
+
+    tables = load_columnar_tcph_tables(sql_tree, directory)
+
+    table_indexes = {}
+    for table_definition in sql_tree['table_definitions']:
+        alias = table_definition['alias'] or table_definition['name']
+        local_filename, s3_filename = \
+            s3_file_names(table_definition['name'],
+                          table_definition['schema'])
+        table_indexes[alias] = layout_indexes(
+            layout_directory(os.path.join(directory, local_filename),
+                             benchmark_etags), sql_tree)
+
+    try:
+        return execute_sqltree_on_tables(sql_tree, tables, table_indexes)
+    finally:
+        for indexes in table_indexes.values():
+            for index in indexes.values():
+                index.close()
+
+
+def benchmark_indexes(scale_factor=0.05):
+    '''compares executing each tcph query against columnar layouts with and
+        without indexes on their join and equality filter columns, and
+        checks that the results are the same.  building the indexes is also
+        timed
+
+    keyword_args:
+        scale_factor - TPC-H scale factor of the generated data
+'''
+
+    index_columns = {'c_custkey', 'o_custkey', 'o_orderkey', 'l_orderkey',
+                     'p_partkey', 'ps_partkey', 's_suppkey', 'ps_suppkey',
+                     'n_nationkey', 's_nationkey', 'r_regionkey',
+                     'n_regionkey', 'c_mktsegment', 'p_size', 'r_name'}
+
+    directory = tempfile.mkdtemp()
+    try:
+        generate_tcph_data(directory, scale_factor)
+
+        layouts = []
+        for local_filename in os.listdir(directory):
+            if not local_filename.endswith('_header'):
+                layouts.append(write_columnar_layout(
+                    os.path.join(directory, local_filename),
+                    benchmark_etags))
+
+        unindexed_times = {}
+        for sql_file in tcph_sql_files:
+            unindexed_times[sql_file] = best_time(
+                lambda: run_columnar_tcph_query(sql_file, directory), 1, 3)
+
+        start_time = timeit.default_timer()
+        for layout in layouts:
+            for column_name in index_columns:
+                write_column_index(layout, column_name)
+        print('building indexes: %.3fs' %
+              (timeit.default_timer() - start_time))
+
+        print('query time (s) at scale factor ' + str(scale_factor))
+        print('query       no indexes   indexes   speedup   lookups  joins'
+              '   same result')
+        for sql_file in tcph_sql_files:
+            indexed_time = best_time(
+                lambda: run_columnar_tcph_query(sql_file, directory), 1, 3)
+
+            clear_scan_statistics()
+            same_result = run_columnar_tcph_query(sql_file, directory) == \
+                run_tcph_query(sql_file, directory)
+
+            print('%-10s %10.3f %9.3f %8.1fx %9d %6d   %s' %
+                  (sql_file, unindexed_times[sql_file], indexed_time,
+                   unindexed_times[sql_file] / indexed_time,
+                   scan_statistics['index_lookups'],
+                   scan_statistics['index_joins'], same_result))
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_zone_maps(scale_factor=0.05):
+    '''compares reading the tables of each tcph query with and without zone
+        maps, from CSV files and from columnar layouts, and counts the
+        blocks that are skipped.  orders and lineitem are sorted on
+        o_orderdate and l_shipdate first, so that their dates are clustered
+
+    keyword_args:
+        scale_factor - TPC-H scale factor of the generated data
+'''
+
+    directory = tempfile.mkdtemp()
+    try:
+        generate_tcph_data(directory, scale_factor)
+        cluster_tcph_table(directory, 'orders', 'o_orderdate')
+        cluster_tcph_table(directory, 'lineitem', 'l_shipdate')
+
+        scanned_tables = {}
+        scan_times = {}
+        for sql_file in tcph_sql_files:
+            with open(sql_file) as f:
+                sql_tree = sql_to_tree(f.read())
+            scanned_tables[sql_file] = load_tcph_tables(sql_tree, directory)
+            scan_times[sql_file] = best_time(
+                lambda: load_tcph_tables(sql_tree, directory), 1, 3)
+
+        for local_filename in os.listdir(directory):
+            if not local_filename.endswith('_header'):
+                write_zone_maps(os.path.join(directory, local_filename))
+                write_columnar_layout(os.path.join(directory, local_filename),
+                                      benchmark_etags)
+
+        print('scan time per query (s) at scale factor ' + str(scale_factor))
+        print('query         csv   zone maps  columnar zone maps   '
+              'blocks skipped   same data')
+        for sql_file in tcph_sql_files:
+            with open(sql_file) as f:
+                sql_tree = sql_to_tree(f.read())
+
+            clear_scan_statistics()
+            same_data = load_tcph_tables(sql_tree, directory) == \
+                scanned_tables[sql_file]
+            blocks = (scan_statistics['blocks_skipped'],
+                      scan_statistics['blocks_scanned'] +
+                      scan_statistics['blocks_skipped'])
+            same_data = same_data and scanned_tables[sql_file] == \
+                load_columnar_tcph_tables(sql_tree, directory)
+
+            zone_map_time = best_time(
+                lambda: load_tcph_tables(sql_tree, directory), 1, 3)
+            columnar_time = best_time(
+                lambda: load_columnar_tcph_tables(sql_tree, directory), 1, 3)
+
+            print('%-10s %6.3f %11.3f %19.3f %8d of %5d   %s' %
+                  (sql_file, scan_times[sql_file], zone_map_time,
+                   columnar_time, blocks[0], blocks[1], same_data))
+    finally:
+        shutil.rmtree(directory)
+
+
+def run_tcph_join_plan(sql_file, directory, cost_based=True):
+    '''parses a tcph query and executes it against tables in a local
+        directory, with its joins ordered by their cost or, as they used to
+        be, only so that each join has a table in common with the joins
+        before it
+
+    keyword_args:
+        sql_file - name of the file holding the query
+        directory - local directory holding the tables
+        cost_based - if False, the joins are ordered without statistics
+
+    returns:
+        a tuple of the query result and the join plan, as kept in the sql
+        tree by execute_sqltree_on_tables
+'''
+
+    with open(sql_file) as f:
+        sql_tree = sql_to_tree(f.read())
+    tables = load_tcph_tables(sql_tree, directory)
+
+    try:
+        if not cost_based:
+            virtual_S3_module.join_statistics = \
+                lambda tables, join_columns, stored_statistics=None: None
+        result = execute_sqltree_on_tables(sql_tree, tables)
+    finally:
+        virtual_S3_module.join_statistics = join_statistics
+
+    return result, sql_tree['join_plan']
+
+
+def benchmark_join_order(scale_factors=[0.01, 0.05]):
+    '''compares executing the tcph queries with joins with their joins in
+        the order they used to be in and in the order chosen by their cost,
+        and prints the estimated and actual rows after each join of both
+        plans
+
+    keyword_args:
+        scale_factors - TPC-H scale factors of the generated data
+'''
+
+    for scale_factor in scale_factors:
+        directory = tempfile.mkdtemp()
+        try:
+            generate_tcph_data(directory, scale_factor)
+
+            print('scale factor ' + str(scale_factor) +
+                  ': query time (s) and rows after each join')
+            for sql_file in ['tcph2.sql', 'tcph3.sql']:
+                results = {}
+                for cost_based in [False, True]:
+                    query_time = best_time(
+                        lambda: run_tcph_join_plan(sql_file, directory,
+                                                   cost_based), 1, 3)
+                    result, join_plan = \
+                        run_tcph_join_plan(sql_file, directory, cost_based)
+                    results[cost_based] = result
+
+                    print('%-10s %-11s %6.3f   intermediate rows %d' %
+                          (sql_file, ['in order', 'cost based'][cost_based],
+                           query_time, sum(join['rows']
+                                           for join in join_plan)))
+                    for join in join_plan:
+                        estimated_rows = join.get('estimated_rows')
+                        if estimated_rows is None:
+                            estimated_rows = '-'
+                        else:
+                            estimated_rows = '%.0f' % estimated_rows
+                        print('    %-28s estimated %8s   actual %8d' %
+                              (' - '.join(join['join_tables']),
+                               estimated_rows, join['rows']))
+
+                print('%-10s same result  %s' %
+                      (sql_file, results[False] == results[True]))
+        finally:
+            shutil.rmtree(directory)
+
+
+def benchmark_statistics(scale_factor=0.05):
+    '''times collecting the statistics of each generated table, and
+        compares the fraction of rows that pass each filter of the tcph
+        queries with the fraction estimated from the statistics and the
+        fraction guessed from the filter's operator
+
+    keyword_args:
+        scale_factor - TPC-H scale factor of the generated data
+'''
+
+    directory = tempfile.mkdtemp()
+    try:
+        generate_tcph_data(directory, scale_factor)
+
+        print('statistics collection time (s) at scale factor ' +
+              str(scale_factor))
+        table_statistics = {}
+        for local_filename in sorted(os.listdir(directory)):
+            if local_filename.endswith('_header'):
+                continue
+            start_time = timeit.default_timer()
+            table_statistics[local_filename] = write_table_statistics(
+                os.path.join(directory, local_filename))
+            print('%-20s %8d rows %8.3f' %
+                  (local_filename,
+                   table_statistics[local_filename]['row_count'],
+                   timeit.default_timer() - start_time))
+
+        print('fraction of rows passing each filter')
+        print('query      filter                          actual   estimated'
+              '   guessed')
+        for sql_file in tcph_sql_files:
+            with open(sql_file) as f:
+                sql_tree = sql_to_tree(f.read())
+
+            for table_definition in sql_tree['table_definitions']:
+                local_filename = s3_file_names(table_definition['name'],
+                                               table_definition['schema'])[0]
+                column_positions, column_datatypes, file_data = \
+                    file_to_data_structure(os.path.join(directory,
+                                                        local_filename))
+                row_count = table_statistics[local_filename]['row_count']
+
+                for filter in sql_tree['filters']:
+                    if filter['identifier'] not in column_positions:
+                        continue
+                    passed_rows = compile_column_filters(
+                        [filter], column_positions, column_datatypes)[0](
+                        file_data, range(row_count))
+                    estimate = estimate_filter_selectivity(
+                        table_statistics[local_filename]['columns'][
+                            filter['identifier']], row_count,
+                        column_datatypes[filter['identifier']],
+                        filter['operator'], filter['value'])
+
+                    print('%-10s %-30s %7.3f %11.3f %9.3f' %
+                          (sql_file, (filter['identifier'] + ' ' +
+                                      filter['operator'] + ' ' +
+                                      filter['value'])[:30],
+                           len(passed_rows) / row_count, estimate,
+                           filter_selectivities[filter['operator']]))
+    finally:
+        shutil.rmtree(directory)
+
+
+def appending_join_data(join, dataset, column_map, previously_joined_tables,
+                        indexes=None, sorted_columns=None,
+                        memory_budget=None, spill_directory=None):
+    '''joins two tables of a columnar dataset the way join_data used to,
+        as a dictionary of each left row's right rows, walked once for every
+        column to append its values one at a time.  used as a baseline, so
+        indexes, sorted columns and the memory budget are ignored
+'''
+    if len(dataset[join['left_identifier']]) < \
+            len(dataset[join['right_identifier']]):
+        left_identifier = join['left_identifier']
+        right_identifier = join['right_identifier']
+    else:
+        left_identifier = join['right_identifier']
+        right_identifier = join['left_identifier']
+    left_table = column_map[left_identifier][0]
+    right_table = column_map[right_identifier][0]
+
+    hashtable = {}
+    for i, v in enumerate(dataset[right_identifier]):
+        try:
+            hashtable[v].append(i)
+        except KeyError:
+            hashtable[v] = [i]
+    table_joins = {}
+    for i, v in enumerate(dataset[left_identifier]):
+        if v is not None:
+            right_rows = hashtable.get(v)
+            if right_rows is not None:
+                table_joins[i] = right_rows
+
+    result_data = {}
+    for k, column in column_map.items():
+        result_data[k] = new_column_like(dataset[k])
+        select_table = column[0]
+
+        if select_table in [left_table, right_table] \
+                or select_table in previously_joined_tables:
+            for left_row, right_rows in table_joins.items():
+                for i, right_row in enumerate(right_rows):
+                    if select_table == left_table:
+                        result_data[k].append(dataset[k][left_row])
+                    elif select_table == right_table:
+                        result_data[k].append(dataset[k][right_row])
+                    elif select_table in previously_joined_tables:
+                        if left_table in previously_joined_tables:
+                            result_data[k].append(dataset[k][left_row])
+                        elif right_table in previously_joined_tables:
+                            result_data[k].append(dataset[k][right_row])
+        else:
+            result_data[k] = dataset[k]
+
+    return result_data
+
+
+def execute_with_join(sql_tree, tables, join_function):
+    '''executes a SQL tree against tables that have already been read,
+        joining them with the given function in place of join_data
+
+    keyword_args:
+        sql_tree - a sql tree, as generated by sql_to_tree library
+        tables - dictionary of tables, as used by execute_sqltree_on_tables
+        join_function - function with the arguments of join_data
+
+    returns:
+        the query result, as returned by execute_sqltree_on_s3
+'''
+    try:
+        virtual_S3_module.join_data = join_function
+        return execute_sqltree_on_tables(sql_tree, tables)
+    finally:
+        virtual_S3_module.join_data = join_data
+
+
+# lineitems of the parts and suppliers in partsupp, joined on both columns
+multi_column_join_sql = '''select l_orderkey, ps_availqty, ps_supplycost
+from tcph.lineitem, tcph.partsupp
+where l_partkey = ps_partkey and l_suppkey = ps_suppkey'''
+
+
+def benchmark_hash_join(scale_factors=[0.01, 0.05, 0.1]):
+    '''compares executing the tcph queries with joins with the join that
+        appended values one column and one row at a time, and with the
+        join that finds the joined rows once and gathers each column from
+        them, and checks that the results are the same.  a join on two
+        columns, which the old join couldn't apply, is also timed and
+        checked against the rows that should join
+
+    keyword_args:
+        scale_factors - TPC-H scale factors of the generated data
+'''
+
+    for scale_factor in scale_factors:
+        directory = tempfile.mkdtemp()
+        try:
+            generate_tcph_data(directory, scale_factor)
+
+            print('query execution time (s), once its tables are read, at '
+                  'scale factor ' + str(scale_factor))
+            print('query         appending   row ids   speedup   same result')
+            sql_files = ['tcph2.sql', 'tcph3.sql', None]
+            for sql_file in sql_files:
+                if sql_file is None:
+                    sql = multi_column_join_sql
+                else:
+                    with open(sql_file) as f:
+                        sql = f.read()
+                sql_tree = sql_to_tree(sql)
+                tables = load_tcph_tables(sql_tree, directory)
+
+                row_id_time = best_time(
+                    lambda: execute_with_join(sql_tree, tables, join_data),
+                    1, 3)
+                result = execute_with_join(sql_tree, tables, join_data)
+
+                if sql_file is None:
+                    partsupp = file_to_data_structure(
+                        os.path.join(directory, 'tcph_partsupp'))[2]
+                    lineitem = file_to_data_structure(
+                        os.path.join(directory, 'tcph_lineitem'))[2]
+                    partsupp_keys = set(zip(partsupp[0], partsupp[1]))
+                    expected_rows = sum(
+                        1 for key in zip(lineitem[1], lineitem[2])
+                        if key in partsupp_keys)
+                    print('%-12s %10s %9.3f %9s   %s' %
+                          ('two columns', '-', row_id_time, '-',
+                           len(result[1]) == expected_rows))
+                    continue
+
+                appending_time = best_time(
+                    lambda: execute_with_join(sql_tree, tables,
+                                              appending_join_data), 1, 3)
+                same_result = result == execute_with_join(
+                    sql_tree, tables, appending_join_data)
+
+                print('%-12s %10.3f %9.3f %8.1fx   %s' %
+                      (sql_file, appending_time, row_id_time,
+                       appending_time / row_id_time, same_result))
+        finally:
+            shutil.rmtree(directory)
+
+
+def load_tcph_tables_with_semi_joins(sql_tree, directory):
+    '''reads the tables of a query from a local directory, as
+        execute_sqltree_on_s3 reads them once they are downloaded when the
+        query has filters: small, filtered tables first, each filtering the
+        tables it joins with a Bloom filter of its join keys
+
+    keyword_args:
+        sql_tree - a sql tree, as generated by sql_to_tree library
+        directory - local directory holding the tables
+
+    returns:
+        dictionary of tables, in the order of the query, as used by
+        execute_sqltree_on_tables
+'''
+
+    query_columns = sql_tree_columns(sql_tree)
+    local_filenames = {}
+    table_datatypes = {}
+    table_sizes = {}
+    for table_definition in sql_tree['table_definitions']:
+        alias = table_definition['alias'] or table_definition['name']
+        local_filenames[alias] = os.path.join(directory, s3_file_names(
+            table_definition['name'], table_definition['schema'])[0])
+        with open(local_filenames[alias] + '_header', newline='') as \
+                lfile_header:
+            table_datatypes[alias] = header_datatypes(lfile_header)
+        table_sizes[alias] = os.path.getsize(local_filenames[alias])
+
+    tables = read_tables_with_semi_joins(
+        sql_tree, table_datatypes, table_sizes, {},
+        lambda alias, table_sql_tree: file_to_data_structure(
+            local_filenames[alias], table_sql_tree, columns=query_columns))
+
+    return {alias: tables[alias] for alias in local_filenames}
+
+
+def run_tcph_semi_joins(sql_file, directory, semi_joins=True):
+    '''parses a tcph query, reads its tables from a local directory with or
+        without semi-joins, and executes it
+
+    keyword_args:
+        sql_file - name of the file holding the query
+        directory - local directory holding the tables
+        semi_joins - if False, every table is read with only its own
+                     filters, as tables used to be
+
+    returns:
+        a tuple of the query result, the number of rows read into memory
+        and the semi-joins, as kept in the sql tree by
+        read_tables_with_semi_joins
+'''
+
+    with open(sql_file) as f:
+        sql_tree = sql_to_tree(f.read())
+    if semi_joins:
+        tables = load_tcph_tables_with_semi_joins(sql_tree, directory)
+    else:
+        tables = load_tcph_tables(sql_tree, directory)
+    rows_read = sum(batch_length(table[2]) for table in tables.values())
+
+    return execute_sqltree_on_tables(sql_tree, tables), rows_read, \
+        sql_tree.get('semi_joins', [])
+
+
+def benchmark_semi_joins(scale_factors=[0.01, 0.05, 0.1]):
+    '''compares reading and executing the tcph queries with joins with and
+        without Bloom filters of the join keys of filtered tables pushed
+        into the scans of the tables they join, and prints the rows each
+        semi-join eliminated and its false-positive rate
+
+    keyword_args:
+        scale_factors - TPC-H scale factors of the generated data
+'''
+
+    for scale_factor in scale_factors:
+        directory = tempfile.mkdtemp()
+        try:
+            generate_tcph_data(directory, scale_factor)
+
+            print('scale factor ' + str(scale_factor) +
+                  ': query time (s), including reading its tables, and '
+                  'rows read into memory')
+            for sql_file in ['tcph2.sql', 'tcph3.sql']:
+                results = {}
+                for semi_joins in [False, True]:
+                    query_time = best_time(
+                        lambda: run_tcph_semi_joins(sql_file, directory,
+                                                    semi_joins), 1, 3)
+                    result, rows_read, semi_join_plan = \
+                        run_tcph_semi_joins(sql_file, directory, semi_joins)
+                    results[semi_joins] = result
+
+                    print('%-10s %-11s %6.3f   rows read %8d' %
+                          (sql_file, ['filters', 'semi-joins'][semi_joins],
+                           query_time, rows_read))
+                    for semi_join in semi_join_plan:
+                        print('    %-26s checked %8d   eliminated %8d   '
+                              'false positives %5.2f%%' %
+                              (semi_join['build_column'] + ' -> ' +
+                               semi_join['probe_column'],
+                               semi_join['rows_checked'],
+                               semi_join['rows_eliminated'],
+                               semi_join['false_positive_rate'] * 100))
+
+                print('%-10s same result  %s' %
+                      (sql_file, results[False] == results[True]))
+        finally:
+            shutil.rmtree(directory)
+
+
+def benchmark_partitioned_join(scale_factors=[0.05, 0.1, 0.2],
+                               partition_count=8):
+    '''compares the time and peak memory of joining lineitem to orders, and
+        to partsupp on two columns, with a hashtable of every key of the
+        smaller table and with the join partitioned on disk, as it is when
+        that hashtable doesn't fit in join_memory_budget, and checks that
+        both find the same rows
+
+    keyword_args:
+        scale_factors - TPC-H scale factors of the generated data
+        partition_count - number of partitions the joins are split into,
+                          by setting the memory budget
+'''
+
+    print('join time (s) and peak memory (MB)')
+    print('scale factor  join                in memory     partitioned'
+          '   same rows')
+    for scale_factor in scale_factors:
+        directory = tempfile.mkdtemp()
+        try:
+            generate_tcph_data(directory, scale_factor)
+
+            tables = {}
+            for table_name in ['orders', 'partsupp', 'lineitem']:
+                column_positions, column_datatypes, file_data = \
+                    file_to_data_structure(
+                        os.path.join(directory, 'tcph_' + table_name))
+                tables[table_name] = {k: file_data[position] for k, position
+                                      in column_positions.items()}
+
+            for join_name, left_columns, right_columns in [
+                    ('orderkey', [tables['orders']['o_orderkey']],
+                     [tables['lineitem']['l_orderkey']]),
+                    ('partkey, suppkey',
+                     [tables['partsupp']['ps_partkey'],
+                      tables['partsupp']['ps_suppkey']],
+                     [tables['lineitem']['l_partkey'],
+                      tables['lineitem']['l_suppkey']])]:
+                in_memory = measure(lambda: file_query_utilities.column_join(
+                    left_columns, right_columns))
+                expected_rows = file_query_utilities.column_join(
+                    left_columns, right_columns)
+
+                join_memory_budget = file_query_utilities.join_memory_budget
+                try:
+                    file_query_utilities.join_memory_budget = \
+                        min(len(left_columns[0]), len(right_columns[0])) * \
+                        file_query_utilities.hashtable_row_bytes * 2 // \
+                        partition_count
+                    partitioned = measure(
+                        lambda: file_query_utilities.column_join(
+                            left_columns, right_columns))
+                    same_rows = expected_rows == \
+                        file_query_utilities.column_join(left_columns,
+                                                         right_columns)
+                finally:
+                    file_query_utilities.join_memory_budget = \
+                        join_memory_budget
+
+                print('%-12s  %-17s %6.3f %6.1f %6.3f %6.1f   %s' %
+                      (scale_factor, join_name, in_memory[0],
+                       in_memory[1] / 1024 ** 2, partitioned[0],
+                       partitioned[1] / 1024 ** 2, same_rows))
+        finally:
+            shutil.rmtree(directory)
+
+
+def benchmark_direct_join(scale_factors=[0.05, 0.1, 0.2]):
+    '''compares the build and probe throughput of joins on dense integer
+        keys with a hashtable of the keys and with a direct-address lookup
+        of the keys, an array indexed by the key, and checks that both find
+        the same rows.  as in column_join's direct lookup, the larger table
+        of each join is the one the lookup is built from, and the hashtable
+        is built from the same table to compare the two.  build throughput
+        counts the rows of that table and probe throughput counts the
+        joined rows
+
+    keyword_args:
+        scale_factors - TPC-H scale factors of the generated data
+'''
+
+    if file_query_utilities.numpy is None:
+        print('direct-address joins need numpy')
+        return
+
+    print('build and probe throughput (million rows/s)')
+    print('scale factor  join         build rows   hashtable         '
+          'direct            same rows')
+    print('                                        build    probe    '
+          'build    probe')
+    for scale_factor in scale_factors:
+        directory = tempfile.mkdtemp()
+        try:
+            generate_tcph_data(directory, scale_factor)
+
+            tables = {}
+            for table_name in ['supplier', 'customer', 'orders',
+                               'lineitem']:
+                column_positions, column_datatypes, file_data = \
+                    file_to_data_structure(
+                        os.path.join(directory, 'tcph_' + table_name))
+                tables[table_name] = {k: file_data[position] for k, position
+                                      in column_positions.items()}
+
+            for join_name, left_column, right_column in [
+                    ('suppkey', tables['supplier']['s_suppkey'],
+                     tables['lineitem']['l_suppkey']),
+                    ('custkey', tables['customer']['c_custkey'],
+                     tables['orders']['o_custkey']),
+                    ('orderkey', tables['orders']['o_orderkey'],
+                     tables['lineitem']['l_orderkey'])]:
+                hashtable = file_query_utilities.build_hashtable(
+                    right_column)
+                lookup = file_query_utilities.direct_lookup(left_column,
+                                                            right_column)
+                left_rows, right_rows = file_query_utilities.probe_hashtable(
+                    hashtable, left_column)
+                same_rows = (left_rows, right_rows) == \
+                    file_query_utilities.probe_direct_lookup(lookup,
+                                                             left_column)
+
+                times = [
+                    best_time(lambda: file_query_utilities.build_hashtable(
+                        right_column), 1, 3),
+                    best_time(lambda: file_query_utilities.probe_hashtable(
+                        hashtable, left_column), 1, 3),
+                    best_time(lambda: file_query_utilities.direct_lookup(
+                        left_column, right_column), 1, 3),
+                    best_time(
+                        lambda: file_query_utilities.probe_direct_lookup(
+                            lookup, left_column), 1, 3)]
+                rows = [len(right_column), len(left_rows)] * 2
+
+                print('%-12s  %-12s %10d  %s  %s' %
+                      (scale_factor, join_name, len(right_column),
+                       ' '.join('%8.2f' % (row_count / time / 1e6)
+                                for row_count, time in zip(rows, times)),
+                       same_rows))
+        finally:
+            shutil.rmtree(directory)
+
+
+def benchmark_merge_join(scale_factors=[0.05, 0.1, 0.2]):
+    '''compares the time and peak memory of joining orders to lineitem,
+        which are generated in order key order, with a hashtable, with a
+        direct-address lookup and by merging the two tables, and checks that
+        all of them find the same rows.  tables that are stored in order of
+        a join column are merged by join_data
+
+    keyword_args:
+        scale_factors - TPC-H scale factors of the generated data
+'''
+
+    print('join time (s) and peak memory (MB) of orderkey')
+    print('scale factor  hashtable       direct          merge'
+          '           same rows')
+    for scale_factor in scale_factors:
+        directory = tempfile.mkdtemp()
+        try:
+            generate_tcph_data(directory, scale_factor)
+
+            columns = []
+            for table_name, column_name in [('orders', 'o_orderkey'),
+                                            ('lineitem', 'l_orderkey')]:
+                column_positions, column_datatypes, file_data = \
+                    file_to_data_structure(
+                        os.path.join(directory, 'tcph_' + table_name))
+                columns.append(file_data[column_positions[column_name]])
+            left_column, right_column = columns
+
+            def hashtable_join():
+                return file_query_utilities.probe_hashtable(
+                    file_query_utilities.build_hashtable(right_column),
+                    left_column)
+
+            def direct_join():
+                lookup = file_query_utilities.direct_lookup(left_column,
+                                                            right_column)
+                if lookup is None:
+                    return hashtable_join()
+                return file_query_utilities.probe_direct_lookup(lookup,
+                                                                left_column)
+
+            def merge_join():
+                return file_query_utilities.merge_column_join(left_column,
+                                                              right_column)
+
+            results = []
+            expected_rows = hashtable_join()
+            same_rows = True
+            for join in [hashtable_join, direct_join, merge_join]:
+                results.append(measure(join))
+                same_rows = same_rows and join() == expected_rows
+
+            print('%-12s  %s   %s' %
+                  (scale_factor,
+                   ' '.join('%6.3f %6.1f ' % (elapsed_time,
+                                              peak_bytes / 1024 ** 2)
+                            for elapsed_time, peak_bytes, retained_bytes
+                            in results), same_rows))
+        finally:
+            shutil.rmtree(directory)
+
+
+# tcph2, with a filter on part that the generated parts pass, so that the
+# six tables have rows to join
+six_table_join_sql = '''select s_acctbal, s_name, n_name, p_partkey, p_mfgr,
+s_address, s_phone, s_comment
+from tcph.part, tcph.supplier, tcph.partsupp, tcph.partsuppcost,
+tcph.nation, tcph.region
+where p_partkey = ps_partkey and s_suppkey = ps_suppkey and p_size <= 5
+and s_nationkey = n_nationkey and n_regionkey = r_regionkey
+and r_name = 'AFRICA                   '
+and ps_supplycost = psc_min_supplycost
+order by s_acctbal, n_name, s_name, p_partkey'''
+
+
+def materializing_join_tables(join_plan, query_data, selected_columns,
+                              join_columns, indexes=None,
+                              sorted_columns=None, memory_budget=None,
+                              spill_directory=None):
+    '''applies a join plan the way join_tables used to, gathering every
+        selected column as well as the join columns at every join.  used as
+        a baseline, with the arguments of join_tables
+'''
+    selected_and_join_columns = {**selected_columns, **join_columns}
+    interim_data = {}
+    for k, column in selected_and_join_columns.items():
+        interim_data[k] = query_data[column[0]][column[1]]
+
+    previously_joined_tables = set()
+    for join in join_plan:
+        interim_data = join_data(join, interim_data,
+                                 selected_and_join_columns,
+                                 previously_joined_tables, indexes,
+                                 sorted_columns, memory_budget,
+                                 spill_directory)
+        previously_joined_tables.update(join['join_tables'])
+
+    return {k: interim_data[k] for k in selected_columns}
+
+
+def benchmark_late_materialization(scale_factors=[0.01, 0.05, 0.1]):
+    '''compares the time of executing the tcph queries with joins, and the
+        peak memory of their joins, when every selected column is gathered
+        by every join, and when the joins only carry the join columns and
+        the rows of each table, and the selected columns are gathered once,
+        after the last join.  checks that the results are the same.  tcph2
+        finds no rows in the generated data, so it is also run with a
+        filter on part that the generated parts pass
+
+    keyword_args:
+        scale_factors - TPC-H scale factors of the generated data
+'''
+
+    print('query execution time (s), once its tables are read, and peak '
+          'memory of its joins (MB)')
+    print('scale factor  query        every join      after joins'
+          '     same result')
+    for scale_factor in scale_factors:
+        directory = tempfile.mkdtemp()
+        try:
+            generate_tcph_data(directory, scale_factor)
+
+            for sql_file in ['tcph2.sql', 'tcph3.sql', None]:
+                if sql_file is None:
+                    sql_file = 'six tables'
+                    sql_tree = sql_to_tree(six_table_join_sql)
+                else:
+                    with open(sql_file) as f:
+                        sql_tree = sql_to_tree(f.read())
+                tables = load_tcph_tables(sql_tree, directory)
+
+                materializing = measure_joins(
+                    lambda: execute_sqltree_on_tables(sql_tree, tables),
+                    materializing_join_tables)
+                late = measure_joins(
+                    lambda: execute_sqltree_on_tables(sql_tree, tables))
+
+                print('%-12s  %-11s %6.3f %6.1f   %6.3f %6.1f    %s' %
+                      (scale_factor, sql_file, materializing[0],
+                       materializing[1] / 1024 ** 2, late[0],
+                       late[1] / 1024 ** 2, materializing[2] == late[2]))
+        finally:
+            shutil.rmtree(directory)
+
+
+def unreleasing_join_tables(join_plan, query_data, selected_columns,
+                            join_columns, indexes=None, sorted_columns=None,
+                            memory_budget=None, spill_directory=None):
+    '''applies a join plan the way join_tables used to, carrying every join
+        column and the row numbers of every table through all of the joins.
+        used as a baseline, with the arguments of join_tables
+'''
+    joined_tables = set()
+    for join in join_plan:
+        joined_tables.update(join['join_tables'])
+
+    row_columns = {(alias, 'rows'): (alias, None) for alias in joined_tables}
+    carried_columns = {**join_columns, **row_columns}
+    interim_data = {}
+    for k, column in join_columns.items():
+        interim_data[k] = query_data[column[0]][column[1]]
+    for k, column in row_columns.items():
+        interim_data[k] = range(batch_length(query_data[column[0]]))
+
+    previously_joined_tables = set()
+    for join in join_plan:
+        interim_data = virtual_S3_module.join_data(
+            join, interim_data, carried_columns, previously_joined_tables,
+            indexes, sorted_columns, memory_budget, spill_directory)
+        previously_joined_tables.update(join['join_tables'])
+
+    selected_data = {}
+    for k, column in selected_columns.items():
+        selected_data[k] = query_data[column[0]][column[1]]
+        if column[0] in joined_tables:
+            selected_data[k] = gather_rows(selected_data[k],
+                                           interim_data[(column[0], 'rows')])
+
+    return selected_data
+
+
+def benchmark_liveness(scale_factors=[0.05, 0.1, 0.2]):
+    '''compares the time of executing the six table tcph2 query, with a
+        filter on part that the generated parts pass, and the peak memory
+        of its joins, when every join column is carried through all of the
+        joins and when each is released after the last join that uses it,
+        and checks that the results are the same
+
+    keyword_args:
+        scale_factors - TPC-H scale factors of the generated data
+'''
+
+    print('query execution time (s), once its tables are read, and peak '
+          'memory of its joins (MB)')
+    print('scale factor  kept            released        same result')
+    for scale_factor in scale_factors:
+        directory = tempfile.mkdtemp()
+        try:
+            generate_tcph_data(directory, scale_factor)
+            sql_tree = sql_to_tree(six_table_join_sql)
+            tables = load_tcph_tables(sql_tree, directory)
+
+            kept = measure_joins(
+                lambda: execute_sqltree_on_tables(sql_tree, tables),
+                unreleasing_join_tables)
+            released = measure_joins(
+                lambda: execute_sqltree_on_tables(sql_tree, tables))
+
+            print('%-12s  %6.3f %6.1f   %6.3f %6.1f   %s' %
+                  (scale_factor, kept[0], kept[1] / 1024 ** 2, released[0],
+                   released[1] / 1024 ** 2, kept[2] == released[2]))
+        finally:
+            shutil.rmtree(directory)
+
+
+def row_list_aggregate(batch, grouping_positions, aggregate_functions):
+    '''groups the rows of a batch and aggregates each group the way
+        execute_sqltree_on_tables used to, with a list of the rows of each
+        group and a list of the values of each group for every aggregate.
+        used as a baseline, with the arguments of aggregate_batches and a
+        single batch
+
+    returns:
+        the same as aggregate_batches
+'''
+    grouping_rows = {}
+    grouping_data = [batch[position] for position in grouping_positions]
+    for row, unique_grouping in enumerate(zip(*grouping_data)):
+        try:
+            grouping_rows[unique_grouping].append(row)
+        except KeyError:
+            grouping_rows[unique_grouping] = [row]
+
+    aggregates = []
+    for function, position in aggregate_functions:
+        aggregate_values = []
+        for rows in grouping_rows.values():
+            if position is None:
+                aggregate_values.append(len(set(rows)))
+                continue
+
+            aggregate_column = batch[position]
+            group_list = [aggregate_column[row] for row in rows]
+            if not isinstance(aggregate_column, array):
+                group_list = [v for v in group_list if v is not None]
+
+            if function == 'count':
+                aggregate_values.append(len(set(group_list)))
+            elif len(group_list) == 0:
+                aggregate_values.append(None)
+            elif function == 'sum':
+                aggregate_values.append(sum(group_list))
+            elif function == 'max':
+                aggregate_values.append(max(group_list))
+            elif function == 'min':
+                aggregate_values.append(min(group_list))
+            elif function == 'avg':
+                aggregate_values.append(sum(group_list) / len(group_list))
+        aggregates.append(aggregate_values)
+
+    return list(grouping_rows), aggregates
+
+
+def benchmark_hash_aggregation(scale_factors=[0.01, 0.05, 0.1, 0.2]):
+    '''compares the time and peak memory of the group by and aggregates of
+        tcph1, applied to lineitem once it is read, with lists of the rows
+        and values of each group and with a hash aggregation that updates
+        running totals in a single pass over the rows, and checks that
+        both give the same results
+
+    keyword_args:
+        scale_factors - TPC-H scale factors of the generated data
+'''
+
+    with open('tcph1.sql') as f:
+        sql_tree = sql_to_tree(f.read())
+
+    print('tcph1 aggregation time (s) and peak memory (MB)')
+    print('scale factor  rows       row lists       hash            speedup'
+          '   same result')
+    for scale_factor in scale_factors:
+        directory = tempfile.mkdtemp()
+        try:
+            generate_tcph_data(directory, scale_factor)
+            column_positions, column_datatypes, columns = \
+                load_tcph_tables(sql_tree, directory)['lineitem']
+
+            grouping_positions = [column_positions[grouping['column_name']]
+                                  for grouping in sql_tree['grouping']]
+            aggregate_functions = [
+                (aggregate['function'],
+                 None if aggregate['column_name'] is None
+                 else column_positions[aggregate['column_name']])
+                for aggregate in sql_tree['select aggregate']]
+
+            results = []
+            for aggregate_function in [row_list_aggregate,
+                                       aggregate_batches_of_batch]:
+                results.append((
+                    measure(lambda: aggregate_function(
+                        columns, grouping_positions, aggregate_functions)),
+                    aggregate_function(columns, grouping_positions,
+                                       aggregate_functions)))
+            (row_lists, expected_result), (hashed, result) = results
+
+            print('%-12s  %-9d  %6.3f %6.1f   %6.3f %6.1f   %6.1fx   %s' %
+                  (scale_factor, batch_length(columns), row_lists[0],
+                   row_lists[1] / 1024 ** 2, hashed[0],
+                   hashed[1] / 1024 ** 2, row_lists[0] / hashed[0],
+                   result == expected_result))
+        finally:
+            shutil.rmtree(directory)
+
+
+def aggregate_batches_of_batch(batch, grouping_positions,
+                               aggregate_functions):
+    '''aggregates a single batch with aggregate_batches, with the arguments
+        of row_list_aggregate
+'''
+    return aggregate_batches([batch], grouping_positions, aggregate_functions)
+
+
+benchmarks = {'parse': benchmark_parse,
+              'parse_cache': benchmark_parse_cache,
+              'fast_parse': benchmark_fast_parse,
+              'typed_columns': benchmark_typed_columns,
+              'filters': benchmark_filters,
+              'scan_engines': benchmark_scan_engines,
+              'projection': benchmark_projection,
+              'batches': benchmark_batches,
+              'columnar': benchmark_columnar,
+              'zone_maps': benchmark_zone_maps,
+              'indexes': benchmark_indexes,
+              'join_order': benchmark_join_order,
+              'statistics': benchmark_statistics,
+              'hash_join': benchmark_hash_join,
+              'semi_joins': benchmark_semi_joins,
+              'partitioned_join': benchmark_partitioned_join,
+              'direct_join': benchmark_direct_join,
+              'merge_join': benchmark_merge_join,
+              'late_materialization': benchmark_late_materialization,
+              'liveness': benchmark_liveness,
+              'hash_aggregation': benchmark_hash_aggregation}
+
+
+if __name__ == '__main__':
+
+    # run the benchmarks named on the command line, or all of them
+    for benchmark_name in sys.argv[1:] or benchmarks.keys():
+        benchmarks[benchmark_name]()
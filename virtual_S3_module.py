@@ -1,29 +1,62 @@
 #!/usr/bin/python
+import codecs
 import boto3
+from collections import deque
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from botocore.exceptions import EndpointConnectionError, ClientError
-from datetime import datetime
+from datetime import date
+from operator import itemgetter
 from file_query_utilities import file_to_data_structure,\
+                           file_to_data_batches,\
+                           csv_to_data_batches,\
+                           concatenate_batches,\
+                           aggregate_batches,\
+                           default_scan_batch_size,\
                            map_select_columns_to_data,\
+                           sql_tree_columns,\
                            transpose_columns_to_rows,\
                            optimize_join_order,\
+                           join_statistics,\
+                           read_table_statistics,\
+                           refresh_table_statistics,\
+                           header_datatypes,\
+                           semi_join_plan,\
+                           semi_join_statistics,\
+                           batch_length,\
+                           gather_rows,\
                            join_data
+from bloom_filter import BloomFilter
+from columnar_cache import cached_table_to_data_batches,\
+                           cached_table_to_data_structure,\
+                           cached_table_layout,\
+                           layout_indexes,\
+                           layout_statistics,\
+                           written_table_layout
+from s3_range_download import read_s3_ranges, stitch_line_blocks,\
+                              block_lines, default_part_size,\
+                              default_range_workers
 
+# number of S3 objects to download at once
+default_max_workers = 8
+
+# size of each read from an S3 object when streaming it - 1 MB
+stream_chunk_size = 1024 * 1024
 
-def retrieve_s3_file(bucket, filename, folder=None):
-    '''retrieves file from S3
+
+def s3_file_names(filename, folder=None):
+    '''determines the local and S3 names of a file
 
     keyword-args:
-        bucket = name of S3 bucket from which to download file
-        filename = name of S3 file to be downloaded
+        filename = name of S3 file
         folder = name of folder within S3, if any (optional)
 
     returns:
-        name of downloaded file on local filesystem
+        a tuple containing:
+            local_filename - name of the file on the local filesystem
+            s3_filename - key of the file in the S3 bucket
 '''
-#   Create an S3 client
-    s3 = boto3.client('s3')
-
-#   set local and S3 filenames
     if folder is not None:
         local_filename = folder+'_'+filename
         s3_filename = folder+'/'+filename
@@ -31,39 +64,355 @@ def retrieve_s3_file(bucket, filename, folder=None):
         local_filename = filename
         s3_filename = filename
 
-    local_header_filename = local_filename + '_header'
-    s3_header_filename = s3_filename + '_header'
+    return local_filename, s3_filename
 
-    # download data file
+
+def retrieve_s3_object(s3, bucket, s3_filename, local_filename, cache=None,
+                       part_size=default_part_size,
+                       range_workers=default_range_workers, pins=None):
+    '''retrieves a single object from S3
+
+    keyword-args:
+        s3 = boto3 S3 client
+        bucket = name of S3 bucket from which to download the object
+        s3_filename = key of the object in the bucket
+        local_filename = name to save the object as on the local filesystem.
+                         ignored if the object is cached
+        cache = S3FileCache to keep the object in (optional)
+        part_size = objects larger than this are downloaded as concurrent
+                    byte ranges of this size (optional)
+        range_workers = number of byte ranges to download at once (optional)
+        pins = list to pin the cached object with, so that the cache
+               doesn't evict it until the list is released, as used by
+               S3FileCache.retrieve (optional)
+
+    returns:
+        name of downloaded file on local filesystem
+'''
     try:
+        if cache is not None:
+            return cache.retrieve(s3, bucket, s3_filename, part_size,
+                                  range_workers, pins)
+
+        # smaller objects are downloaded in a single stream
+        transfer_config = TransferConfig(multipart_threshold=part_size + 1,
+                                         multipart_chunksize=part_size,
+                                         max_concurrency=range_workers)
         with open(local_filename, "wb") as s3_file:
-            s3.download_fileobj(bucket, s3_filename, s3_file)
+            s3.download_fileobj(bucket, s3_filename, s3_file,
+                                Config=transfer_config)
+
+    except EndpointConnectionError:
+        print('cannot connect to S3 bucket')
+    except ClientError:
+        print('cannot locate file ' + s3_filename)
+
+    if cache is not None:
+        return cache.local_filename(bucket, s3_filename)
+    return local_filename
+
+
+def retrieve_s3_table(s3, bucket, s3_filename, local_filename,
+                      header_download, part_size=default_part_size,
+                      range_workers=default_range_workers, scan_engine=None,
+                      object_head=None):
+    '''downloads a table from S3 without a cache, as retrieve_s3_object
+        does, and makes sure it has statistics and zone maps, as
+        refresh_table_statistics does.  they are only collected again when
+        the object has changed since they were last collected, as told by
+        its ETag
+
+    keyword-args:
+        s3, bucket, s3_filename, local_filename, part_size, range_workers =
+            as used by retrieve_s3_object
+        header_download = future of the download of the table's _header
+                          file, which the statistics need.  it must have
+                          been submitted to the executor before this
+                          download, so that it never waits on this one
+        scan_engine = engine used to read the table, if its statistics and
+                      zone maps are collected (optional)
+        object_head = future of the head_object response of the table, if
+                      it has been requested already.  like header_download,
+                      it must have been submitted before this download
+                      (optional)
+
+    returns:
+        name of downloaded file on local filesystem
+'''
+    retrieve_s3_object(s3, bucket, s3_filename, local_filename, None,
+                       part_size, range_workers)
+    header_download.result()
+
+    try:
+        if object_head is not None:
+            etag = object_head.result()['ETag']
+        else:
+            etag = s3.head_object(Bucket=bucket, Key=s3_filename)['ETag']
+    except (EndpointConnectionError, ClientError):
+        # retrieve_s3_object has already reported the error
+        return local_filename
+
+    refresh_table_statistics(local_filename, etag, scan_engine)
+
+    return local_filename
+
+
+def retrieve_s3_file(bucket, filename, folder=None, cache=None, s3=None,
+                     part_size=default_part_size,
+                     range_workers=default_range_workers, pins=None):
+    '''retrieves file from S3
+
+    keyword-args:
+        bucket = name of S3 bucket from which to download file
+        filename = name of S3 file to be downloaded
+        folder = name of folder within S3, if any (optional)
+        cache = S3FileCache to keep the file in, so that it is only
+                downloaded again when it changes (optional)
+        s3 = boto3 S3 client to use (optional)
+        part_size = files larger than this are downloaded as concurrent
+                    byte ranges of this size (optional)
+        range_workers = number of byte ranges to download at once (optional)
+        pins = list to pin the cached file and its _header file with, as
+               used by retrieve_s3_object (optional)
+
+    returns:
+        name of downloaded file on local filesystem
+'''
+#   Create an S3 client
+    if s3 is None:
+        s3 = boto3.client('s3')
+
+#   set local and S3 filenames
+    local_filename, s3_filename = s3_file_names(filename, folder)
+
+    # download data file, then header file.  the header file is always
+    # stored alongside the data file as the data file name + _header
+    local_filename = retrieve_s3_object(s3, bucket, s3_filename,
+                                        local_filename, cache,
+                                        part_size, range_workers, pins)
+    retrieve_s3_object(s3, bucket, s3_filename + '_header',
+                       local_filename + '_header', cache,
+                       part_size, range_workers, pins)
+
+    # return name of local file
+    return local_filename
+
+
+def stream_s3_lines(s3, bucket, s3_filename, chunk_size=stream_chunk_size):
+    '''generator function that streams the lines of a text object from S3,
+        without saving it to the local filesystem
+
+    keyword-args:
+        s3 = boto3 S3 client
+        bucket = name of S3 bucket holding the object
+        s3_filename = key of the object in the bucket
+        chunk_size = number of bytes to read from S3 at a time (optional)
+
+    returns:
+        each line of the object, including its line ending
+'''
+    try:
+        response = s3.get_object(Bucket=bucket, Key=s3_filename)
 
     except EndpointConnectionError:
         print('cannot connect to S3 bucket')
+        raise
     except ClientError:
         print('cannot locate file ' + s3_filename)
+        raise
+
+    # decode incrementally, as chunks can split multi-byte characters
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    partial_line = ''
+
+    for chunk in response['Body'].iter_chunks(chunk_size):
+        lines = (partial_line + decoder.decode(chunk)).split('\n')
+        # the last line is incomplete until the next chunk arrives
+        partial_line = lines.pop()
+        for line in lines:
+            yield line + '\n'
+
+    partial_line += decoder.decode(b'', final=True)
+    if partial_line:
+        yield partial_line
+
+
+def parse_line_blocks(blocks, header_lines, sql_tree=None, scan_engine=None,
+                      columns=None, batch_size=default_scan_batch_size,
+                      parse_workers=default_range_workers):
+    '''parses blocks of whole lines of a CSV file, each block by its own
+        worker, and generates their batches of rows in file order.  only
+        parse_workers blocks are parsed, or held parsed, at a time
+
+    keyword-args:
+        blocks = iterable of blocks of whole lines, as bytes, as generated
+                 by stitch_line_blocks.  the first block starts with the
+                 line of column names
+        header_lines = the lines of the matching _header file
+        sql_tree, scan_engine, columns, batch_size = as used by
+                                                     csv_to_data_batches
+        parse_workers = number of blocks to parse at once (optional)
+
+    returns:
+        the same as csv_to_data_batches
+'''
+    header_lines = list(header_lines)
+    blocks = iter(blocks)
+    first_block = next(blocks, b'')
+
+    # every block is parsed as a file of its own, after the column names
+    column_names_line = first_block[:first_block.find(b'\n') + 1]
+
+    def parse_block(block):
+        batches = csv_to_data_batches(block_lines([block]), header_lines,
+                                      sql_tree, scan_engine, columns,
+                                      batch_size)[2]
+        return list(batches)
+
+    column_positions, column_datatypes, batches = csv_to_data_batches(
+        block_lines([column_names_line]), header_lines, sql_tree,
+        scan_engine, columns, batch_size)
+
+    def read_batches():
+        with ThreadPoolExecutor(max_workers=parse_workers) as executor:
+            pending_blocks = deque([executor.submit(parse_block,
+                                                    first_block)])
+            for block in blocks:
+                pending_blocks.append(executor.submit(
+                    parse_block, column_names_line + block))
+                if len(pending_blocks) == parse_workers:
+                    for batch in pending_blocks.popleft().result():
+                        yield batch
+
+            while pending_blocks:
+                for batch in pending_blocks.popleft().result():
+                    yield batch
+
+    return column_positions, column_datatypes, read_batches()
+
+
+def stream_s3_file_to_data_structure(s3, bucket, filename, folder=None,
+                                     sql_tree=None,
+                                     part_size=default_part_size,
+                                     range_workers=default_range_workers,
+                                     scan_engine=None, columns=None):
+    '''streams a file from S3 straight into a data structure, applying filters
+        along the way.  unlike retrieve_s3_file and file_to_data_structure,
+        the file is never written to the local filesystem, so memory use is
+        limited to a read buffer and the rows that pass the filters
 
-    # download header file
+    keyword-args:
+        the same as stream_s3_file_to_data_batches
+
+    returns:
+        the same as file_to_data_structure
+'''
+    column_positions, column_datatypes, batches = \
+        stream_s3_file_to_data_batches(s3, bucket, filename, folder,
+                                       sql_tree, part_size, range_workers,
+                                       scan_engine, columns)
+
+    return column_positions, column_datatypes, concatenate_batches(batches)
+
+
+def stream_s3_file_to_data_batches(s3, bucket, filename, folder=None,
+                                   sql_tree=None,
+                                   part_size=default_part_size,
+                                   range_workers=default_range_workers,
+                                   scan_engine=None, columns=None,
+                                   batch_size=default_scan_batch_size):
+    '''streams a file from S3 a batch of rows at a time, applying filters
+        along the way.  the file is read as the batches are read, so memory
+        use is limited to a read buffer and a single batch, or for files
+        read as byte ranges, the ranges being downloaded and parsed
+
+    keyword-args:
+        s3 = boto3 S3 client
+        bucket = name of S3 bucket holding the file
+        filename = name of S3 file
+        folder = name of folder within S3, if any (optional)
+        sql_tree = the SQL tree used to filter the file (optional)
+        part_size = files larger than this are streamed as concurrent
+                    byte ranges of this size, each parsed by its own worker
+                    (optional)
+        range_workers = number of byte ranges to download, and to parse, at
+                        once (optional)
+        scan_engine = engine used to read the file, as used by
+                      file_to_data_structure (optional)
+        columns = names of the columns to keep, as used by
+                  file_to_data_structure (optional)
+        batch_size = largest number of rows in each batch (optional)
+
+    returns:
+        the same as file_to_data_batches
+'''
+    local_filename, s3_filename = s3_file_names(filename, folder)
+
+    header_lines = list(stream_s3_lines(s3, bucket, s3_filename + '_header'))
+
+    # large files are read as byte ranges, realigned on line boundaries and
+    # parsed a block per worker, and smaller files in a single stream
     try:
-        with open(local_header_filename, "wb") as s3_file:
-            s3.download_fileobj(bucket, s3_header_filename, s3_file)
+        s3_file = s3.head_object(Bucket=bucket, Key=s3_filename)
 
     except EndpointConnectionError:
         print('cannot connect to S3 bucket')
+        raise
     except ClientError:
-        print('cannot locate file: ' + s3_header_filename)
+        print('cannot locate file ' + s3_filename)
+        raise
 
-    # return name of local file
-    return local_filename
+    if s3_file['ContentLength'] > part_size:
+        return parse_line_blocks(
+            stitch_line_blocks(read_s3_ranges(
+                s3, bucket, s3_filename, s3_file['ContentLength'],
+                s3_file['ETag'], part_size, range_workers)),
+            header_lines, sql_tree, scan_engine, columns, batch_size,
+            range_workers)
+
+    data_lines = stream_s3_lines(s3, bucket, s3_filename)
 
+    return csv_to_data_batches(data_lines, header_lines, sql_tree,
+                               scan_engine, columns, batch_size)
 
-def execute_sqltree_on_s3(bucket, sql_tree):
+
+def execute_sqltree_on_s3(bucket, sql_tree, cache=None,
+                          max_workers=default_max_workers, streaming=False,
+                          part_size=default_part_size,
+                          range_workers=default_range_workers,
+                          scan_engine=None, index_columns=None,
+                          join_memory_budget=None, join_spill_directory=None):
     '''executes a SQL Tree against a S3 bucket
 
     keyword-args:
         bucket - name of S3 bucket that the query will be executed against
         sql_tree - a sql tree, as generated by sql_to_tree library
+        cache - S3FileCache to keep downloaded files in.  cached files are
+                converted to a columnar layout the first time they are
+                read, which later queries read instead (optional)
+        max_workers - number of S3 objects to download at once (optional)
+        streaming - if True, files are parsed as they are streamed from S3
+                    rather than being saved locally first.  the cache is
+                    not used when streaming (optional)
+        part_size - files larger than this are downloaded as concurrent
+                    byte ranges of this size (optional)
+        range_workers - number of byte ranges of each file to download at
+                        once (optional)
+        scan_engine - 'numpy' or 'python', the engine used to read and
+                      filter each file.  defaults to numpy when it is
+                      installed (optional)
+        index_columns - set of names of columns to index.  the indexes are
+                        kept with the columnar layouts of cached files, and
+                        are used for equality filters and to join tables
+                        that have no filters.  only used with a cache
+                        (optional)
+        join_memory_budget - bytes each join's hashtable may take before
+                             the join is partitioned on disk.  defaults to
+                             file_query_utilities.join_memory_budget
+                             (optional)
+        join_spill_directory - directory the partitions of joins are
+                               written to.  defaults to the system's
+                               temporary directory (optional)
 
     returns:
         a tuple containing:
@@ -71,6 +420,428 @@ def execute_sqltree_on_s3(bucket, sql_tree):
             ordered_data - a dataset expressed as a list of tuples
                         each tuple is a row, and the first row is a header
 
+        when the query's filters are pushed through its joins, as Bloom
+        filters of the join keys of filtered tables, the rows each one
+        checked and eliminated are kept in the sql tree's 'semi_joins', as
+        returned by semi_join_statistics, along with the tables and columns
+        of its semi-join, as planned by semi_join_plan.  filters aren't
+        pushed through joins when streaming
+
+'''
+    # download files in query and map to data structures.
+    # every data and header file is downloaded at once, and each table is
+    # read as soon as both of its files are downloaded, while the rest of
+    # the downloads carry on.  when the query has filters, the tables are
+    # read in the order of a plan made from the header files instead, so
+    # that the filtered tables can filter the tables they join as those
+    # are read.  without a cache, the statistics and zone maps of each
+    # table are collected as it's downloaded
+    s3 = boto3.client('s3', config=Config(
+        max_pool_connections=max_workers * range_workers))
+    table_aliases_in_order = []
+    tables = {}
+
+    # only the columns the query refers to are kept from each table
+    query_columns = sql_tree_columns(sql_tree)
+
+    cache_pins = []
+
+    # a query on a single table reads it a batch of rows at a time, so the
+    # table is never held in memory as a whole
+    if len(sql_tree['table_definitions']) == 1 and \
+            len(sql_tree['joins']) == 0:
+        table_definition = sql_tree['table_definitions'][0]
+        alias = table_definition['alias'] or table_definition['name']
+
+        # cached files are pinned until the query has read them, so that
+        # the cache doesn't evict them in the meantime
+        try:
+            if streaming:
+                table = stream_s3_file_to_data_batches(
+                    s3, bucket, table_definition['name'],
+                    table_definition['schema'], sql_tree, part_size,
+                    range_workers, scan_engine, query_columns)
+            else:
+                local_filename = retrieve_s3_file(
+                    bucket, table_definition['name'],
+                    table_definition['schema'], cache, s3, part_size,
+                    range_workers, cache_pins)
+                if cache is not None:
+                    table = cached_table_to_data_batches(
+                        cache, bucket, s3_file_names(
+                            table_definition['name'],
+                            table_definition['schema'])[1],
+                        sql_tree, scan_engine, query_columns,
+                        index_columns=index_columns)
+                else:
+                    table = file_to_data_batches(local_filename, sql_tree,
+                                                 scan_engine, query_columns)
+
+            return execute_sqltree_on_batches(sql_tree, alias, table)
+        finally:
+            if cache is not None:
+                cache.release(cache_pins)
+
+    downloads = {}
+    header_downloads = {}
+    table_downloads = {}
+    object_heads = {}
+    table_indexes = {}
+    table_statistics = {}
+    table_aliases = {}
+    table_local_filenames = {}
+    table_s3_filenames = {}
+    pending_downloads = {}
+    semi_joins = not streaming and len(sql_tree['filters']) > 0
+
+    # reads a table once its files are downloaded, with the filters of the
+    # given sql tree
+    def read_table(alias, table_sql_tree):
+        s3_filename = table_s3_filenames[alias]
+        # errors of the download are raised here, as they would be if the
+        # file had been downloaded on this thread
+        table_downloads[s3_filename].result()
+
+        # cached tables are read from their columnar layout
+        if cache is not None:
+            tables[alias] = cached_table_to_data_structure(
+                cache, bucket, s3_filename, table_sql_tree, scan_engine,
+                query_columns, index_columns)
+            layout = cached_table_layout(cache, bucket, s3_filename)
+            if layout is not None:
+                table_indexes[alias] = layout_indexes(layout,
+                                                      table_sql_tree)
+                table_statistics[alias] = layout_statistics(layout)
+        else:
+            tables[alias] = file_to_data_structure(
+                table_local_filenames[s3_filename], table_sql_tree,
+                scan_engine, query_columns)
+            table_statistics[alias] = read_table_statistics(
+                table_local_filenames[s3_filename])
+
+        return tables[alias]
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for table_definition in sql_tree['table_definitions']:
+                alias = ''
+                if table_definition['alias'] is not None:
+                    alias = table_definition['alias']
+                else:
+                    alias = table_definition['name']
+
+                # when streaming, each table is parsed by the thread
+                # reading it
+                if streaming:
+                    table_aliases_in_order.append(alias)
+                    tables[alias] = executor.submit(
+                        stream_s3_file_to_data_structure, s3, bucket,
+                        table_definition['name'], table_definition['schema'],
+                        sql_tree, part_size, range_workers, scan_engine,
+                        query_columns)
+                    continue
+
+                local_filename, s3_filename = \
+                    s3_file_names(table_definition['name'],
+                                  table_definition['schema'])
+
+                # download each file once, even if the query uses it twice
+                if s3_filename not in table_aliases:
+                    if cache is not None:
+                        local_filename = cache.local_filename(bucket,
+                                                              s3_filename)
+                    table_aliases[s3_filename] = []
+                    table_local_filenames[s3_filename] = local_filename
+                table_aliases[s3_filename].append(alias)
+                table_aliases_in_order.append(alias)
+                table_s3_filenames[alias] = s3_filename
+
+            # the _header files, and the size of each table the semi-joins
+            # are planned from, are fetched before the tables themselves.
+            # cached files stay pinned until the query has been executed
+            for s3_filename, local_filename in table_local_filenames.items():
+                header_downloads[s3_filename] = executor.submit(
+                    retrieve_s3_object, s3, bucket, s3_filename + '_header',
+                    local_filename + '_header', cache, part_size,
+                    range_workers, cache_pins)
+                if semi_joins:
+                    object_heads[s3_filename] = executor.submit(
+                        s3.head_object, Bucket=bucket, Key=s3_filename)
+
+            for s3_filename, local_filename in table_local_filenames.items():
+                # without a cache, the statistics and zone maps of a table
+                # are kept next to its file, so they are collected as it is
+                # downloaded.  cached tables keep them with their layouts
+                if cache is not None:
+                    table_downloads[s3_filename] = executor.submit(
+                        retrieve_s3_object, s3, bucket, s3_filename,
+                        local_filename, cache, part_size, range_workers,
+                        cache_pins)
+                else:
+                    table_downloads[s3_filename] = executor.submit(
+                        retrieve_s3_table, s3, bucket, s3_filename,
+                        local_filename, header_downloads[s3_filename],
+                        part_size, range_workers, scan_engine,
+                        object_heads.get(s3_filename))
+                pending_downloads[s3_filename] = 2
+                downloads[header_downloads[s3_filename]] = s3_filename
+                downloads[table_downloads[s3_filename]] = s3_filename
+
+            # the tables are read in the order chosen by semi_join_plan,
+            # each one as soon as it is downloaded, and filtered by Bloom
+            # filters of the join keys of the tables read before it that it
+            # joins.  the plan only needs the _header files and the sizes of
+            # the tables, and the statistics already kept for the versions
+            # being downloaded, so it is made while the tables are
+            # downloading
+            if semi_joins:
+                table_datatypes = {}
+                table_sizes = {}
+                plan_statistics = {}
+                for alias in table_aliases_in_order:
+                    s3_filename = table_s3_filenames[alias]
+                    local_filename = table_local_filenames[s3_filename]
+                    header_downloads[s3_filename].result()
+                    with open(local_filename + '_header', newline='') as \
+                            lfile_header:
+                        table_datatypes[alias] = \
+                            header_datatypes(lfile_header)
+                    object_head = object_heads[s3_filename].result()
+                    table_sizes[alias] = object_head['ContentLength']
+                    if cache is not None:
+                        layout = written_table_layout(
+                            cache, bucket, s3_filename, object_head['ETag'])
+                        if layout is not None:
+                            plan_statistics[alias] = \
+                                layout_statistics(layout)
+                    else:
+                        plan_statistics[alias] = read_table_statistics(
+                            local_filename, object_head['ETag'])
+
+                read_tables_with_semi_joins(
+                    sql_tree, table_datatypes, table_sizes,
+                    {k: v for k, v in plan_statistics.items()
+                     if v is not None},
+                    read_table)
+
+            # otherwise each table is read as soon as both of its files
+            # are downloaded, while the rest of the downloads carry on
+            else:
+                for download in as_completed(downloads):
+                    # errors of the downloads are raised as they complete
+                    download.result()
+                    s3_filename = downloads[download]
+                    pending_downloads[s3_filename] -= 1
+                    if pending_downloads[s3_filename] > 0:
+                        continue
+
+                    for alias in table_aliases[s3_filename]:
+                        read_table(alias, sql_tree)
+
+        # keep tables in the order of the query, however the downloads
+        # finished
+        query_tables = {}
+        for alias in table_aliases_in_order:
+            if streaming:
+                tables[alias] = tables[alias].result()
+            query_tables[alias] = tables[alias]
+
+        return execute_sqltree_on_tables(sql_tree, query_tables,
+                                         table_indexes, table_statistics,
+                                         join_memory_budget,
+                                         join_spill_directory)
+    finally:
+        for indexes in table_indexes.values():
+            for index in indexes.values():
+                index.close()
+        if cache is not None:
+            cache.release(cache_pins)
+
+
+def read_tables_with_semi_joins(sql_tree, table_datatypes, table_sizes,
+                                table_statistics, read_table):
+    '''reads the tables of a query in the order chosen by semi_join_plan,
+        each one filtered, as it is read, by Bloom filters of the join keys
+        of the tables read before it that it joins
+
+    keyword-args:
+        sql_tree - a sql tree, as generated by sql_to_tree library
+        table_datatypes, table_sizes, table_statistics - the columns, sizes
+                and statistics of the tables, as used by semi_join_plan
+        read_table - function that reads a table, given its alias and the
+                     sql tree to read it with, and returns it as a tuple of
+                     its column positions, column datatypes and columns, as
+                     returned by file_to_data_structure.  the sql tree of a
+                     table with semi-joins has a 'semi_join_filters' list
+                     of its join columns and their Bloom filters
+
+    returns:
+        dictionary of the tables, in the order they were read.  key is the
+        table alias, value is the table returned by read_table.  the
+        semi-joins are kept in the sql tree's 'semi_joins', each with the
+        rows it eliminated, as returned by semi_join_statistics
+'''
+    tables = {}
+    sql_tree['semi_joins'] = []
+
+    for alias, table_semi_joins in semi_join_plan(
+            sql_tree, table_datatypes, table_sizes, table_statistics):
+        if len(table_semi_joins) == 0:
+            tables[alias] = read_table(alias, sql_tree)
+            continue
+
+        semi_join_filters = []
+        for semi_join in table_semi_joins:
+            build_positions, build_datatypes, build_data = \
+                tables[semi_join['build_table']]
+            build_column = build_data[
+                build_positions[semi_join['build_column']]]
+            bloom_filter = BloomFilter(len(build_column))
+            bloom_filter.add(build_column)
+            semi_join_filters.append(
+                {'identifier': semi_join['probe_column'],
+                 'bloom_filter': bloom_filter})
+
+        tables[alias] = read_table(alias, {**sql_tree, 'semi_join_filters':
+                                           semi_join_filters})
+
+        for semi_join, semi_join_filter in zip(table_semi_joins,
+                                               semi_join_filters):
+            build_positions, build_datatypes, build_data = \
+                tables[semi_join['build_table']]
+            sql_tree['semi_joins'].append({
+                **semi_join,
+                **semi_join_statistics(
+                    semi_join_filter['bloom_filter'],
+                    build_data[build_positions[semi_join['build_column']]])})
+
+    return tables
+
+
+def join_tables(join_plan, query_data, selected_columns, join_columns,
+                indexes=None, sorted_columns=None, memory_budget=None,
+                spill_directory=None):
+    '''applies a join plan to tables that have already been read, and
+        returns their selected columns.  the joins only carry the join
+        columns and, for each joined table, the row of the table that each
+        joined row comes from.  the selected columns are gathered once, from
+        the rows that are left after the last join, so wide columns aren't
+        copied by every join, and each carried column is released after
+        the last join that uses it
+
+    keyword-args:
+        join_plan - the joins to apply, in order, as returned by
+                    optimize_join_order.  each join's actual rows are kept
+                    in its 'rows'
+        query_data - dictionary of table aliases and their columns
+        selected_columns, join_columns - the selected columns and the join
+                    columns of the query, mapped to their tables and
+                    positions, as by map_select_columns_to_data
+        indexes, sorted_columns - the indexes and the sorted columns of the
+                    join columns, as used by join_data (optional)
+        memory_budget, spill_directory - the memory budget of each join's
+                    hashtable, and the directory its partitions are written
+                    to if it doesn't fit, as used by join_data (optional)
+
+    returns:
+        dictionary of the selected columns and their joined values.  the
+        columns of tables that aren't joined are returned as they are
+'''
+    joined_tables = set()
+    for join in join_plan:
+        joined_tables.update(join['join_tables'])
+
+    # the rows of each joined table are carried as a column of row numbers,
+    # keyed by a tuple so as not to clash with the names of columns.  they
+    # start as a range, which gather_rows gathers without reading it
+    row_columns = {(alias, 'rows'): (alias, None) for alias in joined_tables}
+    carried_columns = {**join_columns, **row_columns}
+
+    interim_data = {}
+    for k, column in join_columns.items():
+        interim_data[k] = query_data[column[0]][column[1]]
+    for k, column in row_columns.items():
+        interim_data[k] = range(batch_length(query_data[column[0]]))
+
+    # the position in the join plan of the last join that uses each carried
+    # column, after which the column is released rather than gathered by
+    # the joins that follow.  the row numbers of tables with selected
+    # columns are kept until the selected columns are gathered
+    last_uses = {}
+    for position, join in enumerate(join_plan):
+        for k in join.get('left_identifiers', [join['left_identifier']]) + \
+                join.get('right_identifiers', [join['right_identifier']]):
+            last_uses[k] = position
+        for alias in join['join_tables']:
+            last_uses[(alias, 'rows')] = position
+    for k, column in selected_columns.items():
+        if column[0] in joined_tables:
+            last_uses[(column[0], 'rows')] = len(join_plan)
+
+    previously_joined_tables = set()
+    # iteratively join all tables
+    for position, join in enumerate(join_plan):
+        interim_data = join_data(join,
+                                 interim_data,
+                                 carried_columns,
+                                 previously_joined_tables,
+                                 indexes,
+                                 sorted_columns,
+                                 memory_budget,
+                                 spill_directory)
+        previously_joined_tables.update(join['join_tables'])
+
+        # the actual rows after each join, to compare with its estimate
+        join['rows'] = len(interim_data.get((join['join_tables'][0], 'rows'),
+                                            []))
+
+        for k in [k for k in carried_columns
+                  if last_uses.get(k, -1) <= position]:
+            del carried_columns[k]
+            interim_data.pop(k, None)
+
+    # select columns from specified dataset
+    selected_data = {}
+    for k, column in selected_columns.items():
+        selected_column = query_data[column[0]][column[1]]
+        if column[0] in joined_tables:
+            selected_column = gather_rows(selected_column,
+                                          interim_data[(column[0], 'rows')])
+        selected_data[k] = selected_column
+
+    return selected_data
+
+
+def execute_sqltree_on_tables(sql_tree, tables, indexes=None,
+                              statistics=None, join_memory_budget=None,
+                              join_spill_directory=None):
+    '''executes a SQL Tree against tables that have already been read
+
+    keyword-args:
+        sql_tree - a sql tree, as generated by sql_to_tree library
+        tables - dictionary of the tables in the query, in the order of the
+                 query.  key is the table alias, value is a tuple of the
+                 column positions, column datatypes and columns of the
+                 table, as returned by file_to_data_structure
+        indexes - dictionary of the indexes of each table that hasn't been
+                  filtered.  key is the table alias, value is a dictionary
+                  of column names and their indexes, as returned by
+                  layout_indexes (optional)
+        statistics - dictionary of the statistics of each whole table, as
+                     returned by read_table_statistics, used to estimate
+                     the cost of the joins and to find the join columns
+                     that tables are stored in the order of.  tables
+                     without statistics are left out, or None (optional)
+        join_memory_budget, join_spill_directory - the memory budget of
+                     each join's hashtable, and the directory its partitions
+                     are written to if it doesn't fit, as used by
+                     execute_sqltree_on_s3 (optional)
+
+    returns:
+        the same as execute_sqltree_on_s3.  numbers are returned as int or
+        float and dates as datetime.date.  the joins are kept in the sql
+        tree's 'join_plan', in the order they were applied, each with its
+        estimated and actual rows in 'estimated_rows' and 'rows'
 '''
     query_data = {}
     query_data_column_positions = {}
@@ -78,25 +849,11 @@ def execute_sqltree_on_s3(bucket, sql_tree):
     selected_columns = {}
     join_columns = {}
     selected_columns_datatypes = {}
-    selected_data = {}
     post_join_row_count = 0
 
-    # download files in query and map to data structures
-    for table_definition in sql_tree['table_definitions']:
-        alias = ''
-        s3_folder = table_definition['schema']
-        s3_filename = table_definition['name']
-        if table_definition['alias'] is not None:
-            alias = table_definition['alias']
-        else:
-            alias = table_definition['name']
-
+    for alias, table in tables.items():
         query_data_column_positions[alias], query_data_headers[alias], \
-            query_data[alias] = \
-            file_to_data_structure(retrieve_s3_file(bucket,
-                                                    s3_filename,
-                                                    s3_folder),
-                                   sql_tree)
+            query_data[alias] = table
 
     # map selected columns to tables
     for k in query_data_column_positions:
@@ -113,37 +870,40 @@ def execute_sqltree_on_s3(bucket, sql_tree):
             join_columns = {**join_columns, **mapped_join_columns}
 
     # build join plan
-    # follows fairly naive algorithm, just ordering so that each join
-    # has a table in common with the previous join
-    # this could be further optimized
-
-    join_plan = optimize_join_order(sql_tree, join_columns)
-    selected_and_join_columns = {**selected_columns, **join_columns}
+    # the joins are ordered by their estimated cost, from the row counts
+    # of the filtered tables and the distinct values of their join columns
+
+    stored_statistics = {}
+    if statistics is not None:
+        stored_statistics = {alias: table_statistics for alias,
+                             table_statistics in statistics.items()
+                             if table_statistics is not None}
+    join_plan = optimize_join_order(
+        sql_tree, join_columns,
+        join_statistics(query_data, join_columns, stored_statistics))
+    sql_tree['join_plan'] = join_plan
+
+    # indexes of the join columns, which are used instead of building
+    # hashtables
+    join_indexes = {}
+    if indexes is not None:
+        for k, column in join_columns.items():
+            if k in indexes.get(column[0], {}):
+                join_indexes[k] = indexes[column[0]][k]
+
+    # join columns whose tables are stored in their order, which are merged
+    # rather than joined through hashtables
+    sorted_columns = set()
+    for k, column in join_columns.items():
+        column_statistics = stored_statistics.get(column[0], {}).get(
+            'columns', {}).get(k, {})
+        if column_statistics.get('sorted', False):
+            sorted_columns.add(k)
 
     # apply join plan
-
-    interim_data = {}
-
-    for k, column in selected_and_join_columns.items():
-        interim_data[k] = []
-        select_table = column[0]
-        selected_column_position = column[1]
-
-        for row in query_data[select_table]:
-            interim_data[k].append(row[selected_column_position])
-
-    previously_joined_tables = set()
-    # iteratively join all tables
-    for i, join in enumerate(join_plan):
-        interim_data = join_data(join,
-                                 interim_data,
-                                 selected_and_join_columns,
-                                 previously_joined_tables)
-        previously_joined_tables.update(join['join_tables'])
-
-    # select columns from specified dataset
-    for k, column in selected_columns.items():
-        selected_data[k] = interim_data[k]
+    selected_data = join_tables(join_plan, query_data, selected_columns,
+                                join_columns, join_indexes, sorted_columns,
+                                join_memory_budget, join_spill_directory)
 
     # get length of resulting dataset
     for k in selected_data.keys():
@@ -154,7 +914,6 @@ def execute_sqltree_on_s3(bucket, sql_tree):
     # apply aggregates and having
     if len(sql_tree['grouping']) > 0:
         grouping_columns = []
-        grouping_rows = {}
 
         # step 1: map group bys to columns
         for i, grouping_item in enumerate(sql_tree['grouping']):
@@ -164,95 +923,197 @@ def execute_sqltree_on_s3(bucket, sql_tree):
             except KeyError as e:
                 print(e)
 
-        # step 2: get distinct values from group by columns
-        #   and denote the rows for each distinct value
-        for row in range(post_join_row_count):
-            unique_grouping = []
+        # step 2: gather the group by and aggregated columns into a batch
+        batch = []
+        for column_name in grouping_columns:
             try:
-                for k, column in enumerate(grouping_columns):
-                    unique_grouping.append(selected_data[column][row])
+                batch.append(selected_data[column_name])
             except KeyError as e:
                 print(e)
+        grouping_columns = [column_name for column_name in grouping_columns
+                            if column_name in selected_data]
 
-            if repr(unique_grouping) not in grouping_rows.keys():
-                grouping_rows[repr(unique_grouping)] = []
+        aggregated_data = {}
+        aggregated_datatypes = {}
+
+        for v in grouping_columns:
+            aggregated_datatypes[v] = selected_columns_datatypes.get(v)
+
+        aggregate_names = []
+        aggregate_functions = []
+        for i, aggregate in enumerate(sql_tree['select aggregate']):
+            aggregate_name, aggregate_datatype = \
+                aggregate_name_and_datatype(aggregate,
+                                            selected_columns_datatypes)
+            if aggregate_datatype is None:
+                return 'SQL Error'
+
+            aggregate_names.append(aggregate_name)
+            aggregated_datatypes[aggregate_name] = aggregate_datatype
+            if aggregate['column_name'] is None:
+                aggregate_functions.append((aggregate['function'], None))
+            else:
+                aggregate_functions.append((aggregate['function'],
+                                            len(batch)))
+                batch.append(selected_data[aggregate['column_name']])
+
+        # step 3: aggregate each distinct value combination in a single
+        #   pass over the rows
+        try:
+            groups, aggregates = aggregate_batches(
+                [batch], list(range(len(grouping_columns))),
+                aggregate_functions)
+        except TypeError as te:
+            print('SQL Error: ' + str(te))
+            return 'SQL Error'
+
+        for i, column_name in enumerate(grouping_columns):
+            aggregated_data[column_name] = [group[i] for group in groups]
+        for aggregate_name, aggregate_values in zip(aggregate_names,
+                                                    aggregates):
+            aggregated_data[aggregate_name] = aggregate_values
 
-            grouping_rows[repr(unique_grouping)].append(row)
+        selected_data = aggregated_data
+        selected_columns_datatypes = aggregated_datatypes
 
-        # setp 3: build base dataset from unique groupings
-        aggregated_data = {}
+    return order_query_result(sql_tree, selected_data,
+                              selected_columns_datatypes)
 
-        for i, v in enumerate(grouping_columns):
-            aggregated_data[grouping_columns[i]] = []
 
-        for k in grouping_rows.keys():
-            unique_record = k.strip("[]'")
-            for i, v in enumerate(unique_record.split(',')):
-                aggregated_data[grouping_columns[i]].append(v)
+def execute_sqltree_on_batches(sql_tree, alias, table):
+    '''executes a SQL Tree on a single table a batch of rows at a time,
+        so that memory use doesn't grow with the size of the table.  groups
+        are aggregated as each batch is read, so only their running totals
+        are held in memory
 
-        # step 4: aggregate all rows for each distinct value combination
-        if len(sql_tree['select aggregate']) > 0:
-            for i, aggregate in enumerate(sql_tree['select aggregate']):
-                if aggregate['column_name'] is not None:
-                    aggregate_name = aggregate['function'] + \
-                        '_' + aggregate['column_name']
-                else:
-                    aggregate_name = aggregate['function']
-
-                aggregated_data[aggregate_name] = []
-
-                for unique_record, rows in grouping_rows.items():
-                    if aggregate['column_name'] is not None:
-                        group_list = []
-                        for i, row in enumerate(rows):
-                            group_list.append(
-                                selected_data[aggregate['column_name']][row])
-
-                        # build functions to deal with type conversions for
-                        # numbers and dates
-                        aggregate_func = ''
-                        if selected_columns_datatypes[
-                                aggregate['column_name']] == 'NUMBER':
-                            aggregate_func = \
-                                eval('[float(i) for i in group_list]')
-                        elif selected_columns_datatypes[
-                                aggregate['column_name']] == 'DATE':
-                            aggregate_func = \
-                                eval('[datetime.strptime(i, "%Y-%m-%d") ' +
-                                     'for i in group_list]')
-                        else:
-                            aggregate_func = eval('group_list')
-                        try:
-                            if aggregate['function'] == 'count':
-                                aggregated_data[aggregate_name].append(
-                                    str(len(set(group_list))))
-
-                            elif aggregate['function'] == 'sum':
-                                aggregated_data[aggregate_name].append(
-                                    str(sum(aggregate_func)))
-
-                            elif aggregate['function'] == 'max':
-                                aggregated_data[aggregate_name].append(
-                                    str(max(aggregate_func)))
-
-                            elif aggregate['function'] == 'min':
-                                aggregated_data[aggregate_name].append(
-                                    str(min(aggregate_func)))
-
-                            elif aggregate['function'] == 'avg':
-                                aggregated_data[aggregate_name].append(
-                                    str(sum(aggregate_func)
-                                        / len(group_list)))
-                        except TypeError as te:
-                            print('SQL Error: ' + str(te))
-                            return 'SQL Error'
-
-                    elif aggregate['column_name'] is None and \
-                            aggregate['function'] == 'count':
-                        aggregated_data[aggregate_name].append(
-                            str(len(set(rows))))
+    keyword-args:
+        sql_tree - a sql tree with one table and no joins
+        alias - alias of the table in the sql tree
+        table - tuple of the column positions, column datatypes and batches
+                of the table, as returned by file_to_data_batches
 
-        selected_data = aggregated_data
+    returns:
+        the same as execute_sqltree_on_s3
+'''
+    column_positions, column_datatypes, batches = table
+
+    selected_columns, selected_columns_datatypes, join_columns = \
+        map_select_columns_to_data(sql_tree, alias, column_positions,
+                                   column_datatypes)
+
+    if len(sql_tree['grouping']) == 0:
+        selected_positions = [column[1] for column
+                              in selected_columns.values()]
+        selected_batches = ([batch[position] for position
+                             in selected_positions] for batch in batches)
+        selected_data = dict(zip(selected_columns.keys(),
+                                 concatenate_batches(selected_batches)))
+
+        return order_query_result(sql_tree, selected_data,
+                                  selected_columns_datatypes)
+
+    # map group bys and aggregates to the positions of their columns
+    grouping_columns = []
+    for i, grouping_item in enumerate(sql_tree['grouping']):
+        try:
+            column_name = grouping_item['column_name']
+            column_positions[column_name]
+            grouping_columns.append(column_name)
+        except KeyError as e:
+            print(e)
+
+    aggregate_names = []
+    aggregate_functions = []
+    aggregated_datatypes = {}
+    for column_name in grouping_columns:
+        aggregated_datatypes[column_name] = column_datatypes[column_name]
+
+    for i, aggregate in enumerate(sql_tree['select aggregate']):
+        aggregate_name, aggregate_datatype = \
+            aggregate_name_and_datatype(aggregate, column_datatypes)
+        if aggregate_datatype is None:
+            return 'SQL Error'
+
+        aggregate_names.append(aggregate_name)
+        aggregated_datatypes[aggregate_name] = aggregate_datatype
+        if aggregate['column_name'] is None:
+            aggregate_functions.append((aggregate['function'], None))
+        else:
+            aggregate_functions.append(
+                (aggregate['function'],
+                 column_positions[aggregate['column_name']]))
+
+    try:
+        groups, aggregates = aggregate_batches(
+            batches, [column_positions[column_name]
+                      for column_name in grouping_columns],
+            aggregate_functions)
+    except TypeError as te:
+        print('SQL Error: ' + str(te))
+        return 'SQL Error'
+
+    aggregated_data = {}
+    for i, column_name in enumerate(grouping_columns):
+        aggregated_data[column_name] = [group[i] for group in groups]
+    for aggregate_name, aggregate_values in zip(aggregate_names, aggregates):
+        aggregated_data[aggregate_name] = aggregate_values
+
+    return order_query_result(sql_tree, aggregated_data, aggregated_datatypes)
+
+
+def aggregate_name_and_datatype(aggregate, selected_columns_datatypes):
+    '''names the result column of an aggregate and determines its datatype
+
+    keyword-args:
+        aggregate - an item of the 'select aggregate' part of a sql tree
+        selected_columns_datatypes - dictionary of the simplified datatype
+                                     of each column
+
+    returns:
+        aggregate_name - name of the result column, such as sum_l_quantity
+        aggregate_datatype - simplified datatype of the result, or None if
+                             the aggregate can't be applied to its column
+'''
+    if aggregate['column_name'] is None:
+        return aggregate['function'], 'NUMBER'
+
+    aggregate_name = aggregate['function'] + '_' + aggregate['column_name']
+    column_datatype = selected_columns_datatypes.get(aggregate['column_name'])
+
+    if aggregate['function'] in ['min', 'max']:
+        return aggregate_name, column_datatype
+
+    # dates are held as ordinals, which can't be added
+    elif aggregate['function'] in ['sum', 'avg'] and \
+            column_datatype == 'DATE':
+        print('SQL Error: unsupported operand type for ' +
+              aggregate['function'] + ': date')
+        return aggregate_name, None
+
+    return aggregate_name, 'NUMBER'
+
+
+def order_query_result(sql_tree, selected_data, selected_columns_datatypes):
+    '''turns the selected columns of a query into its result, applying the
+        query's order by
+
+    keyword-args:
+        sql_tree - a sql tree, as generated by sql_to_tree library
+        selected_data - dictionary of the selected and aggregated columns.
+                        key is column name, value is the column
+        selected_columns_datatypes - dictionary of the simplified datatype
+                                     of each selected column
+
+    returns:
+        the same as execute_sqltree_on_s3
+'''
+    ordered_data = []
+
+    # dates are held as ordinals until they are returned
+    for k, column in selected_data.items():
+        if selected_columns_datatypes.get(k) == 'DATE':
+            selected_data[k] = [None if v is None else date.fromordinal(v)
+                                for v in column]
 
     # move from columnar to row orientation and apply order by
 
@@ -260,13 +1121,12 @@ def execute_sqltree_on_s3(bucket, sql_tree):
     # add support for column definitions so we can determine how to sort
     # assumes sorting on numbers for now
     selection_headers, selected_rows = transpose_columns_to_rows(selected_data)
-    ordered_data = []
 
     # only apply the sort if there are fields in the
     #   ordering part of the sql tree
     if len(sql_tree['ordering']) > 0:
-        # build a lambda function for the sort
-        order_fields_func = 'lambda i: ('
+        # get the positions of the sort fields in each row
+        order_positions = []
         for i, order_item in enumerate(sql_tree['ordering']):
 
             # handle function vs. column
@@ -277,36 +1137,18 @@ def execute_sqltree_on_s3(bucket, sql_tree):
                                     order_item['column_name']
 
             if order_column_name in selection_headers:
-
-                # if type is number, convert to float in lambda function
-                # use the original column name when looking up the datatype,
-                # but use the derived column name when building the header,
-                # as it's important to use the aggregate name in output
-                if selected_columns_datatypes[order_item['column_name']] \
-                        == 'NUMBER':
-                    sort_item = 'float(i[' + \
-                     str(selection_headers.index(order_column_name)) + ']),'
-
-                # if type is date, convert to datetime in lambda function
-                elif selected_columns_datatypes[order_item['column_name']] \
-                        == 'DATE':
-                    sort_item = 'datetime.strptime(i[' + \
-                     str(selection_headers.index(order_column_name)) + \
-                     '].lstrip(" ").strip("\'"), "%Y-%m-%d"),'
-
-                # else treat as a string
-                else:
-                    sort_item = 'i[' + \
-                        str(selection_headers.index(order_column_name)) + '],'
-
-                order_fields_func += sort_item
-
-        order_fields_func = order_fields_func.rstrip(',')
-        order_fields_func += ')'
-        order_fields_func = eval(order_fields_func)
-
-        # sort based on fields in lambda function
-        ordered_data.extend(sorted(selected_rows, key=order_fields_func))
+                order_positions.append(
+                    selection_headers.index(order_column_name))
+
+        # values are already typed, so they can be compared as they are.
+        # empty values can't be compared, so they are sorted last
+        try:
+            ordered_data.extend(sorted(selected_rows,
+                                       key=itemgetter(*order_positions)))
+        except TypeError:
+            ordered_data.extend(sorted(
+                selected_rows, key=lambda row: tuple(
+                    (row[i] is None, row[i]) for i in order_positions)))
     # otherwise, just return unsorted rows
     else:
         ordered_data.extend(selected_rows)
@@ -4,6 +4,7 @@ from virtual_S3_module import execute_sqltree_on_s3
 from virtual_postgres_module import convert_SQL_to_postgres, \
                                     execute_sql_on_postgres
 from sql_to_tree import sql_to_tree
+from s3_file_cache import open_s3_file_cache
 import get_credentials
 # import cx_Oracle
 
@@ -53,6 +54,18 @@ def virtual_sql(input_sql):
                 if v.find('credential_file_name=') != -1:
                     configuration['credential_file_name'] = \
                         v.replace('credential_file_name=', '')
+                if v.find('cache_directory=') != -1:
+                    configuration['cache_directory'] = \
+                        v.replace('cache_directory=', '')
+                if v.find('index_columns=') != -1:
+                    configuration['index_columns'] = \
+                        v.replace('index_columns=', '')
+                if v.find('join_memory_budget=') != -1:
+                    configuration['join_memory_budget'] = \
+                        v.replace('join_memory_budget=', '')
+                if v.find('join_spill_directory=') != -1:
+                    configuration['join_spill_directory'] = \
+                        v.replace('join_spill_directory=', '')
 
     except FileNotFoundError as fe:
         print('Configuration file not found!')
@@ -102,10 +115,30 @@ def virtual_sql(input_sql):
         # step 3: convert SQL to postgres compliance
         # step 4: execute SQL on database and return results
 
+        cache = None
+        if configuration.get('cache_directory', 'None') != 'None':
+            cache = open_s3_file_cache(configuration['cache_directory'])
+
+        index_columns = None
+        if configuration.get('index_columns', 'None') != 'None':
+            index_columns = set(configuration['index_columns'].split(','))
+
+        join_memory_budget = None
+        if configuration.get('join_memory_budget', 'None') != 'None':
+            join_memory_budget = int(configuration['join_memory_budget'])
+
+        join_spill_directory = None
+        if configuration.get('join_spill_directory', 'None') != 'None':
+            join_spill_directory = configuration['join_spill_directory']
+
         try:
             result = execute_sqltree_on_s3(
                         configuration['target_datastore_name'],
-                        sql_tree)
+                        sql_tree,
+                        cache,
+                        index_columns=index_columns,
+                        join_memory_budget=join_memory_budget,
+                        join_spill_directory=join_spill_directory)
         except:
             return result
 
@@ -118,7 +151,9 @@ def virtual_sql(input_sql):
 
 def configure_virtual_sql(input_sql_type, target_datastore_type,
                           target_datastore_url, target_datastore_name,
-                          credential_file_name):
+                          credential_file_name, cache_directory='None',
+                          index_columns='None', join_memory_budget='None',
+                          join_spill_directory='None'):
     ''' sets the configuration for the virtual sql interface
 
         keyword_args:
@@ -132,6 +167,18 @@ def configure_virtual_sql(input_sql_type, target_datastore_type,
                 for S3, this should be the bucket name
             credential_file_name - name of the file containing the credentials
                 for the target database.  if S3, this should be 'None'
+            cache_directory - local directory in which to cache S3 files.
+                if 'None', files are downloaded for every query (optional)
+            index_columns - comma separated names of the columns of cached
+                S3 files to index, such as 'o_orderkey,c_mktsegment'.  if
+                'None', no columns are indexed (optional)
+            join_memory_budget - bytes the hashtable of each join of S3
+                files may take before the join is partitioned on disk,
+                such as '268435456'.  if 'None', the default budget of 1 GB
+                is used (optional)
+            join_spill_directory - local directory to write the partitions
+                of joins to.  if 'None', the system's temporary directory
+                is used (optional)
 
         returns:
             True if successful
@@ -152,6 +199,14 @@ def configure_virtual_sql(input_sql_type, target_datastore_type,
                               target_datastore_name + '\n')
             config_file.write('credential_file_name=' +
                               credential_file_name + '\n')
+            config_file.write('cache_directory=' +
+                              cache_directory + '\n')
+            config_file.write('index_columns=' +
+                              index_columns + '\n')
+            config_file.write('join_memory_budget=' +
+                              join_memory_budget + '\n')
+            config_file.write('join_spill_directory=' +
+                              join_spill_directory + '\n')
 
     except TypeError as te:
         print(te)